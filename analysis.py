@@ -0,0 +1,839 @@
+"""Analyses built on the batch engine: sweeps, risk, cash-flow projections, the optimizer."""
+import math
+import time
+
+import numpy as np
+
+import parameters
+from engine import (
+    BATCH_OVERRIDE_FIELDS, PROCESS_POOL_WORKERS, batch_results_row, batch_row_error,
+    check_scenarios, compute_results, compute_results_batch, fill_auto_economics_for_form,
+    form_batch_columns, parse_number, process_pool, scenario_form,
+)
+from parameters import ensure_params_version, params_versions
+
+
+# =====================
+#  Parameter sweep
+# =====================
+# metric name -> (results field, higher is better)
+SWEEP_METRICS = {
+    "profit": ("annual_profit", True),
+    "payback": ("simple_payback_years", False),
+    "profit_per_m2": ("profit_per_m2_per_year", True),
+}
+
+SWEEP_CHUNK_SIZE = 50_000
+SWEEP_MAX_CELLS = 5_000_000
+SWEEP_MAX_TOP_N = 10_000
+
+
+def sweep_area_values(spec):
+    """
+    Areas to sweep: a single number, a list of numbers, or a range
+    {"start": ..., "stop": ..., "step": ...} with an inclusive stop.
+    """
+    if isinstance(spec, dict):
+        try:
+            start = float(spec["start"])
+            stop = float(spec["stop"])
+            step = float(spec.get("step") or (stop - start) or 1)
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("area range needs numeric start, stop and step")
+        if step <= 0 or stop < start:
+            raise ValueError("area range needs start <= stop and a positive step")
+        if (stop - start) / step >= SWEEP_MAX_CELLS:
+            raise ValueError(f"area range has more than {SWEEP_MAX_CELLS} values")
+        return np.arange(start, stop + step / 2, step)
+    if isinstance(spec, (list, tuple)):
+        values = spec
+    else:
+        values = [spec]
+    try:
+        return np.array([float(v) for v in values])
+    except (TypeError, ValueError):
+        raise ValueError("area values must be numbers")
+
+
+def _sweep_axis(values, default, name):
+    if values is None:
+        return list(default)
+    if isinstance(values, str):
+        values = [values]
+    values = [str(v) for v in values]
+    if not values:
+        raise ValueError(f"{name} must not be empty")
+    return values
+
+
+def _sweep_grid_columns(grid, flat_idx):
+    areas, crops, system_types, setup_levels = grid["axes"]
+    a, c, s, l = np.unravel_index(flat_idx, grid["shape"])
+    columns = dict(grid["fixed"])
+    columns.update({
+        "area_m2": areas[a],
+        "crop": np.asarray(crops)[c],
+        "system_type": np.asarray(system_types)[s],
+        "setup_level": np.asarray(setup_levels)[l],
+    })
+    return columns
+
+
+def plan_sweep(area=2000, crops=None, system_types=None, setup_levels=None,
+               country="US", currency_override="", use_solar=False,
+               metric="profit", top_n=20):
+    """
+    Validate sweep arguments and describe the grid. Raises ValueError with a
+    user-facing message for bad input, before anything is computed.
+    """
+    if metric not in SWEEP_METRICS:
+        raise ValueError(f"metric must be one of: {', '.join(SWEEP_METRICS)}")
+    try:
+        top_n = int(top_n)
+    except (TypeError, ValueError):
+        raise ValueError("top_n must be an integer")
+    if not 1 <= top_n <= SWEEP_MAX_TOP_N:
+        raise ValueError(f"top_n must be between 1 and {SWEEP_MAX_TOP_N}")
+
+    param_set = parameters.PARAMS
+    tables = param_set.tables
+    axes = (
+        sweep_area_values(area),
+        _sweep_axis(crops, tables["PRICE_PER_KG_USD"]["GLOBAL"], "crops"),
+        _sweep_axis(system_types, tables["PRODUCTION_COST_PER_M2_USD"], "system_types"),
+        _sweep_axis(setup_levels, tables["SETUP_LEVEL_LABELS"], "setup_levels"),
+    )
+    shape = tuple(len(axis) for axis in axes)
+    cells = int(np.prod(shape))
+    if cells > SWEEP_MAX_CELLS:
+        raise ValueError(f"sweep grid has {cells} cells; the limit is {SWEEP_MAX_CELLS}")
+
+    return {
+        "axes": axes,
+        "shape": shape,
+        "cells": cells,
+        "metric": metric,
+        "top_n": top_n,
+        "param_set": param_set,
+        "fixed": {
+            "country": country or "US",
+            "currency_override": currency_override or "",
+            "use_solar": bool(use_solar),
+        },
+    }
+
+
+def iter_sweep(grid):
+    """
+    Evaluate a plan_sweep grid chunk by chunk and yield the top-N rows, best
+    first, as compute_results dicts with "rank" and "score" added. Only the
+    current chunk and the running top-N are held in memory.
+    """
+    field, higher_is_better = SWEEP_METRICS[grid["metric"]]
+    top_n = grid["top_n"]
+    best_idx = np.empty(0, dtype=np.int64)
+    best_key = np.empty(0)
+
+    for lo in range(0, grid["cells"], SWEEP_CHUNK_SIZE):
+        idx = np.arange(lo, min(lo + SWEEP_CHUNK_SIZE, grid["cells"]), dtype=np.int64)
+        batch = compute_results_batch(_sweep_grid_columns(grid, idx), grid["param_set"])
+        score = batch[field]
+        # Lower key ranks first; NaN (no payback) and invalid rows drop out.
+        key = -score if higher_is_better else score
+        keep = batch["valid"] & np.isfinite(key)
+
+        cand_idx = np.concatenate([best_idx, idx[keep]])
+        cand_key = np.concatenate([best_key, key[keep]])
+        if len(cand_key) > top_n:
+            # Ties with the N-th keep grid order, whatever the chunking.
+            kth = np.partition(cand_key, top_n - 1)[top_n - 1]
+            above = np.flatnonzero(cand_key < kth)
+            tied = np.flatnonzero(cand_key == kth)
+            tied = tied[np.argsort(cand_idx[tied], kind="stable")][:top_n - len(above)]
+            part = np.concatenate([above, tied])
+            cand_idx, cand_key = cand_idx[part], cand_key[part]
+        best_idx, best_key = cand_idx, cand_key
+
+    order = np.lexsort((best_idx, best_key))
+    best_idx = best_idx[order]
+
+    rank = 0
+    for lo in range(0, len(best_idx), SWEEP_CHUNK_SIZE):
+        batch = compute_results_batch(
+            _sweep_grid_columns(grid, best_idx[lo:lo + SWEEP_CHUNK_SIZE]), grid["param_set"]
+        )
+        for i in range(len(batch["valid"])):
+            row, _ = batch_results_row(batch, i)
+            rank += 1
+            row["rank"] = rank
+            row["score"] = row[field]
+            yield row
+
+
+def sweep_scenarios(**kwargs):
+    """Run a crop x system x setup x area sweep; see plan_sweep for arguments."""
+    return list(iter_sweep(plan_sweep(**kwargs)))
+
+
+# =====================
+#  Monte Carlo risk
+# =====================
+# Every uncertain input is scaled by a random multiplier drawn around 1.0:
+#   normal     {"sd": ...}                 (clipped at 0)
+#   lognormal  {"sd": ...}                 (sd of the log, median 1.0)
+#   uniform    {"low": ..., "high": ...}
+#   triangular {"low": ..., "mode": ..., "high": ...}
+#   fixed      {"value": ...}
+RISK_DEFAULT_UNCERTAINTY = {
+    "yield": {"dist": "normal", "sd": 0.15},
+    "price": {"dist": "lognormal", "sd": 0.20},
+    "cost": {"dist": "normal", "sd": 0.10},
+    "fx": {"dist": "lognormal", "sd": 0.05},
+    "solar_savings_rate": {"dist": "uniform", "low": 0.5, "high": 1.5},
+}
+
+RISK_DEFAULT_DRAWS = 100_000
+RISK_MAX_DRAWS = 1_000_000
+RISK_MAX_TOTAL_DRAWS = 20_000_000
+RISK_PAYBACK_HORIZONS = (3, 5, 10)
+
+
+def risk_specs(uncertainty=None):
+    """
+    RISK_DEFAULT_UNCERTAINTY overlaid with `uncertainty`, every
+    distribution checked; raises ValueError.
+    """
+    if uncertainty is not None and not isinstance(uncertainty, dict):
+        raise ValueError("uncertainty must be an object keyed by input name")
+    for name, spec in (uncertainty or {}).items():
+        if name not in RISK_DEFAULT_UNCERTAINTY:
+            raise ValueError(f"unknown uncertain input {name!r}")
+        if not isinstance(spec, dict):
+            raise ValueError(f"uncertainty for {name} must be an object")
+        _draw_factor(np.random.default_rng(0), spec, 1)
+    return {**RISK_DEFAULT_UNCERTAINTY, **(uncertainty or {})}
+
+
+def _draw_factor(rng, spec, draws):
+    dist = spec.get("dist", "fixed")
+    try:
+        if dist == "fixed":
+            return np.full(draws, float(spec.get("value", 1.0)))
+        if dist == "normal":
+            return np.clip(rng.normal(1.0, float(spec["sd"]), draws), 0.0, None)
+        if dist == "lognormal":
+            return rng.lognormal(0.0, float(spec["sd"]), draws)
+        if dist == "uniform":
+            return rng.uniform(float(spec["low"]), float(spec["high"]), draws)
+        if dist == "triangular":
+            return rng.triangular(float(spec["low"]), float(spec["mode"]), float(spec["high"]), draws)
+    except (KeyError, TypeError, ValueError) as exc:
+        raise ValueError(f"bad {dist} distribution {spec!r}: {exc}")
+    raise ValueError(f"unknown distribution {dist!r}")
+
+
+def _percentiles(values, method="linear"):
+    p5, p50, p95 = np.percentile(values, [5, 50, 95], method=method)
+    return {
+        "p5": float(p5) if np.isfinite(p5) else None,
+        "p50": float(p50) if np.isfinite(p50) else None,
+        "p95": float(p95) if np.isfinite(p95) else None,
+    }
+
+
+def simulate_risk(scenario, draws=RISK_DEFAULT_DRAWS, seed=None, uncertainty=None):
+    """
+    Monte Carlo version of compute_results for one scenario: (report, error)
+    with profit percentiles, the payback distribution and the probability
+    of a loss. FX only moves the figures estimated from the USD tables.
+    """
+    specs = risk_specs(uncertainty)
+    form = scenario_form(scenario)
+    auto = {key for key in BATCH_OVERRIDE_FIELDS if parse_number(form.get(key)) <= 0}
+    param_set = parameters.PARAMS
+    fill_auto_economics_for_form(form, param_set)
+    point, error = compute_results(form, param_set)
+    if error:
+        return None, error
+
+    rng = np.random.default_rng(seed)
+    factor = {name: _draw_factor(rng, specs[name], draws) for name in RISK_DEFAULT_UNCERTAINTY}
+    fx = factor["fx"]
+
+    annual_yield = point["annual_yield"] * factor["yield"]
+    price = point["price_per_kg"] * factor["price"]
+    if "price_per_unit" in auto:
+        price /= fx
+    gross_cost = point["gross_production_cost"] * factor["cost"]
+    if "annual_production_cost" in auto:
+        gross_cost /= fx
+    if point["use_solar"]:
+        gross_cost -= gross_cost * (point["SOLAR_SAVINGS_RATE"] * factor["solar_savings_rate"])
+    setup_cost = point["total_setup_cost"]
+    if "capex_per_m2" in auto:
+        setup_cost = setup_cost / fx
+
+    profit = annual_yield * price - gross_cost
+    with np.errstate(divide="ignore"):
+        payback = np.where(profit > 0, setup_cost / profit, np.inf)
+
+    report = {
+        "draws": draws,
+        "currency_code": point["currency_code"],
+        "point": {
+            "annual_profit": point["annual_profit"],
+            "simple_payback_years": point["simple_payback_years"],
+        },
+        "annual_profit": {
+            "mean": float(profit.mean()),
+            "std": float(profit.std()),
+            **_percentiles(profit),
+        },
+        "probability_of_loss": float(np.mean(profit < 0)),
+        "payback_years": {
+            **_percentiles(payback, method="inverted_cdf"),
+            "probability_no_payback": float(np.mean(np.isinf(payback))),
+            "probability_within": {
+                str(years): float(np.mean(payback <= years))
+                for years in RISK_PAYBACK_HORIZONS
+            },
+        },
+    }
+    return report, None
+
+
+def _simulate_risk_task(args):
+    scenario, draws, seed, uncertainty, versions = args
+    ensure_params_version(versions)
+    report, error = simulate_risk(scenario, draws, seed, uncertainty)
+    return report if report else {"error": error}
+
+
+def run_risk(scenarios, draws=RISK_DEFAULT_DRAWS, seed=None, uncertainty=None):
+    """
+    Simulate many scenarios. Scenario i always draws from child i of
+    SeedSequence(seed), so the returned seed reproduces the whole run
+    whether it ran inline or on the process pool.
+    """
+    try:
+        draws = int(draws)
+    except (TypeError, ValueError):
+        raise ValueError("draws must be an integer")
+    if not 1 <= draws <= RISK_MAX_DRAWS:
+        raise ValueError(f"draws must be between 1 and {RISK_MAX_DRAWS}")
+    check_scenarios(scenarios)
+    if seed is not None and (isinstance(seed, bool) or not isinstance(seed, int) or seed < 0):
+        raise ValueError("seed must be a non-negative integer")
+    if draws * len(scenarios) > RISK_MAX_TOTAL_DRAWS:
+        raise ValueError(f"at most {RISK_MAX_TOTAL_DRAWS} draws per request")
+    specs = risk_specs(uncertainty)
+
+    seed_seq = np.random.SeedSequence(seed)
+    tasks = [
+        (scenario, draws, child, specs, params_versions())
+        for scenario, child in zip(scenarios, seed_seq.spawn(len(scenarios)))
+    ]
+    if len(tasks) == 1 or PROCESS_POOL_WORKERS <= 1:
+        results = [_simulate_risk_task(task) for task in tasks]
+    else:
+        results = list(process_pool().map(_simulate_risk_task, tasks))
+    return {"seed": seed_seq.entropy, "results": results}
+
+
+# =====================
+#  Cash-flow projection
+# =====================
+# Year 1..years figures start from the compute_results year:
+#   revenue   annual_revenue x ramp_up[year] x (1 + price_inflation)^(year-1)
+#   costs     net_production_cost x (1 + cost_inflation)^(year-1)
+#   equipment equipment_replacement_share of the setup cost, inflated, every
+#             equipment_life_years (not in the final year)
+#   financing loan_share of the setup cost borrowed at loan_rate, repaid as
+#             an annuity over loan_years; a balance left at the horizon is
+#             repaid in the final year
+# Year 0 is the equity part of the setup cost. Cash flows are to equity.
+PROJECTION_DEFAULTS = {
+    "years": 10,
+    "discount_rate": 0.08,
+    "ramp_up": [0.6, 0.85],
+    "price_inflation": 0.02,
+    "cost_inflation": 0.03,
+    "equipment_life_years": 10,
+    "equipment_replacement_share": 0.4,
+    "loan_share": 0.0,
+    "loan_rate": 0.07,
+    "loan_years": 7,
+}
+PROJECTION_MAX_YEARS = 30
+PROJECTION_MAX_SCENARIOS = 100_000
+# Per-year series are returned for requests up to this many scenarios.
+PROJECTION_DETAIL_MAX = 100
+
+
+def projection_options(options=None):
+    """PROJECTION_DEFAULTS overlaid with `options`; raises ValueError."""
+    opts = dict(PROJECTION_DEFAULTS)
+    for key, value in (options or {}).items():
+        if key not in PROJECTION_DEFAULTS:
+            raise ValueError(f"unknown projection option {key!r}")
+        if value is not None:
+            opts[key] = value
+    try:
+        for key in ("years", "equipment_life_years", "loan_years"):
+            opts[key] = int(opts[key])
+        for key in ("discount_rate", "price_inflation", "cost_inflation",
+                    "equipment_replacement_share", "loan_share", "loan_rate"):
+            opts[key] = float(opts[key])
+        opts["ramp_up"] = [float(v) for v in opts["ramp_up"]]
+    except (TypeError, ValueError):
+        raise ValueError("projection options must be numbers (ramp_up a list of numbers)")
+
+    if not 1 <= opts["years"] <= PROJECTION_MAX_YEARS:
+        raise ValueError(f"years must be between 1 and {PROJECTION_MAX_YEARS}")
+    if opts["equipment_life_years"] < 1 or opts["loan_years"] < 1:
+        raise ValueError("equipment_life_years and loan_years must be at least 1")
+    for key in ("discount_rate", "price_inflation", "cost_inflation", "loan_rate"):
+        if opts[key] <= -1:
+            raise ValueError(f"{key} must be above -1")
+    for key in ("equipment_replacement_share", "loan_share"):
+        if not 0 <= opts[key] <= 1:
+            raise ValueError(f"{key} must be between 0 and 1")
+    if any(v < 0 for v in opts["ramp_up"]):
+        raise ValueError("ramp_up fractions can't be negative")
+    return opts
+
+
+def project_cash_flows(annual_revenue, annual_cost, setup_cost, opts):
+    """
+    Equity cash flows for N farms as an (N, years + 1) array, column 0
+    being year 0, plus the (N, years) component series.
+    """
+    years = opts["years"]
+    t = np.arange(1, years + 1)
+    ramp = np.ones(years)
+    ramp_up = opts["ramp_up"][:years]
+    ramp[:len(ramp_up)] = ramp_up
+
+    revenue = annual_revenue[:, None] * (ramp * (1 + opts["price_inflation"]) ** (t - 1))
+    operating_cost = annual_cost[:, None] * (1 + opts["cost_inflation"]) ** (t - 1)
+    replaced = (t % opts["equipment_life_years"] == 0) & (t < years)
+    replacement = setup_cost[:, None] * (
+        replaced * opts["equipment_replacement_share"] * (1 + opts["cost_inflation"]) ** t
+    )
+
+    loan = setup_cost * opts["loan_share"]
+    rate, term = opts["loan_rate"], opts["loan_years"]
+    factor = 1 / term if rate == 0 else rate / (1 - (1 + rate) ** -term)
+    payment = loan * factor
+    debt_service = payment[:, None] * (t <= term)
+    if term > years:
+        if rate == 0:
+            balance = loan - payment * years
+        else:
+            growth = (1 + rate) ** years
+            balance = loan * growth - payment * (growth - 1) / rate
+        debt_service[:, -1] += balance
+
+    cash = np.empty((len(setup_cost), years + 1))
+    cash[:, 0] = -(setup_cost - loan)
+    cash[:, 1:] = revenue - operating_cost - replacement - debt_service
+    series = {
+        "revenue": revenue,
+        "operating_cost": operating_cost,
+        "equipment_replacement": replacement,
+        "debt_service": debt_service,
+    }
+    return cash, series
+
+
+def npv(cash, rate):
+    """Net present value of each row of `cash` (column t = year t)."""
+    return cash @ (1.0 + rate) ** -np.arange(cash.shape[1])
+
+
+def irr(cash, tol=1e-10, newton_steps=50, bisect_steps=100, low=-0.99, high=100.0):
+    """
+    Internal rate of return of every row of `cash` at once. Newton's method
+    runs on all rows together from 10%; rows it leaves unsettled are
+    bisected over (low, high). NaN where that range brackets no root.
+    """
+    t = np.arange(cash.shape[1])
+    scale = np.abs(cash).sum(axis=1)
+    scale[scale == 0] = 1.0
+
+    def value(rate, rows=slice(None)):
+        return (cash[rows] * (1 + rate)[:, None] ** -t).sum(axis=1)
+
+    rate = np.full(len(cash), 0.1)
+    with np.errstate(all="ignore"):
+        for _ in range(newton_steps):
+            disc = (1 + rate)[:, None] ** -t
+            f = (cash * disc).sum(axis=1)
+            df = -(cash * t * disc).sum(axis=1) / (1 + rate)
+            step = np.where(df != 0, f / df, 0.0)
+            rate = np.clip(rate - step, low + 1e-12, high)
+            if np.all(np.abs(step) < tol):
+                break
+        settled = np.isfinite(rate) & (np.abs(value(rate)) / scale < tol)
+
+        todo = np.flatnonzero(~settled)
+        if len(todo):
+            lo = np.full(len(todo), low)
+            hi = np.full(len(todo), high)
+            f_lo = value(lo, todo)
+            bracketed = np.sign(f_lo) != np.sign(value(hi, todo))
+            for _ in range(bisect_steps):
+                mid = (lo + hi) / 2
+                f_mid = value(mid, todo)
+                left = np.sign(f_mid) == np.sign(f_lo)
+                lo = np.where(left, mid, lo)
+                f_lo = np.where(left, f_mid, f_lo)
+                hi = np.where(left, hi, mid)
+            rate[todo] = np.where(bracketed, (lo + hi) / 2, np.nan)
+    return rate
+
+
+def payback_years(cash, rate=0.0):
+    """
+    Years until cumulative (discounted at `rate`) cash turns non-negative,
+    interpolated within the year; NaN if it never does within the horizon.
+    """
+    flows = cash * (1.0 + rate) ** -np.arange(cash.shape[1])
+    cumulative = np.cumsum(flows, axis=1)
+    paid = cumulative >= 0
+    first = paid.argmax(axis=1)
+    rows = np.arange(len(cash))
+    before = cumulative[rows, np.maximum(first - 1, 0)]
+    with np.errstate(all="ignore"):
+        years = np.where(first == 0, 0.0, first - 1 - before / flows[rows, first])
+    years[~paid.any(axis=1)] = np.nan
+    return years
+
+
+def _float_or_none(value):
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+
+def run_projection(scenarios, options=None, detail=None):
+    """
+    Project every scenario over the horizon in one set of array operations:
+    compute_results_batch for year one, then NPV, IRR and (discounted)
+    payback per scenario, in the scenario's display currency.
+    """
+    opts = projection_options(options)
+    check_scenarios(scenarios)
+    if len(scenarios) > PROJECTION_MAX_SCENARIOS:
+        raise ValueError(f"at most {PROJECTION_MAX_SCENARIOS} scenarios per request")
+    if detail is None:
+        detail = len(scenarios) <= PROJECTION_DETAIL_MAX
+
+    batch = compute_results_batch(form_batch_columns([scenario_form(s) for s in scenarios]))
+    valid = batch["valid"]
+    zero = np.zeros(len(valid))
+    cash, series = project_cash_flows(
+        np.where(valid, batch["annual_revenue"], zero),
+        np.where(valid, batch["net_production_cost"], zero),
+        np.where(valid, batch["total_setup_cost"], zero),
+        opts,
+    )
+    net_present_value = npv(cash, opts["discount_rate"])
+    internal_rate = irr(cash)
+    payback = payback_years(cash)
+    discounted_payback = payback_years(cash, opts["discount_rate"])
+
+    results = []
+    for i in range(len(valid)):
+        if not valid[i]:
+            results.append({"error": batch_row_error(batch, i)})
+            continue
+        report = {
+            "currency_code": batch["currency_code"][i],
+            "country_code": batch["country_code"][i],
+            "crop": batch["crop"][i],
+            "system_type": batch["system_type"][i],
+            "setup_level": batch["setup_level"][i],
+            "area": float(batch["area"][i]),
+            "total_setup_cost": float(batch["total_setup_cost"][i]),
+            "npv": float(net_present_value[i]),
+            "irr": _float_or_none(internal_rate[i]),
+            "payback_years": _float_or_none(payback[i]),
+            "discounted_payback_years": _float_or_none(discounted_payback[i]),
+            "total_cash": float(cash[i, 1:].sum() + cash[i, 0]),
+        }
+        if detail:
+            report["cash_flows"] = cash[i].tolist()
+            for name, values in series.items():
+                report[name] = values[i].tolist()
+        results.append(report)
+    return {"options": opts, "results": results}
+
+
+# =====================
+#  Area optimizer
+# =====================
+OPTIMIZE_OBJECTIVES = ("profit", "payback")
+OPTIMIZE_SYSTEMS = ("soil", "soilless", "vertical", "hydroponics", "aeroponics")
+OPTIMIZE_TOL = 1e-9
+
+
+def _pivot(tableau, basis, row, col):
+    tableau[row] /= tableau[row, col]
+    others = np.flatnonzero(tableau[:, col])
+    others = others[others != row]
+    tableau[others] -= np.outer(tableau[others, col], tableau[row])
+    basis[row] = col
+
+
+def _simplex_iterate(tableau, basis, allowed):
+    # Bland's rule: lowest-index improving column and lowest-index leaving
+    # basic variable among ties, which rules out cycling.
+    while True:
+        reduced = tableau[-1, :-1]
+        entering = np.flatnonzero((reduced < -OPTIMIZE_TOL) & allowed)
+        if not len(entering):
+            return
+        col = entering[0]
+        column = tableau[:-1, col]
+        rows = np.flatnonzero(column > OPTIMIZE_TOL)
+        if not len(rows):
+            raise ValueError("the allocation problem is unbounded")
+        ratios = tableau[rows, -1] / column[rows]
+        best = rows[ratios <= ratios.min() + OPTIMIZE_TOL]
+        row = best[np.argmin([basis[i] for i in best])]
+        _pivot(tableau, basis, row, col)
+
+
+def _set_objective(tableau, basis, c):
+    # Reduced-cost row for maximizing c @ x given the current basis.
+    tableau[-1] = 0.0
+    tableau[-1, :len(c)] = -c
+    for i, col in enumerate(basis):
+        if tableau[-1, col]:
+            tableau[-1] -= tableau[-1, col] * tableau[i]
+
+
+def simplex_max(c, rows, senses, rhs):
+    """
+    Maximize c @ x subject to rows @ x (<=, >= or ==) rhs and x >= 0, with
+    a two-phase tableau simplex. Returns x, or None when infeasible; raises
+    ValueError when unbounded. Meant for the optimizer's small dense LPs.
+    """
+    A = np.array(rows, dtype=float).reshape(len(rhs), len(c))
+    b = np.array(rhs, dtype=float)
+    c = np.asarray(c, dtype=float)
+    # Row scaling keeps m2, currency and ratio rows comparable.
+    scale = np.abs(A).max(axis=1)
+    scale[scale == 0] = 1.0
+    A /= scale[:, None]
+    b /= scale
+    senses = list(senses)
+    for i in np.flatnonzero(b < 0):
+        A[i], b[i] = -A[i], -b[i]
+        senses[i] = {"<=": ">=", ">=": "<=", "==": "=="}[senses[i]]
+
+    m, n = A.shape
+    n_slack = sum(sense != "==" for sense in senses)
+    n_art = sum(sense != "<=" for sense in senses)
+    tableau = np.zeros((m + 1, n + n_slack + n_art + 1))
+    tableau[:m, :n] = A
+    tableau[:m, -1] = b
+    basis = []
+    slack, art = n, n + n_slack
+    for i, sense in enumerate(senses):
+        if sense == "<=":
+            tableau[i, slack] = 1.0
+            basis.append(slack)
+            slack += 1
+        else:
+            if sense == ">=":
+                tableau[i, slack] = -1.0
+                slack += 1
+            tableau[i, art] = 1.0
+            basis.append(art)
+            art += 1
+
+    allowed = np.ones(tableau.shape[1] - 1, dtype=bool)
+    if n_art:
+        # Phase 1: drive the artificial variables to zero.
+        phase1 = np.zeros(n + n_slack + n_art)
+        phase1[n + n_slack:] = -1.0
+        _set_objective(tableau, basis, phase1)
+        _simplex_iterate(tableau, basis, allowed)
+        if tableau[-1, -1] < -1e-7 * max(1.0, np.abs(b).max()):
+            return None
+        allowed[n + n_slack:] = False
+        for i, col in enumerate(basis):
+            if col >= n + n_slack:
+                candidates = np.flatnonzero((np.abs(tableau[i, :n + n_slack]) > OPTIMIZE_TOL))
+                if len(candidates):
+                    _pivot(tableau, basis, i, candidates[0])
+
+    _set_objective(tableau, basis, c / (np.abs(c).max() or 1.0))
+    _simplex_iterate(tableau, basis, allowed)
+    x = np.zeros(n)
+    for i, col in enumerate(basis):
+        if col < n:
+            x[col] = tableau[i, -1]
+    return np.maximum(x, 0.0)
+
+
+def _check_option_names(what, names, known):
+    if not isinstance(names, (list, tuple)) or not all(isinstance(n, str) for n in names):
+        raise ValueError(f"{what} must be a list of names")
+    unknown = sorted(set(names) - set(known))
+    if unknown:
+        raise ValueError(f"unknown {what}: {', '.join(unknown)}; use {', '.join(sorted(known))}")
+
+
+def _limit_area(value, what):
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool):
+        raise ValueError(f"{what} must be a number")
+    try:
+        area = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{what} must be a number")
+    if not math.isfinite(area):
+        raise ValueError(f"{what} must be a number")
+    return area
+
+
+def optimize_allocation(spec):
+    """
+    Split spec["area_m2"] across crop/system/setup options to maximize
+    annual profit or minimize simple payback, within an optional capex
+    budget and per-crop min/max areas. Raises ValueError for bad input or
+    no feasible split.
+
+    spec: area_m2, objective, capex_budget, country, currency_override,
+    use_solar, systems, setup_levels and crops, a mapping of crop name to
+    {"min_area", "max_area", "systems"} (default: every crop, no limits).
+    """
+    if not isinstance(spec, dict):
+        raise ValueError("expected a JSON object")
+    area = parse_number(spec.get("area_m2"))
+    if area <= 0:
+        raise ValueError("area_m2 must be positive")
+    objective = spec.get("objective", "profit")
+    if objective not in OPTIMIZE_OBJECTIVES:
+        raise ValueError(f"objective must be one of: {', '.join(OPTIMIZE_OBJECTIVES)}")
+    budget = spec.get("capex_budget")
+    budget = None if budget in (None, "") else parse_number(budget)
+
+    known = parameters.PARAMS.keys
+    crops = spec.get("crops") or {crop: {} for crop in sorted(known[2])}
+    if isinstance(crops, list):
+        crops = {crop: {} for crop in crops}
+    if not isinstance(crops, dict):
+        raise ValueError("crops must be a list of names or an object of crop limits")
+    limit_areas = {}
+    for crop, limits in crops.items():
+        if limits is not None and not isinstance(limits, dict):
+            raise ValueError(f"limits for {crop} must be an object")
+        if (limits or {}).get("systems"):
+            _check_option_names(f"systems for {crop}", limits["systems"], known[1])
+        limit_areas[crop] = {
+            key: _limit_area((limits or {}).get(key), f"{key} for {crop}")
+            for key in ("min_area", "max_area")
+        }
+    systems = spec.get("systems") or OPTIMIZE_SYSTEMS
+    setup_levels = spec.get("setup_levels") or [spec.get("setup_level", "standard")]
+    _check_option_names("crops", list(crops), known[2])
+    _check_option_names("systems", systems, known[1])
+    _check_option_names("setup_levels", setup_levels, known[3])
+
+    options = [
+        (crop, system, setup)
+        for crop, limits in crops.items()
+        for system in ((limits or {}).get("systems") or systems)
+        for setup in setup_levels
+    ]
+    if not options:
+        raise ValueError("no crop/system options to allocate")
+
+    scenario = {
+        "area_m2": area,
+        "country": spec.get("country"),
+        "currency_override": spec.get("currency_override"),
+        "use_solar": spec.get("use_solar"),
+    }
+    forms = [
+        scenario_form({**scenario, "crop": crop, "system_type": system, "setup_level": setup})
+        for crop, system, setup in options
+    ]
+    batch = compute_results_batch(form_batch_columns(forms))
+    profit = batch["annual_profit"] / area
+    capex = batch["total_setup_cost"] / area
+
+    rows, senses, rhs = [np.ones(len(options))], ["<="], [area]
+    if budget is not None:
+        rows.append(capex)
+        senses.append("<=")
+        rhs.append(budget)
+    for crop, limits in limit_areas.items():
+        member = np.array([opt[0] == crop for opt in options], dtype=float)
+        if limits["max_area"] is not None:
+            rows.append(member)
+            senses.append("<=")
+            rhs.append(limits["max_area"])
+        if (limits["min_area"] or 0) > 0:
+            rows.append(member)
+            senses.append(">=")
+            rhs.append(limits["min_area"])
+
+    started = time.perf_counter()
+    x = simplex_max(profit, rows, senses, rhs)
+    if x is None:
+        raise ValueError("no allocation satisfies the area, budget and crop limits")
+
+    if objective == "payback":
+        if profit @ x <= 0:
+            raise ValueError("no allocation within the limits makes a profit")
+        # Dinkelbach: maximize profit - ratio * capex until the best value
+        # is zero; ratio is then the best achievable profit per unit capex.
+        ratio = (profit @ x) / (capex @ x)
+        for _ in range(50):
+            candidate = simplex_max(profit - ratio * capex, rows, senses, rhs)
+            if (profit - ratio * capex) @ candidate <= 1e-9 * (np.abs(profit) @ candidate):
+                break
+            x = candidate
+            ratio = (profit @ x) / (capex @ x)
+        # Among the allocations with that payback, take the most profitable.
+        best = simplex_max(
+            profit,
+            rows + [profit - ratio * (1 - 1e-9) * capex],
+            senses + [">="],
+            rhs + [0.0],
+        )
+        if best is not None:
+            x = best
+    solve_seconds = time.perf_counter() - started
+
+    allocation = [
+        {
+            "crop": crop,
+            "system_type": system,
+            "setup_level": setup,
+            "area": float(x[j]),
+            "annual_profit": float(profit[j] * x[j]),
+            "total_setup_cost": float(capex[j] * x[j]),
+        }
+        for j, (crop, system, setup) in enumerate(options)
+        if x[j] > 1e-6 * area
+    ]
+    total_profit = float(profit @ x)
+    total_capex = float(capex @ x)
+    return {
+        "objective": objective,
+        "currency_code": batch["currency_code"][0],
+        "allocation": allocation,
+        "total_area": float(x.sum()),
+        "unused_area": float(area - x.sum()),
+        "annual_profit": total_profit,
+        "total_setup_cost": total_capex,
+        "payback_years": total_capex / total_profit if total_profit > 0 else None,
+        "options_considered": len(options),
+        "solve_seconds": solve_seconds,
+    }
@@ -1,616 +1,272 @@
-import sqlite3
+import time
+
+_IMPORT_STARTED = time.perf_counter()
+
+import cProfile
 import datetime
-import requests
-import csv
-from io import StringIO
+import hashlib
+import json
+import os
+import random
+import tempfile
+
+import click
 from flask import Response
 from flask import (
     Flask, render_template, request, g,
-    redirect, url_for, session
+    redirect, url_for, session, jsonify, stream_with_context,
+    before_render_template, template_rendered
+)
+from flask.sessions import SecureCookieSessionInterface
+from markupsafe import Markup
+
+import jobs
+import parameters
+import storage
+from analysis import (
+    PROJECTION_DEFAULTS, RISK_DEFAULT_DRAWS, iter_sweep, optimize_allocation, plan_sweep,
+    run_projection, run_risk,
+)
+from engine import (
+    RESULT_CACHE, RESULT_INPUTS, calculate, fill_auto_economics_for_form, scenario_form,
+    shutdown_process_pool, whatif,
+)
+from jobs import (
+    API_STREAM_MAX_SCENARIOS, JOB_POLL_INTERVAL, JOB_RUNNER, JOB_RUNNER_MODE, JobRunner,
+    JobUploadTooLarge, api_log_requested, create_job, delete_job, dumps_json,
+    iter_calculate_stream, iter_job_results, job_chunk_path, job_format_for, job_status,
+)
+from metrics import METRICS, PROFILE_SAMPLE_RATE, SLOW_PROFILES, phase, route_label
+from parameters import (
+    FX_RATES_URL, FX_UNKNOWN_CURRENCIES, PARAMS_FILE, current_params, get_countries,
+    maybe_reload_countries, maybe_reload_fx_rates, maybe_reload_params, param_fallback_report,
+    refresh_countries_in_background, refresh_fx_rates_in_background, save_params_file,
+    start_country_refresh, start_fx_refresh,
+)
+from storage import (
+    REEVALUATE_CHUNK_SIZE, REEVALUATE_WORKERS, ROLLUP_DIMENSIONS,
+    analytics_summary, calculate_and_store, catch_up_rollups, export_history_npz, get_db,
+    gzip_stream, history_filters, history_page, iter_history_csv, load_result, log_calculation,
+    open_db, rebuild_rollups, recent_calculations, reevaluate_history, reevaluation_report,
+    reset_history, rollback_db, stream_file_and_remove, whatif_base,
 )
 
 app = Flask(__name__)
 app.secret_key = "CHANGE_THIS_TO_A_RANDOM_SECRET_KEY"  # required for session
 
-DATABASE = "farm_calc.db"
-SOLAR_SAVINGS_RATE = 0.20  # 20%
-
-# =========================
-#  CROP YIELD + NUTRIENTS
-# =========================
-
-CROP_PARAMS = {
-    "GLOBAL": {
-        "soil": {
-            "tomato":         {"plants_per_m2": 2.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 30, "nutrients_kg_m2_crop": 0.6},
-            "pepper":         {"plants_per_m2": 2.5, "crops_per_year": 1,  "yield_per_m2_per_crop": 25, "nutrients_kg_m2_crop": 0.55},
-            "cucumber":       {"plants_per_m2": 1.8, "crops_per_year": 1,  "yield_per_m2_per_crop": 32, "nutrients_kg_m2_crop": 0.55},
-            "strawberry":     {"plants_per_m2": 7.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 20, "nutrients_kg_m2_crop": 0.40},
-            "lettuce":        {"plants_per_m2": 16,  "crops_per_year": 4,  "yield_per_m2_per_crop": 2.5,"nutrients_kg_m2_crop": 0.15},
-            "spinach":        {"plants_per_m2": 16,  "crops_per_year": 4,  "yield_per_m2_per_crop": 2.3,"nutrients_kg_m2_crop": 0.15},
-            "potato":         {"plants_per_m2": 3.5, "crops_per_year": 1,  "yield_per_m2_per_crop": 5,  "nutrients_kg_m2_crop": 0.45},
-            "fluted_pumpkin": {"plants_per_m2": 3.5, "crops_per_year": 3,  "yield_per_m2_per_crop": 1.6,"nutrients_kg_m2_crop": 0.18},
-            "basil":          {"plants_per_m2": 20,  "crops_per_year": 4,  "yield_per_m2_per_crop": 1.2,"nutrients_kg_m2_crop": 0.12},
-            "water_leaf":     {"plants_per_m2": 14,  "crops_per_year": 4,  "yield_per_m2_per_crop": 1.8,"nutrients_kg_m2_crop": 0.16},
-            "cannabis":       {"plants_per_m2": 5.0, "crops_per_year": 2,  "yield_per_m2_per_crop": 0.7,"nutrients_kg_m2_crop": 0.35},
-        },
-        "soilless": {
-            "tomato":         {"plants_per_m2": 2.5, "crops_per_year": 1,  "yield_per_m2_per_crop": 55, "nutrients_kg_m2_crop": 0.9},
-            "pepper":         {"plants_per_m2": 3.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 45, "nutrients_kg_m2_crop": 0.85},
-            "cucumber":       {"plants_per_m2": 2.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 65, "nutrients_kg_m2_crop": 0.85},
-            "strawberry":     {"plants_per_m2": 8.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 35, "nutrients_kg_m2_crop": 0.55},
-            "lettuce":        {"plants_per_m2": 20,  "crops_per_year": 7,  "yield_per_m2_per_crop": 3.0,"nutrients_kg_m2_crop": 0.20},
-            "spinach":        {"plants_per_m2": 20,  "crops_per_year": 6,  "yield_per_m2_per_crop": 2.8,"nutrients_kg_m2_crop": 0.20},
-            "potato":         {"plants_per_m2": 4.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 6.0,"nutrients_kg_m2_crop": 0.55},
-            "fluted_pumpkin": {"plants_per_m2": 4.0, "crops_per_year": 4,  "yield_per_m2_per_crop": 2.0,"nutrients_kg_m2_crop": 0.22},
-            "basil":          {"plants_per_m2": 25,  "crops_per_year": 6,  "yield_per_m2_per_crop": 1.5,"nutrients_kg_m2_crop": 0.16},
-            "water_leaf":     {"plants_per_m2": 16,  "crops_per_year": 6,  "yield_per_m2_per_crop": 2.0,"nutrients_kg_m2_crop": 0.20},
-            "cannabis":       {"plants_per_m2": 6.0, "crops_per_year": 3,  "yield_per_m2_per_crop": 1.0,"nutrients_kg_m2_crop": 0.40},
-        },
-        "vertical": {
-            "tomato":         {"plants_per_m2": 4.5, "crops_per_year": 1,  "yield_per_m2_per_crop": 75, "nutrients_kg_m2_crop": 1.4},
-            "pepper":         {"plants_per_m2": 5.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 60, "nutrients_kg_m2_crop": 1.2},
-            "cucumber":       {"plants_per_m2": 3.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 85, "nutrients_kg_m2_crop": 1.3},
-            "strawberry":     {"plants_per_m2": 16,  "crops_per_year": 1,  "yield_per_m2_per_crop": 50, "nutrients_kg_m2_crop": 0.9},
-            "lettuce":        {"plants_per_m2": 60,  "crops_per_year": 9,  "yield_per_m2_per_crop": 3.0,"nutrients_kg_m2_crop": 0.35},
-            "spinach":        {"plants_per_m2": 60,  "crops_per_year": 8,  "yield_per_m2_per_crop": 2.8,"nutrients_kg_m2_crop": 0.35},
-            "potato":         {"plants_per_m2": 6.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 7.0,"nutrients_kg_m2_crop": 0.65},
-            "fluted_pumpkin": {"plants_per_m2": 8.0, "crops_per_year": 5,  "yield_per_m2_per_crop": 2.2,"nutrients_kg_m2_crop": 0.30},
-            "basil":          {"plants_per_m2": 70,  "crops_per_year": 7,  "yield_per_m2_per_crop": 1.6,"nutrients_kg_m2_crop": 0.24},
-            "water_leaf":     {"plants_per_m2": 40,  "crops_per_year": 7,  "yield_per_m2_per_crop": 2.2,"nutrients_kg_m2_crop": 0.30},
-            "cannabis":       {"plants_per_m2": 12,  "crops_per_year": 4,  "yield_per_m2_per_crop": 1.4,"nutrients_kg_m2_crop": 0.55},
-        },
-        "hydroponics": {
-            "tomato":         {"plants_per_m2": 2.7, "crops_per_year": 1,  "yield_per_m2_per_crop": 60, "nutrients_kg_m2_crop": 1.0},
-            "pepper":         {"plants_per_m2": 3.2, "crops_per_year": 1,  "yield_per_m2_per_crop": 50, "nutrients_kg_m2_crop": 0.95},
-            "cucumber":       {"plants_per_m2": 2.2, "crops_per_year": 1,  "yield_per_m2_per_crop": 70, "nutrients_kg_m2_crop": 0.95},
-            "strawberry":     {"plants_per_m2": 9.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 40, "nutrients_kg_m2_crop": 0.65},
-            "lettuce":        {"plants_per_m2": 24,  "crops_per_year": 8,  "yield_per_m2_per_crop": 3.2,"nutrients_kg_m2_crop": 0.22},
-            "spinach":        {"plants_per_m2": 24,  "crops_per_year": 7,  "yield_per_m2_per_crop": 3.0,"nutrients_kg_m2_crop": 0.22},
-            "potato":         {"plants_per_m2": 4.5, "crops_per_year": 1,  "yield_per_m2_per_crop": 6.5,"nutrients_kg_m2_crop": 0.60},
-            "fluted_pumpkin": {"plants_per_m2": 4.5, "crops_per_year": 4,  "yield_per_m2_per_crop": 2.1,"nutrients_kg_m2_crop": 0.24},
-            "basil":          {"plants_per_m2": 28,  "crops_per_year": 6,  "yield_per_m2_per_crop": 1.6,"nutrients_kg_m2_crop": 0.18},
-            "water_leaf":     {"plants_per_m2": 18,  "crops_per_year": 6,  "yield_per_m2_per_crop": 2.1,"nutrients_kg_m2_crop": 0.22},
-            "cannabis":       {"plants_per_m2": 7.0, "crops_per_year": 3,  "yield_per_m2_per_crop": 1.1,"nutrients_kg_m2_crop": 0.45},
-        },
-        "aeroponics": {
-            "tomato":         {"plants_per_m2": 2.8, "crops_per_year": 1,  "yield_per_m2_per_crop": 65, "nutrients_kg_m2_crop": 1.1},
-            "pepper":         {"plants_per_m2": 3.3, "crops_per_year": 1,  "yield_per_m2_per_crop": 52, "nutrients_kg_m2_crop": 1.0},
-            "cucumber":       {"plants_per_m2": 2.3, "crops_per_year": 1,  "yield_per_m2_per_crop": 72, "nutrients_kg_m2_crop": 1.0},
-            "strawberry":     {"plants_per_m2": 9.5, "crops_per_year": 1,  "yield_per_m2_per_crop": 42, "nutrients_kg_m2_crop": 0.70},
-            "lettuce":        {"plants_per_m2": 26,  "crops_per_year": 9,  "yield_per_m2_per_crop": 3.3,"nutrients_kg_m2_crop": 0.24},
-            "spinach":        {"plants_per_m2": 26,  "crops_per_year": 8,  "yield_per_m2_per_crop": 3.1,"nutrients_kg_m2_crop": 0.24},
-            "potato":         {"plants_per_m2": 4.8, "crops_per_year": 1,  "yield_per_m2_per_crop": 6.8,"nutrients_kg_m2_crop": 0.62},
-            "fluted_pumpkin": {"plants_per_m2": 4.8, "crops_per_year": 4,  "yield_per_m2_per_crop": 2.2,"nutrients_kg_m2_crop": 0.26},
-            "basil":          {"plants_per_m2": 30,  "crops_per_year": 6,  "yield_per_m2_per_crop": 1.7,"nutrients_kg_m2_crop": 0.19},
-            "water_leaf":     {"plants_per_m2": 20,  "crops_per_year": 6,  "yield_per_m2_per_crop": 2.2,"nutrients_kg_m2_crop": 0.24},
-            "cannabis":       {"plants_per_m2": 7.5, "crops_per_year": 3,  "yield_per_m2_per_crop": 1.2,"nutrients_kg_m2_crop": 0.48},
-        },
-    },
-    "NG": {
-        "soil": {
-            "tomato":         {"plants_per_m2": 2.0, "crops_per_year": 2,  "yield_per_m2_per_crop": 25, "nutrients_kg_m2_crop": 0.55},
-            "pepper":         {"plants_per_m2": 2.5, "crops_per_year": 2,  "yield_per_m2_per_crop": 22, "nutrients_kg_m2_crop": 0.50},
-            "cucumber":       {"plants_per_m2": 1.8, "crops_per_year": 2,  "yield_per_m2_per_crop": 28, "nutrients_kg_m2_crop": 0.50},
-            "strawberry":     {"plants_per_m2": 7.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 18, "nutrients_kg_m2_crop": 0.38},
-            "lettuce":        {"plants_per_m2": 16,  "crops_per_year": 6,  "yield_per_m2_per_crop": 2.4,"nutrients_kg_m2_crop": 0.16},
-            "spinach":        {"plants_per_m2": 16,  "crops_per_year": 6,  "yield_per_m2_per_crop": 2.3,"nutrients_kg_m2_crop": 0.16},
-            "potato":         {"plants_per_m2": 3.5, "crops_per_year": 1,  "yield_per_m2_per_crop": 4.5,"nutrients_kg_m2_crop": 0.40},
-            "fluted_pumpkin": {"plants_per_m2": 3.5, "crops_per_year": 4,  "yield_per_m2_per_crop": 1.8,"nutrients_kg_m2_crop": 0.20},
-            "basil":          {"plants_per_m2": 20,  "crops_per_year": 5,  "yield_per_m2_per_crop": 1.1,"nutrients_kg_m2_crop": 0.13},
-            "water_leaf":     {"plants_per_m2": 14,  "crops_per_year": 5,  "yield_per_m2_per_crop": 1.9,"nutrients_kg_m2_crop": 0.18},
-            "cannabis":       {"plants_per_m2": 5.0, "crops_per_year": 2,  "yield_per_m2_per_crop": 0.6,"nutrients_kg_m2_crop": 0.33},
-        }
-    },
-    "US": {
-        "soil": {
-            "tomato":         {"plants_per_m2": 2.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 32, "nutrients_kg_m2_crop": 0.60},
-            "pepper":         {"plants_per_m2": 2.5, "crops_per_year": 1,  "yield_per_m2_per_crop": 27, "nutrients_kg_m2_crop": 0.56},
-            "cucumber":       {"plants_per_m2": 1.8, "crops_per_year": 1,  "yield_per_m2_per_crop": 34, "nutrients_kg_m2_crop": 0.58},
-            "strawberry":     {"plants_per_m2": 7.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 22, "nutrients_kg_m2_crop": 0.42},
-            "lettuce":        {"plants_per_m2": 16,  "crops_per_year": 4,  "yield_per_m2_per_crop": 2.6,"nutrients_kg_m2_crop": 0.16},
-            "spinach":        {"plants_per_m2": 16,  "crops_per_year": 4,  "yield_per_m2_per_crop": 2.4,"nutrients_kg_m2_crop": 0.16},
-            "potato":         {"plants_per_m2": 3.5, "crops_per_year": 1,  "yield_per_m2_per_crop": 5.2,"nutrients_kg_m2_crop": 0.47},
-            "fluted_pumpkin": {"plants_per_m2": 3.5, "crops_per_year": 3,  "yield_per_m2_per_crop": 1.6,"nutrients_kg_m2_crop": 0.18},
-            "basil":          {"plants_per_m2": 20,  "crops_per_year": 4,  "yield_per_m2_per_crop": 1.3,"nutrients_kg_m2_crop": 0.13},
-            "water_leaf":     {"plants_per_m2": 14,  "crops_per_year": 4,  "yield_per_m2_per_crop": 1.8,"nutrients_kg_m2_crop": 0.17},
-            "cannabis":       {"plants_per_m2": 5.0, "crops_per_year": 3,  "yield_per_m2_per_crop": 0.8,"nutrients_kg_m2_crop": 0.40},
-        }
-    },
-}
+# before_request hooks that need no request; asgi.py runs them too.
+WORKER_HOOKS = []
 
 
-def get_crop_params(country_code, system_type, crop):
-    country_table = CROP_PARAMS.get(country_code) or CROP_PARAMS["GLOBAL"]
-    system_table = country_table.get(system_type)
-    if not system_table or crop not in system_table:
-        system_table = CROP_PARAMS["GLOBAL"].get(system_type, {})
-    params = system_table.get(crop)
-    if not params:
-        params = CROP_PARAMS["GLOBAL"]["soilless"]["tomato"]
-    return params
+def worker_hook(fn):
+    WORKER_HOOKS.append(fn)
+    return app.before_request(fn)
 
 
-# =====================
-#  ECONOMIC PARAMETERS
-# =====================
+# The JSON APIs never use the session: no cookie is read or written there.
+SESSIONLESS_PATH_PREFIXES = ("/api/",)
 
-SETUP_LEVEL_LABELS = {
-    "local":    "Local (low-tech, locally sourced materials)",
-    "standard": "Standard (commercial greenhouse technology)",
-    "hightech": "Hi-tech (fully automated indoor/CEA)",
-}
-
-PRODUCTION_COST_PER_M2_USD = {
-    "soil":        6.0,
-    "soilless":   10.0,
-    "vertical":   30.0,
-    "hydroponics":18.0,
-    "aeroponics": 22.0,
-}
-
-PRICE_PER_KG_USD = {
-    "GLOBAL": {
-        "tomato":         2.0,
-        "pepper":         2.5,
-        "cucumber":       2.0,
-        "strawberry":     5.0,
-        "lettuce":        3.0,
-        "spinach":        3.0,
-        "potato":         1.0,
-        "fluted_pumpkin": 2.0,
-        "basil":         12.0,
-        "water_leaf":     2.5,
-        "cannabis":    1500.0,
-    },
-    "US": {
-        "tomato":         2.5,
-        "pepper":         3.0,
-        "cucumber":       2.3,
-        "strawberry":     6.0,
-        "lettuce":        3.5,
-        "spinach":        3.5,
-        "potato":         1.2,
-        "fluted_pumpkin": 2.2,
-        "basil":         14.0,
-        "water_leaf":     2.7,
-        "cannabis":    1800.0,
-    },
-    "CA": {
-        "tomato":         2.7,
-        "pepper":         3.1,
-        "cucumber":       2.4,
-        "strawberry":     6.5,
-        "lettuce":        3.7,
-        "spinach":        3.7,
-        "potato":         1.3,
-        "fluted_pumpkin": 2.3,
-        "basil":         15.0,
-        "water_leaf":     2.8,
-        "cannabis":    1700.0,
-    },
-    "NG": {
-        "tomato":         1.4,
-        "pepper":         1.8,
-        "cucumber":       1.3,
-        "strawberry":     3.5,
-        "lettuce":        2.0,
-        "spinach":        2.0,
-        "potato":         0.7,
-        "fluted_pumpkin": 1.4,
-        "basil":          6.0,
-        "water_leaf":     1.5,
-        "cannabis":     900.0,
-    },
-}
-
-CAPEX_PER_M2_USD = {
-    "GLOBAL": {
-        "local":    80.0,
-        "standard": 150.0,
-        "hightech": 400.0,
-    },
-    "US": {
-        "local":    120.0,
-        "standard": 250.0,
-        "hightech": 750.0,
-    },
-    "CA": {
-        "local":    130.0,
-        "standard": 270.0,
-        "hightech": 780.0,
-    },
-    "NG": {
-        "local":    50.0,
-        "standard": 110.0,
-        "hightech": 250.0,
-    },
-}
-
-# FX rates: how many USD is 1 unit of currency
-FX_TO_USD = {
-    "USD": 1.0,
-    "EUR": 1.10,
-    "CAD": 0.75,
-    "NGN": 0.0008,
-    "TRY": 0.032,
-    "ANG": 0.56,
-    "GBP": 1.25,
-}
-
-
-def usd_to_currency(amount_usd, currency_code):
-    rate = FX_TO_USD.get(currency_code, 1.0)
-    if rate == 0:
-        return amount_usd
-    return amount_usd / rate
-
-
-def estimate_price_per_kg_usd(crop, country_code):
-    table = PRICE_PER_KG_USD.get(country_code, PRICE_PER_KG_USD["GLOBAL"])
-    return table.get(crop, PRICE_PER_KG_USD["GLOBAL"].get(crop, 2.0))
-
-
-def estimate_capex_per_m2_usd(setup_level, country_code):
-    table = CAPEX_PER_M2_USD.get(country_code, CAPEX_PER_M2_USD["GLOBAL"])
-    return table.get(setup_level, table.get("standard", 150.0))
-
-
-def current_price_unit_for_crop(crop):
-    if crop in {
-        "cannabis", "lettuce", "spinach", "basil", "water_leaf", "fluted_pumpkin"
-    }:
-        return "kg"
-
-
-# ================
-#  DB helper funcs
-# ================
-def get_db():
-    db = getattr(g, "_database", None)
-    if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
-    return db
 
+class TimedSessionInterface(SecureCookieSessionInterface):
+    def open_session(self, app, request):
+        if request.path.startswith(SESSIONLESS_PATH_PREFIXES):
+            return self.make_null_session(app)
+        started = time.perf_counter()
+        try:
+            return super().open_session(app, request)
+        finally:
+            g._session_open_seconds = time.perf_counter() - started
 
-@app.teardown_appcontext
-def close_connection(exception):
-    db = getattr(g, "_database", None)
-    if db is not None:
-        db.close()
+    def save_session(self, app, session, response):
+        with phase("session_save"):
+            return super().save_session(app, session, response)
 
 
-def init_db():
-    conn = get_db()
-    conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS calculations (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            created_at TEXT NOT NULL,
-            country_code TEXT,
-            currency_code TEXT,
-            crop TEXT,
-            system_type TEXT,
-            area_m2 REAL,
-            annual_yield REAL,
-            annual_revenue REAL,
-            annual_profit REAL
-        )
-        """
-    )
-    conn.commit()
+app.session_interface = TimedSessionInterface()
 
-def normalize_checkboxes(form_data, keys):
-    for k in keys:
-        form_data[k] = k in form_data
 
-# ==========================
-#  Country / currency lookup
-# ==========================
-def fetch_countries():
-    try:
-        url = "https://restcountries.com/v3.1/all?fields=name,currencies,cca2"
-        resp = requests.get(url, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
-    except Exception:
-        return [
-            {
-                "code": "US",
-                "name": "United States",
-                "currency_code": "USD",
-                "currency_symbol": "$",
-            }
-        ]
+@before_render_template.connect_via(app)
+def _render_started(sender, template, context, **extra):
+    g._render_started = time.perf_counter()
 
-    countries = []
-    for c in data:
-        name = c.get("name", {}).get("common", "Unknown")
-        cca2 = c.get("cca2", "")
-        currencies = c.get("currencies", {})
-        if currencies:
-            code = list(currencies.keys())[0]
-            symbol = currencies[code].get("symbol", code)
-        else:
-            code, symbol = "USD", "$"
-        countries.append(
-            {
-                "code": cca2,
-                "name": name,
-                "currency_code": code,
-                "currency_symbol": symbol,
-            }
-        )
 
-    countries.sort(key=lambda x: x["name"])
-    return countries
+@template_rendered.connect_via(app)
+def _render_finished(sender, template, context, **extra):
+    started = g.pop("_render_started", None)
+    if started is not None:
+        METRICS.observe(
+            "maro_phase_seconds",
+            (("route", route_label()), ("phase", "render_template")),
+            time.perf_counter() - started,
+        )
 
 
-COUNTRIES = fetch_countries()
+@app.before_request
+def _start_request_timer():
+    g._request_started = time.perf_counter()
+    opened = g.pop("_session_open_seconds", None)
+    if opened is not None:
+        METRICS.observe(
+            "maro_phase_seconds",
+            (("route", route_label()), ("phase", "session_open")),
+            opened,
+        )
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active in this process.
+            return
+        g._profiler = profiler
+
+
+@app.after_request
+def _remember_status(response):
+    g._response_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def _finish_request_timer(exception):
+    started = g.pop("_request_started", None)
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    route = route_label()
+    status = g.pop("_response_status", 500 if exception else 200)
+    METRICS.count_request((("route", route), ("method", request.method), ("status", status)))
+    METRICS.observe("maro_request_seconds", (("route", route),), seconds)
+
+    profiler = g.pop("_profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        SLOW_PROFILES.offer(profiler, route, request.method, request.full_path, seconds)
 
 
-def find_country(cca2):
-    for c in COUNTRIES:
-        if c["code"] == cca2:
-            return c
-    return None
+@app.teardown_appcontext
+def close_connection(exception):
+    # The connection outlives the request; just don't leak a transaction.
+    rollback_db()
 
 
-# =========================
-#  Auto economics defaults
-# =========================
-def fill_auto_economics_for_form(form_dict):
+def shutdown_worker():
     """
-    Fill in default annual_production_cost, price_per_unit, capex_per_m2
-    if user left them blank/0. Textboxes may be hidden; values are used
-    only for calculations.
+    Flush the write-behind queue and stop the process pool. Runs at exit
+    and from gunicorn's worker_exit/worker_abort hooks (gunicorn.conf.py).
+    Records still queued when a worker is killed outright (SIGKILL, OOM)
+    are lost; "sync" logging has no such window.
     """
-    try:
-        area = float(form_dict.get("area_m2", 0) or 0)
-    except ValueError:
-        area = 0
-
-    crop = form_dict.get("crop", "tomato")
-    system_type = form_dict.get("system_type", "soilless")
-    setup_level = form_dict.get("setup_level", "standard")
-    country_code = form_dict.get("country") or "US"
-
-    # Determine display currency
-    country = find_country(country_code)
-    base_curr = country["currency_code"] if country else "USD"
-    override = (form_dict.get("currency_override") or "").strip().upper()
-    display_curr = override or base_curr
-
-    # Production cost
-    raw_cost = (form_dict.get("annual_production_cost") or "").strip()
-    try:
-        cost_val = float(raw_cost) if raw_cost else 0
-    except ValueError:
-        cost_val = 0
-
-    if area > 0 and cost_val <= 0:
-        per_m2_usd = PRODUCTION_COST_PER_M2_USD.get(system_type, PRODUCTION_COST_PER_M2_USD["soilless"])
-        total_usd = per_m2_usd * area
-        form_dict["annual_production_cost"] = f"{usd_to_currency(total_usd, display_curr):.2f}"
+    storage.CALC_LOG_WRITER.close()
+    shutdown_process_pool()
 
-    # Price per unit
-    raw_price = (form_dict.get("price_per_unit") or "").strip()
-    try:
-        price_val = float(raw_price) if raw_price else 0
-    except ValueError:
-        price_val = 0
-
-    if price_val <= 0:
-        price_unit = current_price_unit_for_crop(crop)
-        price_usd_per_kg = estimate_price_per_kg_usd(crop, country_code)
-        price_local_per_kg = usd_to_currency(price_usd_per_kg, display_curr)
-        if price_unit == "g":
-            est_unit = price_local_per_kg / 1000.0
-        else:
-            est_unit = price_local_per_kg
-        form_dict["price_per_unit"] = f"{est_unit:.3f}"
 
-    # CAPEX per m²
-    raw_capex = (form_dict.get("capex_per_m2") or "").strip()
-    try:
-        capex_val = float(raw_capex) if raw_capex else 0
-    except ValueError:
-        capex_val = 0
+def normalize_checkboxes(form_data, keys):
+    for k in keys:
+        form_data[k] = k in form_data
 
-    if capex_val <= 0:
-        capex_usd = estimate_capex_per_m2_usd(setup_level, country_code)
-        form_dict["capex_per_m2"] = f"{usd_to_currency(capex_usd, display_curr):.0f}"
 
+@worker_hook
+def _check_params_file():
+    maybe_reload_params()
 
-# =====================
-#  Core calculation
-# =====================
-def compute_results(form):
-    # -------------------
-    # Basic inputs
-    # -------------------
-    try:
-        area = float(form.get("area_m2", 0) or 0)
-    except ValueError:
-        area = 0
-
-    if area <= 0:
-        return None, "Please fill in the greenhouse area."
-
-    crop = form.get("crop", "tomato")
-    system_type = form.get("system_type", "soilless")
-    setup_level = form.get("setup_level", "standard")
-    use_solar = form.get("use_solar") is True
-    country_code = form.get("country", "US")
-    currency_override = (form.get("currency_override") or "").strip().upper()
-
-    country = find_country(country_code)
-    base_currency_code = country["currency_code"] if country else "USD"
-    base_currency_symbol = country["currency_symbol"] if country else "$"
-
-    currency_code = currency_override or base_currency_code
-    currency_symbol = currency_override or base_currency_symbol
-
-    fx_rate = FX_TO_USD.get(currency_code, 1.0)
-
-    # -------------------
-    # Crop parameters
-    # -------------------
-    p = get_crop_params(country_code, system_type, crop)
-
-    plants_per_m2 = p["plants_per_m2"]
-    crops_per_year = p["crops_per_year"]
-    yield_per_m2_per_crop = p["yield_per_m2_per_crop"]
-    nutrient_per_m2_per_crop = p["nutrients_kg_m2_crop"]
-
-    plants = area * plants_per_m2
-    annual_yield = area * yield_per_m2_per_crop * crops_per_year
-
-    nutrient_per_crop_total = nutrient_per_m2_per_crop * area
-    annual_nutrient_total = nutrient_per_crop_total * crops_per_year
-    nutrient_per_plant_per_crop = (
-        nutrient_per_m2_per_crop / plants_per_m2 if plants_per_m2 > 0 else 0
-    )
 
-    # -------------------
-    # PRICE (INPUT IS LOCAL → CONVERT TO USD)
-    # -------------------
-    try:
-        price_per_kg_local = float(form.get("price_per_unit") or 0)
-    except ValueError:
-        price_per_kg_local = 0
+@worker_hook
+def _check_fx_rates():
+    start_fx_refresh()
+    maybe_reload_fx_rates()
 
-    price_per_kg_usd = price_per_kg_local * fx_rate
 
-    # -------------------
-    # PRODUCTION COST (LOCAL → USD)
-    # -------------------
-    try:
-        gross_cost_local = float(form.get("annual_production_cost") or 0)
-    except ValueError:
-        gross_cost_local = 0
+@worker_hook
+def _check_countries():
+    start_country_refresh()
+    maybe_reload_countries()
 
-    gross_cost_usd = gross_cost_local * fx_rate
-    solar_savings_usd = gross_cost_usd * SOLAR_SAVINGS_RATE if use_solar else 0
-    net_cost_usd = gross_cost_usd - solar_savings_usd
 
-    # -------------------
-    # CAPEX (LOCAL → USD)
-    # -------------------
-    try:
-        capex_per_m2_local = float(form.get("capex_per_m2") or 0)
-    except ValueError:
-        capex_per_m2_local = 0
-
-    capex_per_m2_usd = capex_per_m2_local * fx_rate
-    total_setup_cost_usd = capex_per_m2_usd * area
-
-    # -------------------
-    # CORE ECONOMICS (USD)
-    # -------------------
-    annual_revenue_usd = annual_yield * price_per_kg_usd
-    annual_profit_usd = annual_revenue_usd - net_cost_usd
-
-    cost_per_kg_usd = net_cost_usd / annual_yield if annual_yield > 0 else None
-    profit_per_kg_usd = annual_profit_usd / annual_yield if annual_yield > 0 else None
-
-    simple_payback_years = (
-        total_setup_cost_usd / annual_profit_usd
-        if annual_profit_usd > 0
-        else None
-    )
+@worker_hook
+def _start_job_runner():
+    if JOB_RUNNER_MODE == "web":
+        JOB_RUNNER.ensure_started()
 
-    # -------------------
-    # CONVERT BACK TO DISPLAY CURRENCY
-    # -------------------
-    annual_revenue = usd_to_currency(annual_revenue_usd, currency_code)
-    annual_profit = usd_to_currency(annual_profit_usd, currency_code)
-    net_production_cost = usd_to_currency(net_cost_usd, currency_code)
-    solar_savings = usd_to_currency(solar_savings_usd, currency_code)
-
-    cost_per_kg = (
-        usd_to_currency(cost_per_kg_usd, currency_code)
-        if cost_per_kg_usd is not None
-        else None
-    )
 
-    profit_per_kg = (
-        usd_to_currency(profit_per_kg_usd, currency_code)
-        if profit_per_kg_usd is not None
-        else None
+# =============
+#  CLI commands
+# =============
+@app.cli.command("export-params")
+@click.argument("path", required=False)
+def export_params_command(path):
+    """Write the parameter set in use to PARAMS_FILE (or PATH) for editing."""
+    save_params_file(current_params(), path)
+    print(f"Wrote parameters {parameters.PARAMS.version} to {path or PARAMS_FILE}")
+
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create or upgrade the database schema."""
+    conn = open_db()
+    conn.close()
+    print(f"Schema ready in {storage.DATABASE}")
+
+
+@app.cli.command("rebuild-rollups")
+def rebuild_rollups_command():
+    """Rebuild the analytics rollups from the calculations table."""
+    conn = open_db()
+    groups = rebuild_rollups(conn)
+    conn.close()
+    print(f"Rebuilt {groups} rollup rows")
+
+
+@app.cli.command("run-jobs")
+@click.option("--once", is_flag=True, help="Exit when no job is left instead of polling.")
+def run_jobs_command(once):
+    """Run queued and abandoned batch jobs in the foreground."""
+    runner = JobRunner()
+    conn = open_db()
+    while True:
+        ran = runner.run_pending(conn)
+        if ran:
+            print(f"Ran {ran} job(s)")
+        if once:
+            break
+        time.sleep(JOB_POLL_INTERVAL)
+    conn.close()
+
+
+@app.cli.command("reevaluate-history")
+@click.option("--chunk-size", default=REEVALUATE_CHUNK_SIZE, show_default=True)
+@click.option("--workers", default=REEVALUATE_WORKERS, show_default=True)
+@click.option("--restart", is_flag=True, help="Discard this version's progress first.")
+def reevaluate_history_command(chunk_size, workers, restart):
+    """Recompute stored history under the current parameter tables."""
+    conn = open_db()
+    started = time.perf_counter()
+
+    def progress(hi, max_id, count):
+        print(f"  ... id {hi}/{max_id} (+{count} rows)")
+
+    state = reevaluate_history(conn, chunk_size, workers, restart, progress)
+    report = reevaluation_report(conn, state["params_version"])
+    conn.close()
+    print(
+        f"Re-evaluated history up to id {state['last_id']} under params "
+        f"{state['params_version']} in {time.perf_counter() - started:.1f}s"
     )
+    print(json.dumps(report["groups"], indent=1))
 
-    total_setup_cost = usd_to_currency(total_setup_cost_usd, currency_code)
-
-    setup_label = SETUP_LEVEL_LABELS.get(setup_level, setup_level)
-
-    # -------------------
-    # FINAL RESULTS DICT
-    # -------------------
-    results = {
-        "currency_code": currency_code,
-        "currency_symbol": currency_symbol,
-        "country_code": country_code,
-
-        "area": area,
-        "crop": crop,
-        "system_type": system_type,
-        "setup_level": setup_level,
-        "setup_label": setup_label,
-        "use_solar": use_solar,
-
-        "plants_per_m2": plants_per_m2,
-        "crops_per_year": crops_per_year,
-        "yield_per_m2_per_crop": yield_per_m2_per_crop,
-        "plants": plants,
-        "annual_yield": annual_yield,
-
-        "nutrient_per_m2_per_crop": nutrient_per_m2_per_crop,
-        "nutrient_per_crop_total": nutrient_per_crop_total,
-        "annual_nutrient_total": annual_nutrient_total,
-        "nutrient_per_plant_per_crop": nutrient_per_plant_per_crop,
-
-        "gross_production_cost": usd_to_currency(gross_cost_usd, currency_code),
-        "solar_savings": solar_savings,
-        "net_production_cost": net_production_cost,
-
-        "price_per_kg": usd_to_currency(price_per_kg_usd, currency_code),
-
-        "annual_revenue": annual_revenue,
-        "annual_profit": annual_profit,
 
-        "cost_per_kg": cost_per_kg,
-        "profit_per_kg": profit_per_kg,
-
-        "cost_per_m2_per_year": net_production_cost / area if area > 0 else 0,
-        "profit_per_m2_per_year": annual_profit / area if area > 0 else 0,
-
-        "cost_per_plant_per_year": net_production_cost / plants if plants > 0 else 0,
-        "profit_per_plant_per_year": annual_profit / plants if plants > 0 else 0,
-
-        "revenue_per_m2_per_year": annual_revenue / area if area > 0 else 0,
-        "revenue_per_plant_per_year": annual_revenue / plants if plants > 0 else 0,
-
-        "capex_per_m2": usd_to_currency(capex_per_m2_usd, currency_code),
-        "total_setup_cost": total_setup_cost,
-        "simple_payback_years": simple_payback_years,
-
-        "SOLAR_SAVINGS_RATE": SOLAR_SAVINGS_RATE,
-    }
-
-    return results, None
-
-# =============
-#  Routes
-# =============
-@app.route("/", methods=["GET", "POST"])
-def index():
-    init_db()
+# =====================
+#  Index page cache
+# =====================
+# (version, [(code, option, option marked selected)])
+_country_options_cache = (None, [])
+# (versions, body, etag, last_modified)
+_index_page_cache = (None, None, None, None)
 
-    default_country = COUNTRIES[0]["code"] if COUNTRIES else "US"
 
-    form_defaults = {
+def index_form_defaults(countries):
+    default_country = countries[0]["code"] if countries else "US"
+    return {
         "area_m2": "2000",
         "system_type": "soil",
         "crop": "tomato",
@@ -627,11 +283,67 @@ def index():
         "use_custom_capex": False,
     }
 
-    error = None
-    if request.method == "POST":
-     form_data = {**form_defaults, **request.form.to_dict()}
 
-     normalize_checkboxes(
+def country_options_html(selected=None):
+    """The country <option> list with `selected` marked, as Markup."""
+    global _country_options_cache
+    version, options = _country_options_cache
+    if version != parameters.COUNTRY_SNAPSHOT.version:
+        snapshot = parameters.COUNTRY_SNAPSHOT
+        options = [
+            (
+                c["code"],
+                render_template("_country_options.html", countries=[c], selected=None),
+                render_template("_country_options.html", countries=[c], selected=c["code"]),
+            )
+            for c in snapshot.countries
+        ]
+        _country_options_cache = (snapshot.version, options)
+    return Markup("".join(
+        marked if code == selected else plain for code, plain, marked in options
+    ))
+
+
+def cached_index_response():
+    """GET / with the default form, rendered once per set of data versions."""
+    global _index_page_cache
+    param_set = parameters.PARAMS
+    versions = (param_set.version, param_set.fx.version, parameters.COUNTRY_SNAPSHOT.version)
+    cached_versions, body, etag, last_modified = _index_page_cache
+    if cached_versions != versions:
+        form = index_form_defaults(get_countries())
+        fill_auto_economics_for_form(form, param_set)
+        body = render_template(
+            "index.html",
+            country_options=country_options_html(form["country"]),
+            form=form,
+            error=None,
+        )
+        etag = hashlib.sha1(body.encode("utf-8")).hexdigest()[:16]
+        last_modified = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        _index_page_cache = (versions, body, etag, last_modified)
+
+    response = Response(body, mimetype="text/html")
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+# =============
+#  Routes
+# =============
+@app.route("/", methods=["GET", "POST"])
+def index():
+    if request.method == "GET":
+        return cached_index_response()
+
+    countries = get_countries()
+    form_defaults = index_form_defaults(countries)
+
+    form_data = {**form_defaults, **request.form.to_dict()}
+
+    normalize_checkboxes(
         form_data,
         [
             "use_custom_production_cost",
@@ -641,191 +353,485 @@ def index():
         ],
     )
 
-     if not form_data["use_custom_production_cost"]:
+    if not form_data["use_custom_production_cost"]:
         form_data["annual_production_cost"] = ""
 
-     if not form_data["use_custom_price"]:
+    if not form_data["use_custom_price"]:
         form_data["price_per_unit"] = ""
 
-     if not form_data["use_custom_capex"]:
+    if not form_data["use_custom_capex"]:
         form_data["capex_per_m2"] = ""
 
-     fill_auto_economics_for_form(form_data)
-     results, error = compute_results(form_data)
-
-     if results and not error:
-        session["last_form"] = form_data
-        session["last_results"] = results
-
-        conn = get_db()
-        conn.execute(
-            """
-            INSERT INTO calculations (
-                created_at,
-                country_code,
-                currency_code,
-                crop,
-                system_type,
-                area_m2,
-                annual_yield,
-                annual_revenue,
-                annual_profit
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                datetime.datetime.utcnow().isoformat(),
-                results["country_code"],
-                results["currency_code"],
-                results["crop"],
-                results["system_type"],
-                results["area"],
-                results["annual_yield"],
-                results["annual_revenue"],
-                results["annual_profit"],
-            ),
-        )
-        conn.commit()
-        return redirect(url_for("results_page"))
+    result_id, results, error = calculate_and_store(form_data)
 
-         # ✅ THIS LINE MUST BE HERE
-     form_defaults.update(form_data)
+    if results and not error:
+        # The cookie only carries the id; the result lives in the database.
+        session.pop("last_form", None)
+        session.pop("last_results", None)
+        session["last_result_id"] = result_id
 
-    else:
-     fill_auto_economics_for_form(form_defaults)
+        log_calculation(results, form_data, result_id)
+        return redirect(url_for("result_permalink", result_id=result_id))
+
+    form_defaults.update(form_data)
 
     return render_template(
     "index.html",
-    countries=COUNTRIES,
+    country_options=country_options_html(form_defaults["country"]),
     form=form_defaults,
     error=error,
 )
 
+
 @app.route("/results")
 def results_page():
-    init_db()
-    results = session.get("last_results")
-    form = session.get("last_form")
-
-    if not results or not form:
+    result_id = session.get("last_result_id")
+    if not result_id:
         return redirect(url_for("index"))
+    return redirect(url_for("result_permalink", result_id=result_id))
 
+
+@app.route("/r/<result_id>")
+def result_permalink(result_id):
     conn = get_db()
-    cur = conn.execute(
-        """
-        SELECT id, created_at, country_code, currency_code, crop,
-               system_type, area_m2, annual_yield, annual_profit
-        FROM calculations
-        ORDER BY id DESC
-        LIMIT 10
-        """
-    )
-    history = cur.fetchall()
+    stored = load_result(conn, result_id)
+    if stored is None:
+        return render_template("results.html", missing=True), 404
 
     return render_template(
         "results.html",
-        results=results,
-        form=form,
-        history=history,
+        results=stored.results,
+        form=stored.form,
+        result_id=stored.id,
+        params_version=stored.params_version,
+        history=recent_calculations(conn),
     )
 
+
 @app.route("/admin/history")
 def admin_history_page():
-    init_db()
-
     conn = get_db()
-    cur = conn.execute(
-        """
-        SELECT id,
-               created_at,
-               country_code,
-               currency_code,
-               crop,
-               system_type,
-               area_m2,
-               annual_yield,
-               annual_revenue,
-               annual_profit
-        FROM calculations
-        ORDER BY id DESC
-        LIMIT 50
-        """
-    )
-    history = cur.fetchall()
+    filters = {
+        key: request.args.get(key, "").strip()
+        for key in ("crop", "country", "system", "date_from", "date_to")
+    }
+    try:
+        history, older, newer = history_page(conn, request.args)
+        error = None
+    except ValueError as exc:
+        history, older, newer, error = [], None, None, str(exc)
 
+    active = {key: value for key, value in filters.items() if value}
     return render_template(
         "admin_history.html",
         history=history,
+        filters=filters,
+        active_filters=active,
+        older_url=url_for("admin_history_page", before=older, **active) if older else None,
+        newer_url=url_for("admin_history_page", after=newer, **active) if newer else None,
+        error=error,
     )
 
+
 @app.route("/admin/history/download")
 def admin_history_download():
-    init_db()
+    try:
+        where, params = history_filters(request.args)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+
+    compress = request.args.get("gzip") in ("1", "true", "yes")
+    body = iter_history_csv(where, params)
+    filename = "maro_history.csv"
+    mimetype = "text/csv"
+    if compress:
+        body = gzip_stream(body)
+        filename += ".gz"
+        mimetype = "application/gzip"
+
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition": f"attachment; filename={filename}"
+        },
+    )
+
+
+def _analytics_request():
+    group_by = [
+        dim.strip()
+        for dim in (request.args.get("group_by") or "day").split(",")
+        if dim.strip()
+    ]
+    unknown = [dim for dim in group_by if dim not in ROLLUP_DIMENSIONS]
+    if unknown or not group_by:
+        raise ValueError(f"group_by must use: {', '.join(ROLLUP_DIMENSIONS)}")
     conn = get_db()
+    catch_up_rollups(conn)
+    rows = analytics_summary(
+        conn,
+        group_by,
+        date_from=request.args.get("date_from") or None,
+        date_to=request.args.get("date_to") or None,
+        currency=(request.args.get("currency") or "").strip().upper() or None,
+    )
+    return group_by, rows
+
 
-    cur = conn.execute(
-        """
-        SELECT created_at,
-               country_code,
-               currency_code,
-               crop,
-               system_type,
-               area_m2,
-               annual_yield,
-               annual_revenue,
-               annual_profit
-        FROM calculations
-        ORDER BY id DESC
-        """
+@app.route("/admin/analytics")
+def admin_analytics_page():
+    try:
+        group_by, rows = _analytics_request()
+        error = None
+    except ValueError as exc:
+        group_by, rows, error = [], [], str(exc)
+    return render_template(
+        "admin_analytics.html",
+        group_by=group_by,
+        dimensions=ROLLUP_DIMENSIONS,
+        rows=rows,
+        error=error,
     )
-    rows = cur.fetchall()
-
-    output = StringIO()
-    writer = csv.writer(output)
-
-    writer.writerow([
-        "Date (UTC)",
-        "Country",
-        "Currency",
-        "Crop",
-        "System",
-        "Area (m2)",
-        "Annual Yield (kg)",
-        "Annual Revenue",
-        "Annual Profit",
-    ])
-
-    for r in rows:
-        writer.writerow([
-            r["created_at"],
-            r["country_code"],
-            r["currency_code"],
-            r["crop"],
-            r["system_type"],
-            f"{r['area_m2']:.0f}",
-            f"{r['annual_yield']:.0f}",
-            f"{r['annual_revenue']:.2f}",
-            f"{r['annual_profit']:.2f}",
-        ])
-
-    output.seek(0)
+
+
+@app.route("/admin/analytics.json")
+def admin_analytics_json():
+    try:
+        group_by, rows = _analytics_request()
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    return jsonify({"group_by": group_by, "rows": rows})
+
+
+@app.route("/admin/history/download.npz")
+def admin_history_download_npz():
+    try:
+        where, params = history_filters(request.args)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+
+    fd, path = tempfile.mkstemp(prefix="maro-history-", suffix=".npz")
+    os.close(fd)
+    try:
+        export_history_npz(path, where, params)
+    except Exception:
+        os.remove(path)
+        raise
 
     return Response(
-        output.getvalue(),
-        mimetype="text/csv",
+        stream_file_and_remove(path),
+        mimetype="application/octet-stream",
         headers={
-            "Content-Disposition": "attachment; filename=maro_history.csv"
+            "Content-Disposition": "attachment; filename=maro_history.npz",
+            "Content-Length": str(os.path.getsize(path)),
         },
     )
 
+
 @app.route("/admin/history/reset", methods=["POST"])
 def admin_history_reset():
-    init_db()
-    conn = get_db()
-    conn.execute("DELETE FROM calculations")
-    conn.commit()
-
+    reset_history(get_db())
     return redirect(url_for("admin_history_page"))
 
+
+@app.route("/api/sweep", methods=["POST"])
+def api_sweep():
+    params = request.get_json(silent=True) or {}
+    if not isinstance(params, dict):
+        return jsonify({"error": "expected a JSON object"}), 400
+    try:
+        grid = plan_sweep(
+            area=params.get("area", 2000),
+            crops=params.get("crops"),
+            system_types=params.get("system_types"),
+            setup_levels=params.get("setup_levels"),
+            country=params.get("country", "US"),
+            currency_override=params.get("currency_override", ""),
+            use_solar=params.get("use_solar", False),
+            metric=params.get("metric", "profit"),
+            top_n=params.get("top_n", 20),
+        )
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+
+    def generate():
+        for row in iter_sweep(grid):
+            yield json.dumps(row) + "\n"
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+@app.route("/api/risk", methods=["POST"])
+def api_risk():
+    params = request.get_json(silent=True) or {}
+    if not isinstance(params, dict):
+        return jsonify({"error": "expected a JSON object"}), 400
+    scenarios = params.get("scenarios")
+    if scenarios is None:
+        scenarios = [params.get("scenario") or {}]
+    try:
+        report = run_risk(
+            scenarios,
+            draws=params.get("draws", RISK_DEFAULT_DRAWS),
+            seed=params.get("seed"),
+            uncertainty=params.get("uncertainty"),
+        )
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    return jsonify(report)
+
+
+@app.route("/api/projection", methods=["POST"])
+def api_projection():
+    params = request.get_json(silent=True) or {}
+    if not isinstance(params, dict):
+        return jsonify({"error": "expected a JSON object"}), 400
+    scenarios = params.get("scenarios")
+    if scenarios is None:
+        scenarios = [params.get("scenario") or {}]
+    try:
+        report = run_projection(
+            scenarios,
+            options={k: params[k] for k in PROJECTION_DEFAULTS if k in params},
+            detail=params.get("detail"),
+        )
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    return jsonify(report)
+
+
+@app.route("/api/optimize", methods=["POST"])
+def api_optimize():
+    try:
+        report = optimize_allocation(request.get_json(silent=True) or {})
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    return jsonify(report)
+
+
+@app.route("/api/v1/calculate", methods=["POST"])
+def api_v1_calculate():
+    scenario = request.get_json(silent=True)
+    if not isinstance(scenario, dict):
+        return jsonify({"error": "expected a JSON object with form fields"}), 400
+    form = scenario_form(scenario)
+    results, error = calculate(form)
+    if error:
+        return jsonify({"error": error}), 400
+    if api_log_requested(request.args):
+        log_calculation(results, form)
+    return Response(dumps_json(results), mimetype="application/json")
+
+
+@app.route("/api/v1/calculate.ndjson", methods=["POST"])
+def api_v1_calculate_ndjson():
+    # Read up front, or a client that sends everything first deadlocks.
+    lines = request.get_data().splitlines()
+    if len(lines) > API_STREAM_MAX_SCENARIOS:
+        return jsonify({"error": f"at most {API_STREAM_MAX_SCENARIOS} scenarios per request"}), 400
+    log = api_log_requested(request.args)
+    return Response(
+        stream_with_context(iter_calculate_stream(lines, log)),
+        mimetype="application/x-ndjson",
+    )
+
+
+@app.route("/api/v1/results/<result_id>/whatif", methods=["POST"])
+def api_v1_whatif(result_id):
+    spec = request.get_json(silent=True)
+    if spec is None:
+        spec = {}
+    if not isinstance(spec, dict):
+        return jsonify({"error": "expected a JSON object"}), 400
+    found = whatif_base(get_db(), result_id)
+    if found is None:
+        return jsonify({"error": "no such result"}), 404
+    form, base = found
+    try:
+        result, results, error = whatif(
+            form, base, spec.get("changes"), spec.get("scale"), spec.get("fields")
+        )
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    if error:
+        return jsonify({"error": error}), 400
+    fields_by_input = {name: field for field, name in RESULT_INPUTS.items()}
+    return Response(
+        dumps_json({
+            "result_id": result_id,
+            "params_version": result.param_set.version,
+            "changed": [fields_by_input[name] for name in result.changed],
+            "recomputed": result.evaluated,
+            "results": results,
+        }),
+        mimetype="application/json",
+    )
+
+
+@app.route("/api/jobs", methods=["POST"])
+def api_jobs_create():
+    upload = request.files.get("file")
+    try:
+        if upload is not None:
+            fmt = job_format_for(upload.filename, upload.mimetype, request.args.get("format"))
+        else:
+            if not request.content_length:
+                raise ValueError("upload a CSV or NDJSON file as 'file' or as the request body")
+            fmt = job_format_for(None, request.content_type, request.args.get("format"))
+            upload = request.stream
+        if (request.content_length or 0) > jobs.JOB_MAX_UPLOAD_BYTES:
+            raise JobUploadTooLarge(f"uploads are limited to {jobs.JOB_MAX_UPLOAD_BYTES} bytes")
+        job_id = create_job(get_db(), upload, fmt)
+    except JobUploadTooLarge as exc:
+        return jsonify({"error": str(exc)}), 413
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+
+    JOB_RUNNER.wake()
+    status_url = url_for("api_jobs_status", job_id=job_id)
+    return (
+        jsonify({
+            "id": job_id,
+            "status": "queued",
+            "status_url": status_url,
+            "results_url": url_for("api_jobs_results", job_id=job_id),
+        }),
+        202,
+        {"Location": status_url},
+    )
+
+
+@app.route("/api/jobs/<job_id>")
+def api_jobs_status(job_id):
+    status = job_status(get_db(), job_id)
+    if status is None:
+        return jsonify({"error": "no such job"}), 404
+    return jsonify(status)
+
+
+@app.route("/api/jobs/<job_id>/results")
+def api_jobs_results(job_id):
+    status = job_status(get_db(), job_id)
+    if status is None:
+        return jsonify({"error": "no such job"}), 404
+    if status["status"] != "done":
+        return jsonify({"error": f"job is {status['status']}", **status}), 409
+    size = sum(
+        os.path.getsize(job_chunk_path(job_id, chunk)) for chunk in range(status["chunks"])
+    )
+    return Response(
+        iter_job_results(job_id, status["chunks"]),
+        mimetype="application/x-ndjson",
+        headers={
+            "Content-Disposition": f"attachment; filename=maro_job_{job_id}.ndjson",
+            "Content-Length": str(size),
+        },
+    )
+
+
+@app.route("/api/jobs/<job_id>", methods=["DELETE"])
+def api_jobs_delete(job_id):
+    if not delete_job(get_db(), job_id):
+        return jsonify({"error": "no such job"}), 404
+    return jsonify({"id": job_id, "deleted": True})
+
+
+@app.route("/admin/params")
+def admin_params():
+    param_set = parameters.PARAMS
+    return jsonify(
+        {
+            "version": param_set.version,
+            "source": param_set.source,
+            "loaded_at": param_set.loaded_at,
+            **param_fallback_report(param_set),
+        }
+    )
+
+
+@app.route("/admin/params/reload", methods=["POST"])
+def admin_params_reload():
+    changed = maybe_reload_params(force=True)
+    param_set = parameters.PARAMS
+    return jsonify({"changed": changed, "version": param_set.version, "source": param_set.source})
+
+
+@app.route("/admin/cache")
+def admin_cache():
+    return jsonify({**RESULT_CACHE.stats(), "params_version": parameters.PARAMS.version})
+
+
+@app.route("/admin/calc-log")
+def admin_calc_log():
+    return jsonify(storage.CALC_LOG_WRITER.stats())
+
+
+@app.route("/admin/metrics")
+def admin_metrics():
+    cache = RESULT_CACHE.stats()
+    calc_log = storage.CALC_LOG_WRITER.stats()
+    extra = [
+        ("maro_result_cache_hits_total", "counter", "Result cache hits.", cache["hits"]),
+        ("maro_result_cache_misses_total", "counter", "Result cache misses.", cache["misses"]),
+        ("maro_result_cache_size", "gauge", "Entries in the result cache.", cache["size"]),
+        ("maro_calc_log_queue_depth", "gauge", "Queued calculation log records.", calc_log["queue_depth"]),
+        ("maro_calc_log_dropped_total", "counter", "Calculation log records dropped.", calc_log["dropped"]),
+    ]
+    return Response(METRICS.render(extra), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/admin/profiles")
+def admin_profiles():
+    return jsonify(
+        {"sample_rate": PROFILE_SAMPLE_RATE, "profiles": SLOW_PROFILES.slowest()}
+    )
+
+
+@app.route("/admin/countries")
+def admin_countries():
+    snapshot = parameters.COUNTRY_SNAPSHOT
+    return jsonify({
+        "countries": len(snapshot.countries),
+        "fetched_at": snapshot.fetched_at,
+        "version": snapshot.version,
+        "import_seconds": APP_IMPORT_SECONDS,
+    })
+
+
+@app.route("/admin/countries/refresh", methods=["POST"])
+def admin_countries_refresh():
+    refresh_countries_in_background()
+    return jsonify({"status": "refresh started", "version": parameters.COUNTRY_SNAPSHOT.version}), 202
+
+
+@app.route("/admin/fx")
+def admin_fx():
+    param_set = parameters.PARAMS
+    table = param_set.fx
+    country_currencies = {c["currency_code"] for c in get_countries() if c.get("currency_code")}
+    return jsonify({
+        "version": table.version,
+        "source": table.source,
+        "fetched_at": table.fetched_at,
+        "currencies": len(table.codes),
+        "missing_for_countries": sorted(country_currencies - set(table.index)),
+        "unknown_requested": dict(FX_UNKNOWN_CURRENCIES),
+        "refresh_url": FX_RATES_URL,
+        "params_version": param_set.version,
+    })
+
+
+@app.route("/admin/fx/refresh", methods=["POST"])
+def admin_fx_refresh():
+    if not FX_RATES_URL:
+        return jsonify({"error": "MARO_FX_RATES_URL is not set"}), 400
+    refresh_fx_rates_in_background()
+    return jsonify({"status": "refresh started", "version": parameters.PARAMS.fx.version}), 202
+
+
+# Cold-start cost of importing this module, reported by /admin/countries.
+APP_IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
+
 if __name__ == "__main__":
-    app.run(debug=False)
\ No newline at end of file
+    app.run(debug=False)
@@ -0,0 +1,384 @@
+"""
+ASGI entry point for high-concurrency API traffic.
+
+    uvicorn asgi:app --workers 4
+
+POST /api/v1/calculate and /api/v1/calculate.ndjson are dispatched on the
+event loop, but nothing that computes or blocks runs on it: calculations,
+the worker hooks (data file checks, refresh threads) and SQLite writes
+(calculation logging) run in a bounded thread pool, and stream chunks
+larger than ASGI_INLINE_ROWS are computed in a process pool. Every other
+route is the Flask app, run in a second thread pool with the request body
+streamed to it, so pages, uploads, history exports and admin views behave
+exactly as under gunicorn, and slow clients of those pages cannot hold up
+the API.
+"""
+import asyncio
+import contextvars
+import functools
+import io
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import app as maro
+import engine
+import jobs
+import metrics
+import parameters
+import storage
+
+ASGI_THREADS = int(os.environ.get("MARO_ASGI_THREADS", "32"))
+# Threads running the Flask app. A WSGI thread is held for as long as its
+# client takes to send the request and read the response.
+ASGI_WSGI_THREADS = int(os.environ.get("MARO_ASGI_WSGI_THREADS", "16"))
+# Stream chunks up to this many scenarios are computed in the thread pool;
+# shipping them to a process costs more than computing them.
+ASGI_INLINE_ROWS = int(os.environ.get("MARO_ASGI_INLINE_ROWS", "256"))
+# Chunks of one stream computed ahead of the one being sent.
+ASGI_PIPELINE_DEPTH = int(os.environ.get("MARO_ASGI_PIPELINE_DEPTH", "4"))
+# Response chunks buffered between a Flask thread and the loop.
+ASGI_WSGI_BUFFER = 16
+# Largest body the API routes read into memory. Bodies of other routes
+# are streamed to Flask, whose upload routes enforce their own limits.
+ASGI_MAX_BODY = int(os.environ.get("MARO_ASGI_MAX_BODY", str(512 * 1024 * 1024)))
+
+JSON_HEADERS = [(b"content-type", b"application/json")]
+NDJSON_HEADERS = [(b"content-type", b"application/x-ndjson")]
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+def _calculate_chunk(chunk, log, versions):
+    # Runs in a pool process.
+    parameters.ensure_params_version(versions)
+    return jobs.calculate_ndjson_chunk(chunk, log)
+
+
+def _run_worker_hooks():
+    for hook in maro.WORKER_HOOKS:
+        hook()
+
+
+def _log_calculations(records):
+    # log_calculations needs an app context for get_db().
+    with maro.app.app_context():
+        storage.log_calculations(records)
+
+
+class MaroASGI:
+    def __init__(self, wsgi_app, threads=ASGI_THREADS, wsgi_threads=ASGI_WSGI_THREADS):
+        self.wsgi_app = wsgi_app
+        self.threads = threads
+        self.wsgi_threads = wsgi_threads
+        self._thread_pool = self._wsgi_pool = None
+        self._lock = threading.Lock()
+        self.routes = {
+            "/api/v1/calculate": ("api_v1_calculate", self.calculate),
+            "/api/v1/calculate.ndjson": ("api_v1_calculate_ndjson", self.calculate_ndjson),
+        }
+
+    # ---- pools ----
+
+    @property
+    def thread_pool(self):
+        with self._lock:
+            if self._thread_pool is None:
+                self._thread_pool = ThreadPoolExecutor(
+                    max_workers=self.threads, thread_name_prefix="asgi-io"
+                )
+            return self._thread_pool
+
+    @property
+    def wsgi_pool(self):
+        with self._lock:
+            if self._wsgi_pool is None:
+                self._wsgi_pool = ThreadPoolExecutor(
+                    max_workers=self.wsgi_threads, thread_name_prefix="asgi-wsgi"
+                )
+            return self._wsgi_pool
+
+    def shutdown(self):
+        with self._lock:
+            pools = self._thread_pool, self._wsgi_pool
+            self._thread_pool = self._wsgi_pool = None
+        for pool in pools:
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+        engine.shutdown_process_pool()
+
+    def run_blocking(self, fn, *args):
+        # Copies the context so phase() metrics carry the route label.
+        call = functools.partial(contextvars.copy_context().run, fn, *args)
+        return asyncio.get_running_loop().run_in_executor(self.thread_pool, call)
+
+    # ---- dispatch ----
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        route = self.routes.get(scope["path"]) if scope["method"] == "POST" else None
+        if route is None:
+            await self.call_wsgi(scope, receive, send)
+            return
+
+        name, handler = route
+        started = time.perf_counter()
+        metrics.METRICS_ROUTE.set(name)
+        await self.run_blocking(_run_worker_hooks)
+        try:
+            body = await read_body(receive)
+        except BodyTooLarge:
+            status = await send_json(send, 413, {"error": "request body too large"})
+        else:
+            status = await handler(scope, body, send)
+        seconds = time.perf_counter() - started
+        metrics.METRICS.count_request((("route", name), ("method", "POST"), ("status", status)))
+        metrics.METRICS.observe("maro_request_seconds", (("route", name),), seconds)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.run_blocking(storage.CALC_LOG_WRITER.close)
+                self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    # ---- calculation API ----
+
+    async def calculate(self, scope, body, send):
+        try:
+            scenario = jobs.loads_json(body)
+        except ValueError:
+            scenario = None
+        if not isinstance(scenario, dict):
+            return await send_json(send, 400, {"error": "expected a JSON object with form fields"})
+        form = engine.scenario_form(scenario)
+        results, error = await self.run_blocking(engine.calculate, form)
+        if error:
+            return await send_json(send, 400, {"error": error})
+        if jobs.api_log_requested(query_args(scope)):
+            await self.run_blocking(
+                _log_calculations, [storage.calculation_record(results, form)]
+            )
+        return await send_json(send, 200, results)
+
+    async def calculate_ndjson(self, scope, body, send):
+        lines = body.splitlines()
+        if len(lines) > jobs.API_STREAM_MAX_SCENARIOS:
+            return await send_json(
+                send, 400,
+                {"error": f"at most {jobs.API_STREAM_MAX_SCENARIOS} scenarios per request"},
+            )
+        log = jobs.api_log_requested(query_args(scope))
+        loop = asyncio.get_running_loop()
+
+        def start(chunk):
+            if len(chunk) <= ASGI_INLINE_ROWS:
+                return self.run_blocking(jobs.calculate_ndjson_chunk, chunk, log)
+            return loop.run_in_executor(
+                engine.process_pool(), _calculate_chunk, chunk, log, parameters.params_versions()
+            )
+
+        await send({"type": "http.response.start", "status": 200, "headers": NDJSON_HEADERS})
+        pending = deque()
+        chunks = jobs.chunk_scenario_lines(lines)
+        try:
+            for chunk in chunks:
+                pending.append(start(chunk))
+                if len(pending) >= ASGI_PIPELINE_DEPTH:
+                    await self._send_chunk(send, await pending.popleft())
+            while pending:
+                await self._send_chunk(send, await pending.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
+        await send({"type": "http.response.body", "body": b""})
+        return 200
+
+    async def _send_chunk(self, send, computed):
+        payload, records, _ = computed
+        if records:
+            await self.run_blocking(_log_calculations, records)
+        await send({"type": "http.response.body", "body": payload, "more_body": True})
+
+    # ---- everything else: the Flask app in a thread ----
+
+    async def call_wsgi(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        environ = wsgi_environ(scope, ReceiveStream(receive, loop))
+        messages = asyncio.Queue(maxsize=ASGI_WSGI_BUFFER)
+        abandoned = threading.Event()
+
+        def put(message):
+            asyncio.run_coroutine_threadsafe(messages.put(message), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            put(("start", int(status.split(" ", 1)[0]), headers))
+            return _unsupported_write
+
+        def run():
+            # The whole response is produced in this one thread, so
+            # stream_with_context generators keep their context.
+            try:
+                iterable = self.wsgi_app(environ, start_response)
+                try:
+                    for chunk in iterable:
+                        if abandoned.is_set():
+                            break
+                        if chunk:
+                            put(("body", chunk))
+                finally:
+                    if hasattr(iterable, "close"):
+                        iterable.close()
+            except BaseException as exc:
+                maro.app.logger.exception("WSGI app failed for %s", environ["PATH_INFO"])
+                put(("error", exc))
+            else:
+                put(("end",))
+
+        self.wsgi_pool.submit(run)
+        finished = started = False
+        try:
+            while True:
+                message = await messages.get()
+                kind = message[0]
+                if kind == "start":
+                    started = True
+                    headers = [
+                        (name.lower().encode("latin-1"), value.encode("latin-1"))
+                        for name, value in message[2]
+                    ]
+                    await send({"type": "http.response.start", "status": message[1], "headers": headers})
+                elif kind == "body":
+                    await send({"type": "http.response.body", "body": message[1], "more_body": True})
+                else:
+                    finished = True
+                    if kind == "error":
+                        if not started:
+                            await send_json(send, 500, {"error": "internal server error"})
+                            return
+                    await send({"type": "http.response.body", "body": b""})
+                    return
+        finally:
+            if not finished:
+                # The client went away: let the thread stop and drain it.
+                abandoned.set()
+                while (await messages.get())[0] not in ("end", "error"):
+                    pass
+
+
+def _unsupported_write(data):
+    raise RuntimeError("the WSGI write() callable is not supported")
+
+
+class ReceiveStream(io.RawIOBase):
+    """
+    wsgi.input for a Flask thread: reads the request body from the ASGI
+    receive channel as the app asks for it, so uploads are never held
+    whole in memory. A client that disconnects ends the body.
+    """
+
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.pending = b""
+        self.finished = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending and not self.finished:
+            message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+            if message["type"] == "http.disconnect":
+                self.finished = True
+                break
+            self.pending = message.get("body", b"")
+            self.finished = not message.get("more_body")
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+async def read_body(receive):
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > ASGI_MAX_BODY:
+            raise BodyTooLarge()
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            break
+    return b"".join(chunks)
+
+
+async def send_json(send, status, obj):
+    body = jobs.dumps_json(obj)
+    headers = JSON_HEADERS + [(b"content-length", str(len(body)).encode())]
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+    return status
+
+
+def query_args(scope):
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    return {key: values[-1] for key, values in query.items()}
+
+
+def wsgi_environ(scope, stream):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1] if server[1] is not None else 80),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BufferedReader(stream),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for raw_name, raw_value in scope.get("headers", []):
+        name = raw_name.decode("latin-1").upper().replace("-", "_")
+        value = raw_value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+            continue
+        if name == "CONTENT_LENGTH":
+            environ["CONTENT_LENGTH"] = value
+            continue
+        key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    if "CONTENT_LENGTH" not in environ:
+        # A chunked body: the stream ends where the body does.
+        environ["wsgi.input_terminated"] = True
+    return environ
+
+
+app = MaroASGI(maro.app)
@@ -0,0 +1,338 @@
+"""
+Benchmarks for the calculator's hot paths.
+
+    python bench.py run [--sizes 10k,1m,10m] [--out bench.json] [--db-dir DIR]
+    python bench.py compare baseline.json bench.json [--threshold 0.10]
+
+`run` times `import app` in fresh interpreters, the scalar calculation
+helpers, the POST / -> redirect -> result page cycle and the history
+views against synthetic calculations tables of each size, and writes the
+timings as JSON. `compare` prints the
+change per benchmark and exits 1 when any got slower than the threshold.
+
+Synthetic tables are generated into --db-dir (a temporary directory by
+default) and reused there when they already hold the right row count.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import app
+import engine
+import parameters
+import storage
+
+SIZES = {"10k": 10_000, "1m": 1_000_000, "10m": 10_000_000}
+GENERATE_CHUNK = 200_000
+
+# Target for a cold `import app`, Flask and NumPy included.
+IMPORT_BUDGET_SECONDS = 0.200
+IMPORT_RUNS = 15
+IMPORT_SNIPPET = """
+import time
+{preload}
+started = time.perf_counter()
+import app
+print(time.perf_counter() - started)
+"""
+
+FORM = {
+    "area_m2": "2000",
+    "system_type": "soilless",
+    "crop": "tomato",
+    "setup_level": "standard",
+    "country": "NG",
+    "currency_override": "",
+    "use_solar": True,
+    "annual_production_cost": "",
+    "price_per_unit": "",
+    "capex_per_m2": "",
+}
+
+
+def measure(fn, min_time=0.5, max_repeat=10_000, min_repeat=3):
+    """Warm up once, then call fn until min_time has passed; returns stats."""
+    fn()
+    times = []
+    started = time.perf_counter()
+    while len(times) < max_repeat and (
+        len(times) < min_repeat or time.perf_counter() - started < min_time
+    ):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return summarize(times)
+
+
+def summarize(times):
+    return {
+        "repeat": len(times),
+        "median": statistics.median(times),
+        "mean": statistics.fmean(times),
+        "min": min(times),
+        "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+    }
+
+
+# =====================
+#  Synthetic history
+# =====================
+def generate_history(path, rows, seed=0):
+    """Fill a fresh database at `path` with `rows` random calculations."""
+    remove_database(path)
+    conn = storage.open_db(path)
+    rng = np.random.default_rng(seed)
+    countries = [c["code"] for c in parameters.get_countries()[:40]]
+    currencies = sorted(parameters.PARAMS.fx.rates)
+    crops = sorted(parameters.PARAMS.tables["PRICE_PER_KG_USD"]["GLOBAL"])
+    systems = ["soil", "soilless", "vertical", "hydroponics", "aeroponics"]
+    start = datetime.datetime(2025, 1, 1)
+    span = 365 * 86400
+
+    columns = ", ".join(storage.CALCULATION_COLUMNS[:9])
+    for lo in range(0, rows, GENERATE_CHUNK):
+        n = min(GENERATE_CHUNK, rows - lo)
+        # Timestamps grow with the id, like the real log.
+        seconds = (np.arange(lo, lo + n) + rng.random(n)) * span / rows
+        area = rng.uniform(50, 10_000, n).round()
+        yield_ = area * rng.uniform(5, 60, n)
+        revenue = yield_ * rng.uniform(0.5, 8, n)
+        profit = revenue - area * rng.uniform(10, 80, n)
+        records = zip(
+            ((start + datetime.timedelta(seconds=float(s))).isoformat() for s in seconds),
+            rng.choice(countries, n).tolist(),
+            rng.choice(currencies, n).tolist(),
+            rng.choice(crops, n).tolist(),
+            rng.choice(systems, n).tolist(),
+            area.tolist(),
+            yield_.tolist(),
+            revenue.tolist(),
+            profit.tolist(),
+        )
+        with conn:
+            conn.executemany(
+                f"INSERT INTO calculations ({columns}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                records,
+            )
+    storage.rebuild_rollups(conn)
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+def remove_database(path):
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    # The file is gone, so its schema has to be created again.
+    storage._migrated_databases.discard(path)
+
+
+def history_database(db_dir, label, rows):
+    path = os.path.join(db_dir, f"bench_history_{label}.db")
+    if os.path.exists(path):
+        conn = storage.open_db(path)
+        count = conn.execute("SELECT count(*) FROM calculations").fetchone()[0]
+        conn.close()
+        if count == rows:
+            return path
+    print(f"  generating {rows} rows into {path} ...", file=sys.stderr)
+    # Generated aside and renamed in, so an interrupted run leaves no
+    # half-filled database behind.
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    generate_history(tmp_path, rows)
+    remove_database(path)
+    os.replace(tmp_path, path)
+    return path
+
+
+# =====================
+#  Benchmarks
+# =====================
+def bench_import(results, db_dir):
+    """
+    `import app` in fresh interpreters: in full (import_app) and with
+    Flask and NumPy already loaded, i.e. the module's own start-up work
+    (import_app_own).
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, MARO_DATABASE=os.path.join(db_dir, "bench_import.db"))
+    # The first run writes the bytecode cache the others load.
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    for name, preload in (("import_app", ""), ("import_app_own", "import flask, numpy")):
+        code = IMPORT_SNIPPET.format(preload=preload)
+        times = []
+        for _ in range(IMPORT_RUNS + 1):
+            out = subprocess.run(
+                [sys.executable, "-c", code], cwd=root, env=env,
+                capture_output=True, text=True, check=True,
+            ).stdout
+            times.append(float(out.split()[-1]))
+        results[name] = summarize(times[1:])
+
+
+def bench_scalar(results):
+    filled = dict(FORM)
+    engine.fill_auto_economics_for_form(filled)
+    results["compute_results"] = measure(lambda: engine.compute_results(filled))
+    results["fill_auto_economics_for_form"] = measure(
+        lambda: engine.fill_auto_economics_for_form(dict(FORM))
+    )
+    codes = [c["code"] for c in parameters.get_countries()]
+    results["find_country"] = measure(lambda: [parameters.find_country(c) for c in codes])
+    results["find_country"]["ops"] = len(codes)
+
+
+def bench_request_cycle(results, db_dir):
+    storage.DATABASE = os.path.join(db_dir, "bench_requests.db")
+    remove_database(storage.DATABASE)
+    client = app.app.test_client()
+    counter = iter(range(10**9))
+
+    def cycle(area):
+        response = client.post("/", data={**FORM, "area_m2": area})
+        assert response.status_code == 302, response.status_code
+        page = client.get(response.location)
+        assert page.status_code == 200, page.status_code
+
+    # Identical inputs hit the stored result; unique ones compute and store.
+    results["post_results_cycle_repeat"] = measure(lambda: cycle("2000"))
+    results["post_results_cycle_unique"] = measure(
+        lambda: cycle(str(1000 + next(counter)))
+    )
+
+
+def bench_history(results, db_dir, label, rows):
+    storage.DATABASE = history_database(db_dir, label, rows)
+    client = app.app.test_client()
+
+    def get(url):
+        response = client.get(url)
+        assert response.status_code == 200, response.status_code
+        return response
+
+    def download(url):
+        return sum(len(chunk) for chunk in get(url).response)
+
+    results[f"admin_history[{label}]"] = measure(lambda: get("/admin/history"))
+    results[f"admin_history_filtered[{label}]"] = measure(
+        lambda: get("/admin/history?crop=basil&date_from=2025-06-01")
+    )
+    # Full exports of the big tables take long enough that one run will do.
+    min_repeat = 3 if rows <= 100_000 else 1
+    results[f"admin_history_download[{label}]"] = measure(
+        lambda: download("/admin/history/download"), min_time=0, min_repeat=min_repeat
+    )
+    results[f"admin_history_download[{label}]"]["rows"] = rows
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    db_dir = args.db_dir or tempfile.mkdtemp(prefix="maro-bench-")
+    os.makedirs(db_dir, exist_ok=True)
+    labels = [label.strip().lower() for label in args.sizes.split(",") if label.strip()]
+    unknown = [label for label in labels if label not in SIZES]
+    if unknown:
+        sys.exit(f"unknown size(s) {', '.join(unknown)}; use {', '.join(SIZES)}")
+
+    results = {}
+    print("import ...", file=sys.stderr)
+    bench_import(results, db_dir)
+    print("scalar helpers ...", file=sys.stderr)
+    bench_scalar(results)
+    print("request cycle ...", file=sys.stderr)
+    bench_request_cycle(results, db_dir)
+    for label in labels:
+        print(f"history {label} ...", file=sys.stderr)
+        bench_history(results, db_dir, label, SIZES[label])
+
+    report = {
+        "meta": {
+            "created_at": datetime.datetime.utcnow().isoformat(),
+            "commit": git_commit(),
+            "params_version": parameters.PARAMS.version,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=1)
+
+    for name, stats in results.items():
+        print(f"{name:45s} {stats['median'] * 1000:12.3f} ms  (x{stats['repeat']})")
+    if results["import_app"]["median"] > IMPORT_BUDGET_SECONDS:
+        print(f"import app is over its {IMPORT_BUDGET_SECONDS * 1000:.0f} ms budget")
+    print(f"wrote {args.out}")
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    with open(args.current) as f:
+        current = json.load(f)["results"]
+
+    regressions = []
+    for name in sorted(set(baseline) | set(current)):
+        if name not in baseline or name not in current:
+            print(f"{name:45s} {'only in ' + ('baseline' if name in baseline else 'current'):>30s}")
+            continue
+        old, new = baseline[name]["median"], current[name]["median"]
+        change = new / old - 1 if old else 0.0
+        flag = ""
+        if change > args.threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif change < -args.threshold:
+            flag = "  faster"
+        print(f"{name:45s} {old * 1000:12.3f} -> {new * 1000:12.3f} ms {change:+8.1%}{flag}")
+
+    if regressions:
+        print(f"{len(regressions)} regression(s) past {args.threshold:.0%}")
+        sys.exit(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = sub.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--sizes", default="10k,1m,10m",
+                            help="history table sizes (default: 10k,1m,10m)")
+    run_parser.add_argument("--out", default="bench.json")
+    run_parser.add_argument("--db-dir", help="where synthetic tables are kept")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = sub.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.10,
+                                help="relative slowdown flagged as a regression")
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
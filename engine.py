@@ -0,0 +1,1097 @@
+"""The calculation: form defaults, the scalar, graph and batch engines, and their cache."""
+import atexit
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from operator import itemgetter
+
+import numpy as np
+
+import parameters
+from metrics import phase
+from parameters import (
+    current_price_unit_for_crop, estimate_capex_per_m2_usd, estimate_price_per_kg_usd,
+    estimate_production_cost_per_m2_usd, find_country, get_crop_params, lookup_fx_rate,
+    missing_rate_message, usd_to_currency,
+)
+
+
+def parse_number(value):
+    """A form value as a float; blank or unparsable values count as 0."""
+    if isinstance(value, str):
+        value = value.strip()
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+# =========================
+#  Auto economics defaults
+# =========================
+def fill_auto_economics_for_form(form_dict, param_set=None):
+    """
+    Fill in default annual_production_cost, price_per_unit, capex_per_m2
+    if user left them blank/0. Textboxes may be hidden; values are used
+    only for calculations.
+    """
+    param_set = param_set or parameters.PARAMS
+    try:
+        area = float(form_dict.get("area_m2", 0) or 0)
+    except ValueError:
+        area = 0
+
+    crop = form_dict.get("crop", "tomato")
+    system_type = form_dict.get("system_type", "soilless")
+    setup_level = form_dict.get("setup_level", "standard")
+    country_code = form_dict.get("country") or "US"
+
+    # Determine display currency
+    country = find_country(country_code)
+    base_curr = country["currency_code"] if country else "USD"
+    override = (form_dict.get("currency_override") or "").strip().upper()
+    display_curr = override or base_curr
+    if lookup_fx_rate(display_curr, param_set) is None:
+        # Nothing can be estimated; compute_results reports the currency.
+        return
+
+    # Production cost
+    raw_cost = (form_dict.get("annual_production_cost") or "").strip()
+    try:
+        cost_val = float(raw_cost) if raw_cost else 0
+    except ValueError:
+        cost_val = 0
+
+    if area > 0 and cost_val <= 0:
+        per_m2_usd = estimate_production_cost_per_m2_usd(system_type, param_set)
+        total_usd = per_m2_usd * area
+        total_local = usd_to_currency(total_usd, display_curr, param_set)
+        form_dict["annual_production_cost"] = f"{total_local:.2f}"
+
+    # Price per unit
+    raw_price = (form_dict.get("price_per_unit") or "").strip()
+    try:
+        price_val = float(raw_price) if raw_price else 0
+    except ValueError:
+        price_val = 0
+
+    if price_val <= 0:
+        price_unit = current_price_unit_for_crop(crop)
+        price_usd_per_kg = estimate_price_per_kg_usd(crop, country_code, param_set)
+        price_local_per_kg = usd_to_currency(price_usd_per_kg, display_curr, param_set)
+        if price_unit == "g":
+            est_unit = price_local_per_kg / 1000.0
+        else:
+            est_unit = price_local_per_kg
+        form_dict["price_per_unit"] = f"{est_unit:.3f}"
+
+    # CAPEX per m²
+    raw_capex = (form_dict.get("capex_per_m2") or "").strip()
+    try:
+        capex_val = float(raw_capex) if raw_capex else 0
+    except ValueError:
+        capex_val = 0
+
+    if capex_val <= 0:
+        capex_usd = estimate_capex_per_m2_usd(setup_level, country_code, param_set)
+        form_dict["capex_per_m2"] = f"{usd_to_currency(capex_usd, display_curr, param_set):.0f}"
+
+
+# =====================
+#  Core calculation
+# =====================
+# The formulas, shared by compute_results and the result graph.
+def display_currency(currency_override, country):
+    """(code, symbol) of the currency results are shown in."""
+    if currency_override:
+        return currency_override, currency_override
+    if country:
+        return country["currency_code"], country["currency_symbol"]
+    return "USD", "$"
+
+
+def _per(amount, base):
+    return amount / base if base > 0 else 0
+
+
+def crop_quantities(area, p):
+    """Plant, yield and nutrient figures for `area` m² under crop parameters `p`."""
+    plants_per_m2 = p["plants_per_m2"]
+    crops_per_year = p["crops_per_year"]
+    yield_per_m2_per_crop = p["yield_per_m2_per_crop"]
+    nutrient_per_m2_per_crop = p["nutrients_kg_m2_crop"]
+    nutrient_per_crop_total = nutrient_per_m2_per_crop * area
+    return {
+        "plants_per_m2": plants_per_m2,
+        "crops_per_year": crops_per_year,
+        "yield_per_m2_per_crop": yield_per_m2_per_crop,
+        "plants": area * plants_per_m2,
+        "annual_yield": area * yield_per_m2_per_crop * crops_per_year,
+        "nutrient_per_m2_per_crop": nutrient_per_m2_per_crop,
+        "nutrient_per_crop_total": nutrient_per_crop_total,
+        "annual_nutrient_total": nutrient_per_crop_total * crops_per_year,
+        "nutrient_per_plant_per_crop": _per(nutrient_per_m2_per_crop, plants_per_m2),
+    }
+
+
+def usd_economics(area, annual_yield, fx_rate, price_per_kg_local, gross_cost_local,
+                  capex_per_m2_local, use_solar, solar_savings_rate):
+    """
+    Revenue, costs and payback in USD, keyed by result field, from the
+    price and costs entered in a currency worth `fx_rate` USD.
+    """
+    price_per_kg_usd = price_per_kg_local * fx_rate
+    gross_cost_usd = gross_cost_local * fx_rate
+    solar_savings_usd = gross_cost_usd * solar_savings_rate if use_solar else 0
+    net_cost_usd = gross_cost_usd - solar_savings_usd
+    capex_per_m2_usd = capex_per_m2_local * fx_rate
+    total_setup_cost_usd = capex_per_m2_usd * area
+
+    annual_revenue_usd = annual_yield * price_per_kg_usd
+    annual_profit_usd = annual_revenue_usd - net_cost_usd
+    return {
+        "gross_production_cost": gross_cost_usd,
+        "solar_savings": solar_savings_usd,
+        "net_production_cost": net_cost_usd,
+        "price_per_kg": price_per_kg_usd,
+        "annual_revenue": annual_revenue_usd,
+        "annual_profit": annual_profit_usd,
+        "cost_per_kg": net_cost_usd / annual_yield if annual_yield > 0 else None,
+        "profit_per_kg": annual_profit_usd / annual_yield if annual_yield > 0 else None,
+        "capex_per_m2": capex_per_m2_usd,
+        "total_setup_cost": total_setup_cost_usd,
+        "simple_payback_years": (
+            total_setup_cost_usd / annual_profit_usd if annual_profit_usd > 0 else None
+        ),
+    }
+
+
+def display_economics(usd, fx_rate, area, plants):
+    """
+    usd_economics in a currency worth `fx_rate` USD, with the per-m² and
+    per-plant figures, in result field order.
+    """
+    net_cost = usd["net_production_cost"] / fx_rate
+    profit = usd["annual_profit"] / fx_rate
+    revenue = usd["annual_revenue"] / fx_rate
+    cost_per_kg = usd["cost_per_kg"]
+    profit_per_kg = usd["profit_per_kg"]
+    return {
+        "gross_production_cost": usd["gross_production_cost"] / fx_rate,
+        "solar_savings": usd["solar_savings"] / fx_rate,
+        "net_production_cost": net_cost,
+        "price_per_kg": usd["price_per_kg"] / fx_rate,
+        "annual_revenue": revenue,
+        "annual_profit": profit,
+        "cost_per_kg": None if cost_per_kg is None else cost_per_kg / fx_rate,
+        "profit_per_kg": None if profit_per_kg is None else profit_per_kg / fx_rate,
+        "cost_per_m2_per_year": _per(net_cost, area),
+        "profit_per_m2_per_year": _per(profit, area),
+        "cost_per_plant_per_year": _per(net_cost, plants),
+        "profit_per_plant_per_year": _per(profit, plants),
+        "revenue_per_m2_per_year": _per(revenue, area),
+        "revenue_per_plant_per_year": _per(revenue, plants),
+        "capex_per_m2": usd["capex_per_m2"] / fx_rate,
+        "total_setup_cost": usd["total_setup_cost"] / fx_rate,
+        "simple_payback_years": usd["simple_payback_years"],
+    }
+
+
+# The compute_results dict, in its order.
+RESULT_FIELDS = (
+    "currency_code", "currency_symbol", "country_code",
+    "area", "crop", "system_type", "setup_level", "setup_label", "use_solar",
+    "plants_per_m2", "crops_per_year", "yield_per_m2_per_crop", "plants", "annual_yield",
+    "nutrient_per_m2_per_crop", "nutrient_per_crop_total", "annual_nutrient_total",
+    "nutrient_per_plant_per_crop",
+    "gross_production_cost", "solar_savings", "net_production_cost",
+    "price_per_kg",
+    "annual_revenue", "annual_profit",
+    "cost_per_kg", "profit_per_kg",
+    "cost_per_m2_per_year", "profit_per_m2_per_year",
+    "cost_per_plant_per_year", "profit_per_plant_per_year",
+    "revenue_per_m2_per_year", "revenue_per_plant_per_year",
+    "capex_per_m2", "total_setup_cost", "simple_payback_years",
+    "SOLAR_SAVINGS_RATE",
+)
+
+
+def compute_results(form, param_set=None):
+    param_set = param_set or parameters.PARAMS
+    tables = param_set.tables
+
+    area = parse_number(form.get("area_m2", 0))
+    if area <= 0:
+        return None, "Please fill in the greenhouse area."
+
+    crop = form.get("crop", "tomato")
+    system_type = form.get("system_type", "soilless")
+    setup_level = form.get("setup_level", "standard")
+    use_solar = form.get("use_solar") is True
+    country_code = form.get("country", "US")
+    currency_override = (form.get("currency_override") or "").strip().upper()
+
+    currency_code, currency_symbol = display_currency(currency_override, find_country(country_code))
+    fx_rate = lookup_fx_rate(currency_code, param_set)
+    if fx_rate is None:
+        return None, missing_rate_message(currency_code)
+
+    # Prices and costs are entered in the display currency.
+    quantities = crop_quantities(area, get_crop_params(country_code, system_type, crop, param_set))
+    solar_savings_rate = tables["SOLAR_SAVINGS_RATE"]
+    usd = usd_economics(
+        area,
+        quantities["annual_yield"],
+        fx_rate,
+        parse_number(form.get("price_per_unit")),
+        parse_number(form.get("annual_production_cost")),
+        parse_number(form.get("capex_per_m2")),
+        use_solar,
+        solar_savings_rate,
+    )
+
+    return {
+        "currency_code": currency_code,
+        "currency_symbol": currency_symbol,
+        "country_code": country_code,
+        "area": area,
+        "crop": crop,
+        "system_type": system_type,
+        "setup_level": setup_level,
+        "setup_label": tables["SETUP_LEVEL_LABELS"].get(setup_level, setup_level),
+        "use_solar": use_solar,
+        **quantities,
+        **display_economics(usd, fx_rate, area, quantities["plants"]),
+        "SOLAR_SAVINGS_RATE": solar_savings_rate,
+    }, None
+
+
+# =====================
+#  Result graph
+# =====================
+# The quantities of calculate() as a dependency graph, so a what-if only
+# recomputes what its change affects. The nodes call the helpers
+# compute_results uses, so the values are identical.
+
+# form field -> graph input
+RESULT_INPUTS = {
+    "area_m2": "area",
+    "crop": "crop",
+    "system_type": "system_type",
+    "setup_level": "setup_level",
+    "use_solar": "use_solar",
+    "country": "country_code",
+    "currency_override": "currency_override",
+    "price_per_unit": "price_override",
+    "annual_production_cost": "cost_override",
+    "capex_per_m2": "capex_override",
+}
+
+
+def form_result_inputs(form):
+    """
+    The graph inputs of a form dict as submitted, parsed and defaulted as
+    calculate() does. An override that is not positive gets estimated.
+    """
+    return {
+        "area": parse_number(form.get("area_m2", 0)),
+        "crop": form.get("crop", "tomato"),
+        "system_type": form.get("system_type", "soilless"),
+        "setup_level": form.get("setup_level", "standard"),
+        "use_solar": form.get("use_solar") is True,
+        "country_code": form.get("country", "US"),
+        "currency_override": (form.get("currency_override") or "").strip().upper(),
+        "price_override": parse_number(form.get("price_per_unit")),
+        "cost_override": parse_number(form.get("annual_production_cost")),
+        "capex_override": parse_number(form.get("capex_per_m2")),
+    }
+
+
+def _estimated(override, estimate_usd, fx_rate, digits):
+    # Rounded as fill_auto_economics_for_form writes it into the form.
+    if override > 0 or fx_rate is None:
+        return override
+    return float(f"{estimate_usd() / fx_rate:.{digits}f}")
+
+
+# name -> (dependency names, function of their values)
+RESULT_GRAPH = {
+    # currency and labels
+    "country": (("country_code",), lambda code: find_country(code)),
+    "display_currency": (("currency_override", "country"), display_currency),
+    "currency_code": (("display_currency",), itemgetter(0)),
+    "currency_symbol": (("display_currency",), itemgetter(1)),
+    "fx_rate": (("currency_code", "param_set"), lookup_fx_rate),
+    "setup_label": (
+        ("setup_level", "param_set"),
+        lambda level, param_set: param_set.tables["SETUP_LEVEL_LABELS"].get(level, level),
+    ),
+    "SOLAR_SAVINGS_RATE": (("param_set",), lambda param_set: param_set.tables["SOLAR_SAVINGS_RATE"]),
+
+    # overrides in use: the form value, or the estimate fill_auto_economics writes
+    "estimate_country": (("country_code",), lambda code: code or "US"),
+    "price_per_kg_local": (
+        ("price_override", "crop", "estimate_country", "fx_rate", "param_set"),
+        lambda override, crop, code, rate, param_set: _estimated(
+            override, lambda: estimate_price_per_kg_usd(crop, code, param_set), rate, 3
+        ),
+    ),
+    "gross_cost_local": (
+        ("cost_override", "system_type", "area", "fx_rate", "param_set"),
+        lambda override, system_type, area, rate, param_set: _estimated(
+            override,
+            lambda: estimate_production_cost_per_m2_usd(system_type, param_set) * area,
+            rate,
+            2,
+        ),
+    ),
+    "capex_per_m2_local": (
+        ("capex_override", "setup_level", "estimate_country", "fx_rate", "param_set"),
+        lambda override, level, code, rate, param_set: _estimated(
+            override, lambda: estimate_capex_per_m2_usd(level, code, param_set), rate, 0
+        ),
+    ),
+
+    # crop
+    "crop_params": (("country_code", "system_type", "crop", "param_set"), get_crop_params),
+    "crop_quantities": (("area", "crop_params"), crop_quantities),
+
+    # economics
+    "usd_economics": (
+        (
+            "area", "annual_yield", "fx_rate", "price_per_kg_local", "gross_cost_local",
+            "capex_per_m2_local", "use_solar", "SOLAR_SAVINGS_RATE",
+        ),
+        usd_economics,
+    ),
+    "display_economics": (
+        ("usd_economics", "fx_rate", "area", "plants"), display_economics
+    ),
+}
+
+# The result fields the helper nodes hold.
+for _group, _names in (
+    ("crop_quantities", (
+        "plants_per_m2", "crops_per_year", "yield_per_m2_per_crop", "plants", "annual_yield",
+        "nutrient_per_m2_per_crop", "nutrient_per_crop_total", "annual_nutrient_total",
+        "nutrient_per_plant_per_crop",
+    )),
+    ("display_economics", (
+        "gross_production_cost", "solar_savings", "net_production_cost", "price_per_kg",
+        "annual_revenue", "annual_profit", "cost_per_kg", "profit_per_kg",
+        "cost_per_m2_per_year", "profit_per_m2_per_year",
+        "cost_per_plant_per_year", "profit_per_plant_per_year",
+        "revenue_per_m2_per_year", "revenue_per_plant_per_year",
+        "capex_per_m2", "total_setup_cost", "simple_payback_years",
+    )),
+):
+    for _name in _names:
+        RESULT_GRAPH[_name] = ((_group,), itemgetter(_name))
+
+
+def _result_downstream():
+    """Every node and input -> the nodes that depend on it, transitively."""
+    direct = {}
+    for name, (deps, _) in RESULT_GRAPH.items():
+        for dep in deps:
+            direct.setdefault(dep, set()).add(name)
+    closure = {}
+
+    def visit(name):
+        if name not in closure:
+            found = set()
+            for child in direct.get(name, ()):
+                found.add(child)
+                found |= visit(child)
+            closure[name] = frozenset(found)
+        return closure[name]
+
+    for name in set(direct) | set(RESULT_GRAPH):
+        visit(name)
+    return closure
+
+
+RESULT_DOWNSTREAM = _result_downstream()
+
+
+class LazyResults:
+    """
+    One calculation as a lazily evaluated RESULT_GRAPH: results["name"]
+    computes that node, and what it needs, once. with_changes() gives a
+    copy with some inputs replaced that keeps every unaffected value.
+    """
+
+    def __init__(self, inputs, values=None, param_set=None):
+        self.param_set = param_set or parameters.PARAMS
+        self._inputs = dict(inputs)
+        self._values = dict(values) if values else {}
+        self._values.update(inputs)
+        self._values["param_set"] = self.param_set
+        self.changed = []
+        self.evaluated = 0
+
+    @classmethod
+    def from_form(cls, form):
+        return cls(form_result_inputs(form))
+
+    def __getitem__(self, name):
+        values = self._values
+        if name in values:
+            return values[name]
+        deps, fn = RESULT_GRAPH[name]
+        value = fn(*[self[dep] for dep in deps])
+        values[name] = value
+        self.evaluated += 1
+        return value
+
+    def _check_params(self):
+        param_set = parameters.PARAMS
+        if self.param_set is not param_set:
+            self._values = {**self._inputs, "param_set": param_set}
+            self.param_set = param_set
+
+    @property
+    def error(self):
+        """The error compute_results gives for these inputs, or None."""
+        self._check_params()
+        if self["area"] <= 0:
+            return "Please fill in the greenhouse area."
+        if self["fx_rate"] is None:
+            return missing_rate_message(self["currency_code"])
+        return None
+
+    def get(self, fields=RESULT_FIELDS):
+        """({field: value}, None), or (None, error) like compute_results."""
+        unknown = [name for name in fields if name not in RESULT_GRAPH and name not in self._inputs]
+        if unknown:
+            raise ValueError(f"unknown result fields: {', '.join(unknown)}")
+        error = self.error
+        if error:
+            return None, error
+        values = self._values
+        return {name: values[name] if name in values else self[name] for name in fields}, None
+
+    def with_changes(self, inputs):
+        """
+        A copy with some graph inputs replaced. Only the values downstream
+        of an input that actually changed are dropped.
+        """
+        self._check_params()
+        changed = {name: value for name, value in inputs.items() if self._inputs[name] != value}
+        child = LazyResults({**self._inputs, **changed}, self._values, self.param_set)
+        for name in changed:
+            for stale in RESULT_DOWNSTREAM[name]:
+                child._values.pop(stale, None)
+        child.changed = sorted(changed)
+        return child
+
+
+# =====================
+#  Batch calculation
+# =====================
+# Column defaults mirror the form.get(...) defaults used by the scalar path.
+BATCH_TEXT_DEFAULTS = {
+    "crop": "tomato",
+    "system_type": "soilless",
+    "setup_level": "standard",
+    "country": "US",
+    "currency_override": "",
+}
+
+# Optional per-row overrides; NaN or <= 0 means "estimate it", like a blank box.
+BATCH_OVERRIDE_FIELDS = ("annual_production_cost", "price_per_unit", "capex_per_m2")
+
+# Results fields that compute_results reports as None; NaN in the batch columns.
+BATCH_NULLABLE_FIELDS = ("cost_per_kg", "profit_per_kg", "simple_payback_years")
+
+# Crop parameters compute_results passes through as ints where the table
+# has one; the (n, 4) "int_params" column records which.
+BATCH_PARAM_FIELDS = (
+    "plants_per_m2", "crops_per_year", "yield_per_m2_per_crop", "nutrient_per_m2_per_crop",
+)
+
+# Columns of a compute_results_batch result that are not result fields.
+BATCH_FLAG_FIELDS = ("valid", "fx_missing", "int_params")
+
+BATCH_TEXT_FIELDS = (
+    "currency_code", "currency_symbol", "country_code",
+    "crop", "system_type", "setup_level", "setup_label",
+)
+
+
+def _batch_column(columns, key, n, default, dtype):
+    value = columns.get(key)
+    if value is None:
+        return np.full(n, default, dtype=dtype)
+    arr = np.array(value, dtype=dtype)
+    if arr.ndim == 0:
+        return np.full(n, arr.item(), dtype=dtype)
+    if arr.shape != (n,):
+        raise ValueError(f"column {key!r} has {arr.shape[0]} rows, expected {n}")
+    return arr
+
+
+def _factorize(columns, key, n, default):
+    """Distinct values of a text column and each row's index into them."""
+    value = columns.get(key, default)
+    if isinstance(value, str):
+        return [value], np.zeros(n, dtype=np.intp)
+    if isinstance(value, np.ndarray) and value.dtype.kind == "U":
+        uniques, codes = np.unique(value, return_inverse=True)
+        return [str(u) for u in uniques], codes.reshape(-1)
+    lookup = {}
+    codes = np.fromiter(
+        (lookup.setdefault(str(v), len(lookup)) for v in value), dtype=np.intp, count=len(value)
+    )
+    if codes.shape != (n,):
+        raise ValueError(f"column {key!r} has {codes.shape[0]} rows, expected {n}")
+    return list(lookup), codes
+
+
+def _round_like_format(values, decimals):
+    """
+    Round exactly like float(f"{value:.{decimals}f}"). rint() only disagrees
+    next to a .5 boundary, so only those values are formatted.
+    """
+    scale = 10.0 ** decimals
+    scaled = values * scale
+    out = np.rint(scaled) / scale
+    tol = np.abs(scaled) * 1e-12 + 1e-9
+    close = np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < tol)
+    for i in close:
+        out[i] = float(f"{values[i]:.{decimals}f}")
+    return out
+
+
+def compute_results_batch(columns, param_set=None):
+    """
+    Vectorized equivalent of fill_auto_economics_for_form + compute_results.
+
+    `columns` maps input names to equal-length arrays (scalars broadcast):
+    area_m2, crop, system_type, setup_level, country, currency_override,
+    use_solar and the optional overrides annual_production_cost,
+    price_per_unit and capex_per_m2. Returns a dict of column arrays with
+    every field compute_results produces plus a boolean "valid" column;
+    rows with a non-positive area are invalid and hold NaN.
+    """
+    param_set = param_set or parameters.PARAMS
+    tables = param_set.tables
+    # A copy: invalid rows of the returned "area" column are set to NaN.
+    area = np.array(columns["area_m2"], dtype=float)
+    if area.ndim == 0:
+        area = area.reshape(1)
+    n = area.shape[0]
+
+    use_solar = _batch_column(columns, "use_solar", n, False, bool)
+    overrides = {
+        key: np.nan_to_num(_batch_column(columns, key, n, np.nan, float), nan=0.0)
+        for key in BATCH_OVERRIDE_FIELDS
+    }
+    valid = area > 0
+
+    # Factorize the text columns; all lookups then run once per distinct value.
+    uniques, codes = {}, {}
+    for key, default in BATCH_TEXT_DEFAULTS.items():
+        uniques[key], codes[key] = _factorize(columns, key, n, default)
+
+    # Currency resolution per (country, override) pair. The form fill step
+    # falls back to "US" for a blank country, compute_results does not.
+    n_over = len(uniques["currency_override"])
+    pair_keys, pair_codes = np.unique(
+        codes["country"] * n_over + codes["currency_override"], return_inverse=True
+    )
+    fill_rate = np.empty(len(pair_keys))
+    rate = np.empty(len(pair_keys))
+    currency_code = np.empty(len(pair_keys), dtype=object)
+    currency_symbol = np.empty(len(pair_keys), dtype=object)
+    for j, key in enumerate(pair_keys):
+        country_code = uniques["country"][key // n_over]
+        override = uniques["currency_override"][key % n_over].strip().upper()
+
+        fill_country = find_country(country_code or "US")
+        fill_curr = override or (fill_country["currency_code"] if fill_country else "USD")
+        fill_rate[j] = param_set.fx.rates.get(fill_curr, np.nan)
+
+        country = find_country(country_code)
+        currency_code[j] = override or (country["currency_code"] if country else "USD")
+        currency_symbol[j] = override or (country["currency_symbol"] if country else "$")
+        rate[j] = lookup_fx_rate(currency_code[j], param_set) or np.nan
+
+    fill_rate = fill_rate[pair_codes]
+    fx_rate = rate[pair_codes]
+    # Rows in a currency without a rate are invalid, like compute_results.
+    fx_missing = np.isnan(fx_rate) & valid
+    valid = valid & ~fx_missing
+
+    # Crop parameters per (country, system, crop).
+    n_sys = len(uniques["system_type"])
+    n_crop = len(uniques["crop"])
+    crop_keys, crop_codes = np.unique(
+        (codes["country"] * n_sys + codes["system_type"]) * n_crop + codes["crop"],
+        return_inverse=True,
+    )
+    crop_table = np.empty((len(crop_keys), 4))
+    crop_ints = np.empty((len(crop_keys), 4), dtype=bool)
+    for j, key in enumerate(crop_keys):
+        p = get_crop_params(
+            uniques["country"][key // (n_sys * n_crop)],
+            uniques["system_type"][key // n_crop % n_sys],
+            uniques["crop"][key % n_crop],
+            param_set,
+        )
+        values = (
+            p["plants_per_m2"], p["crops_per_year"],
+            p["yield_per_m2_per_crop"], p["nutrients_kg_m2_crop"],
+        )
+        crop_table[j] = values
+        crop_ints[j] = [type(value) is int for value in values]
+    plants_per_m2, crops_per_year, yield_per_m2_per_crop, nutrient_per_m2_per_crop = (
+        crop_table[crop_codes].T
+    )
+
+    # Auto economics, as fill_auto_economics_for_form writes them into the form.
+    fill_countries = [c or "US" for c in uniques["country"]]
+    n_setup = len(uniques["setup_level"])
+    price_usd = np.array([
+        [estimate_price_per_kg_usd(crop, c, param_set) for crop in uniques["crop"]]
+        for c in fill_countries
+    ]).reshape(-1, n_crop)[codes["country"], codes["crop"]]
+    capex_usd = np.array([
+        [estimate_capex_per_m2_usd(level, c, param_set) for level in uniques["setup_level"]]
+        for c in fill_countries
+    ]).reshape(-1, n_setup)[codes["country"], codes["setup_level"]]
+    cost_per_m2_usd = np.array([
+        estimate_production_cost_per_m2_usd(s, param_set) for s in uniques["system_type"]
+    ])[codes["system_type"]]
+
+    auto_cost = _round_like_format(cost_per_m2_usd * area / fill_rate, 2)
+    auto_price = _round_like_format(price_usd / fill_rate, 3)
+    auto_capex = _round_like_format(capex_usd / fill_rate, 0)
+
+    cost_override = overrides["annual_production_cost"]
+    price_override = overrides["price_per_unit"]
+    capex_override = overrides["capex_per_m2"]
+    gross_cost_local = np.where(cost_override > 0, cost_override, auto_cost)
+    price_per_kg_local = np.where(price_override > 0, price_override, auto_price)
+    capex_per_m2_local = np.where(capex_override > 0, capex_override, auto_capex)
+
+    # Same operation order as compute_results so the floats match exactly.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        plants = area * plants_per_m2
+        annual_yield = area * yield_per_m2_per_crop * crops_per_year
+
+        nutrient_per_crop_total = nutrient_per_m2_per_crop * area
+        annual_nutrient_total = nutrient_per_crop_total * crops_per_year
+        nutrient_per_plant_per_crop = np.where(
+            plants_per_m2 > 0, nutrient_per_m2_per_crop / plants_per_m2, 0.0
+        )
+
+        price_per_kg_usd = price_per_kg_local * fx_rate
+        gross_cost_usd = gross_cost_local * fx_rate
+        solar_savings_rate = tables["SOLAR_SAVINGS_RATE"]
+        solar_savings_usd = np.where(use_solar, gross_cost_usd * solar_savings_rate, 0.0)
+        net_cost_usd = gross_cost_usd - solar_savings_usd
+
+        capex_per_m2_usd = capex_per_m2_local * fx_rate
+        total_setup_cost_usd = capex_per_m2_usd * area
+
+        annual_revenue_usd = annual_yield * price_per_kg_usd
+        annual_profit_usd = annual_revenue_usd - net_cost_usd
+
+        has_yield = annual_yield > 0
+        cost_per_kg_usd = np.where(has_yield, net_cost_usd / annual_yield, np.nan)
+        profit_per_kg_usd = np.where(has_yield, annual_profit_usd / annual_yield, np.nan)
+        simple_payback_years = np.where(
+            annual_profit_usd > 0, total_setup_cost_usd / annual_profit_usd, np.nan
+        )
+
+        annual_revenue = annual_revenue_usd / fx_rate
+        annual_profit = annual_profit_usd / fx_rate
+        net_production_cost = net_cost_usd / fx_rate
+        has_area = area > 0
+        has_plants = plants > 0
+
+        def text_column(key, values=None):
+            return np.array(values or uniques[key], dtype=object)[codes[key]]
+
+        results = {
+            "currency_code": currency_code[pair_codes],
+            "currency_symbol": currency_symbol[pair_codes],
+            "country_code": text_column("country"),
+
+            "area": area,
+            "crop": text_column("crop"),
+            "system_type": text_column("system_type"),
+            "setup_level": text_column("setup_level"),
+            "setup_label": text_column(
+                "setup_level",
+                [tables["SETUP_LEVEL_LABELS"].get(s, s) for s in uniques["setup_level"]],
+            ),
+            "use_solar": use_solar,
+
+            "plants_per_m2": plants_per_m2,
+            "crops_per_year": crops_per_year,
+            "yield_per_m2_per_crop": yield_per_m2_per_crop,
+            "plants": plants,
+            "annual_yield": annual_yield,
+
+            "nutrient_per_m2_per_crop": nutrient_per_m2_per_crop,
+            "nutrient_per_crop_total": nutrient_per_crop_total,
+            "annual_nutrient_total": annual_nutrient_total,
+            "nutrient_per_plant_per_crop": nutrient_per_plant_per_crop,
+
+            "gross_production_cost": gross_cost_usd / fx_rate,
+            "solar_savings": solar_savings_usd / fx_rate,
+            "net_production_cost": net_production_cost,
+
+            "price_per_kg": price_per_kg_usd / fx_rate,
+
+            "annual_revenue": annual_revenue,
+            "annual_profit": annual_profit,
+
+            "cost_per_kg": cost_per_kg_usd / fx_rate,
+            "profit_per_kg": profit_per_kg_usd / fx_rate,
+
+            "cost_per_m2_per_year": np.where(has_area, net_production_cost / area, 0.0),
+            "profit_per_m2_per_year": np.where(has_area, annual_profit / area, 0.0),
+
+            "cost_per_plant_per_year": np.where(has_plants, net_production_cost / plants, 0.0),
+            "profit_per_plant_per_year": np.where(has_plants, annual_profit / plants, 0.0),
+
+            "revenue_per_m2_per_year": np.where(has_area, annual_revenue / area, 0.0),
+            "revenue_per_plant_per_year": np.where(has_plants, annual_revenue / plants, 0.0),
+
+            "capex_per_m2": capex_per_m2_usd / fx_rate,
+            "total_setup_cost": total_setup_cost_usd / fx_rate,
+            "simple_payback_years": simple_payback_years,
+
+            "SOLAR_SAVINGS_RATE": np.full(n, solar_savings_rate),
+        }
+
+    for key, arr in results.items():
+        if arr.dtype.kind == "f" and key != "SOLAR_SAVINGS_RATE":
+            arr[~valid] = np.nan
+    results["valid"] = valid
+    results["fx_missing"] = fx_missing
+    results["int_params"] = crop_ints[crop_codes] & valid[:, None]
+    return results
+
+
+def batch_row_error(results, i):
+    """The error compute_results gives for row `i`, or None if it is valid."""
+    if results["valid"][i]:
+        return None
+    if results["fx_missing"][i]:
+        return missing_rate_message(results["currency_code"][i])
+    return "Please fill in the greenhouse area."
+
+
+def batch_results_row(results, i):
+    """
+    Row `i` of a compute_results_batch result as the (results, error) pair
+    compute_results returns for the same inputs.
+    """
+    error = batch_row_error(results, i)
+    if error:
+        return None, error
+    row = {}
+    for key, arr in results.items():
+        if key in BATCH_FLAG_FIELDS:
+            continue
+        value = arr[i]
+        if key in BATCH_TEXT_FIELDS:
+            row[key] = str(value)
+        elif key == "use_solar":
+            row[key] = bool(value)
+        elif key in BATCH_PARAM_FIELDS and results["int_params"][i, BATCH_PARAM_FIELDS.index(key)]:
+            row[key] = int(value)
+        elif key in BATCH_NULLABLE_FIELDS and np.isnan(value):
+            row[key] = None
+        else:
+            row[key] = float(value)
+    return row, None
+
+
+def form_batch_columns(forms):
+    """compute_results_batch columns for a list of form dicts."""
+    columns = {key: [] for key in ("area_m2", "use_solar", *BATCH_TEXT_DEFAULTS, *BATCH_OVERRIDE_FIELDS)}
+    for form in forms:
+        columns["area_m2"].append(parse_number(form.get("area_m2")))
+        columns["use_solar"].append(form.get("use_solar") is True)
+        for key, default in BATCH_TEXT_DEFAULTS.items():
+            value = form.get(key, default)
+            columns[key].append(default if value is None else value)
+        for key in BATCH_OVERRIDE_FIELDS:
+            columns[key].append(parse_number(form.get(key)))
+    return columns
+
+
+# =====================
+#  Scenarios
+# =====================
+# Override field -> the form checkbox that makes it a user value. Unchecked
+# overrides hold the estimate written back at the time and are re-estimated.
+CUSTOM_OVERRIDE_FLAGS = {
+    "annual_production_cost": "use_custom_production_cost",
+    "price_per_unit": "use_custom_price",
+    "capex_per_m2": "use_custom_capex",
+}
+
+
+def scenario_form(scenario):
+    """
+    Turn a JSON scenario (form field names, numbers allowed) into the string
+    form dict compute_results expects. A positive override counts as
+    custom, as the web form would mark it.
+    """
+    form = {}
+    for key, value in scenario.items():
+        if value is None:
+            continue
+        if key == "use_solar":
+            form[key] = value is True or str(value).strip().lower() in ("1", "true", "on", "yes")
+        else:
+            form[key] = str(value)
+    for field, flag in CUSTOM_OVERRIDE_FLAGS.items():
+        form[flag] = parse_number(form.get(field)) > 0
+    return form
+
+
+def check_scenarios(scenarios):
+    """Raise ValueError unless `scenarios` is a non-empty list of JSON objects."""
+    if not isinstance(scenarios, list):
+        raise ValueError("scenarios must be a list of objects")
+    if not scenarios:
+        raise ValueError("no scenarios given")
+    for i, scenario in enumerate(scenarios):
+        if not isinstance(scenario, dict):
+            raise ValueError(f"scenario {i} must be an object with form fields")
+
+
+# =====================
+#  Result cache
+# =====================
+RESULT_CACHE_SIZE = int(os.environ.get("MARO_RESULT_CACHE_SIZE", "1024"))
+RESULT_CACHE_TTL = float(os.environ.get("MARO_RESULT_CACHE_TTL", "3600"))
+
+
+class ResultCache:
+    """Thread-safe LRU cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": self.hits / lookups if lookups else None,
+            }
+
+
+RESULT_CACHE = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+
+
+# Form key where calculate() lists the overrides it estimated.
+ESTIMATED_FIELDS = "estimated_fields"
+
+
+def calculation_key(form, param_set=None):
+    """
+    Normalized inputs of one calculation plus the parameter and country
+    versions and the exchange rate of its currency.
+    """
+    param_set = param_set or parameters.PARAMS
+    area = parse_number(form.get("area_m2"))
+    country = find_country(form.get("country"))
+    currency_override = (form.get("currency_override") or "").strip().upper()
+    currency_code = currency_override or (country["currency_code"] if country else "USD")
+    return (
+        param_set.version,
+        parameters.COUNTRY_SNAPSHOT.version,
+        param_set.fx.rates.get(currency_code),
+        area,
+        form.get("crop", "tomato"),
+        form.get("system_type", "soilless"),
+        form.get("setup_level", "standard"),
+        form.get("country"),
+        currency_override,
+        form.get("use_solar") is True,
+        # Non-positive overrides mean "estimate it"; those all behave alike.
+        max(parse_number(form.get("annual_production_cost")), 0),
+        max(parse_number(form.get("price_per_unit")), 0),
+        max(parse_number(form.get("capex_per_m2")), 0),
+    )
+
+
+def calculate(form, param_set=None):
+    """
+    fill_auto_economics_for_form + compute_results, memoized on
+    calculation_key. Estimated overrides are written back into `form` and
+    listed in form["estimated_fields"], on a hit as on a miss.
+    """
+    param_set = param_set or parameters.PARAMS
+    key = calculation_key(form, param_set)
+    estimated = [field for field in BATCH_OVERRIDE_FIELDS if parse_number(form.get(field)) <= 0]
+    cached = RESULT_CACHE.get(key)
+    if cached is not None:
+        filled, results = cached
+        form.update(filled)
+        form[ESTIMATED_FIELDS] = estimated
+        return dict(results), None
+
+    before = {field: form.get(field) for field in BATCH_OVERRIDE_FIELDS}
+    with phase("fill_auto_economics"):
+        fill_auto_economics_for_form(form, param_set)
+    with phase("compute_results"):
+        results, error = compute_results(form, param_set)
+    if results and not error:
+        filled = {
+            field: form[field]
+            for field in BATCH_OVERRIDE_FIELDS
+            if form.get(field) != before[field]
+        }
+        RESULT_CACHE.put(key, (filled, dict(results)))
+        form[ESTIMATED_FIELDS] = estimated
+    return results, error
+
+
+def submitted_form(form):
+    """A stored (filled-in) form as it was submitted: estimated overrides blank."""
+    estimated = form.get(ESTIMATED_FIELDS)
+    if estimated is None:
+        # Stored before the estimates were recorded; the checkboxes tell.
+        estimated = [field for field, flag in CUSTOM_OVERRIDE_FLAGS.items() if not form.get(flag)]
+    return {**form, **{field: "" for field in estimated}}
+
+
+# =====================
+#  What-if
+# =====================
+# Form field a what-if may scale -> graph node of its value in use.
+WHATIF_SCALABLE = {
+    "area_m2": "area",
+    "price_per_unit": "price_per_kg_local",
+    "annual_production_cost": "gross_cost_local",
+    "capex_per_m2": "capex_per_m2_local",
+}
+
+
+def whatif(form, base, changes=None, scale=None, fields=None):
+    """
+    Reprice `base` (the LazyResults of the submitted `form`) with form
+    fields set to new values (`changes`), then numeric ones multiplied
+    (`scale`); scaling an estimated override scales its estimate.
+    Returns (LazyResults, results, error); raises ValueError for bad specs.
+    """
+    changes = changes or {}
+    scale = scale or {}
+    if not isinstance(changes, dict) or not isinstance(scale, dict):
+        raise ValueError("'changes' and 'scale' must be objects keyed by form field")
+    unknown = sorted(set(changes) - set(RESULT_INPUTS))
+    if unknown:
+        raise ValueError(f"unknown input fields: {', '.join(unknown)}; use {', '.join(RESULT_INPUTS)}")
+    if fields is not None and (
+        not isinstance(fields, list) or not all(isinstance(name, str) for name in fields)
+    ):
+        raise ValueError("'fields' must be a list of result field names")
+    unscalable = sorted(set(scale) - set(WHATIF_SCALABLE))
+    if unscalable:
+        raise ValueError(f"only {', '.join(WHATIF_SCALABLE)} can be scaled")
+    for field, factor in scale.items():
+        if isinstance(factor, bool) or not isinstance(factor, (int, float)) or not math.isfinite(factor):
+            raise ValueError(f"scale factor for {field} must be a number")
+
+    result = base.with_changes(
+        form_result_inputs({**form, **scenario_form(changes)}) if changes else {}
+    )
+    if scale:
+        scaled = result.with_changes({
+            RESULT_INPUTS[field]: result[WHATIF_SCALABLE[field]] * factor
+            for field, factor in scale.items()
+        })
+        scaled.changed = sorted(set(result.changed) | set(scaled.changed))
+        scaled.evaluated += result.evaluated
+        result = scaled
+    results, error = result.get(fields or RESULT_FIELDS)
+    return result, results, error
+
+
+# =====================
+#  Process pool
+# =====================
+PROCESS_POOL_WORKERS = int(os.environ.get("MARO_PROCESS_POOL_WORKERS", str(os.cpu_count() or 1)))
+
+_process_pool = None
+_process_pool_pid = None
+_process_pool_lock = threading.Lock()
+
+
+def process_pool():
+    """
+    The process's one pool for CPU-bound work (risk runs, large NDJSON
+    chunks), created on first use and again after a fork.
+    """
+    # Imported here: multiprocessing is slow to import.
+    from concurrent.futures import ProcessPoolExecutor
+
+    global _process_pool, _process_pool_pid
+    with _process_pool_lock:
+        if _process_pool is None or _process_pool_pid != os.getpid():
+            _process_pool = ProcessPoolExecutor(max_workers=PROCESS_POOL_WORKERS)
+            _process_pool_pid = os.getpid()
+        return _process_pool
+
+
+def shutdown_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        pool, _process_pool = _process_pool, None
+        if pool is not None and _process_pool_pid == os.getpid():
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+atexit.register(shutdown_process_pool)
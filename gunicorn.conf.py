@@ -0,0 +1,18 @@
+"""
+gunicorn reads this file from the working directory:
+
+    gunicorn app:app --workers 4
+"""
+
+
+def worker_exit(server, worker):
+    # A worker stopped by the arbiter (restart, max_requests, shutdown)
+    # writes out its queued calculation records first.
+    import app
+    app.shutdown_worker()
+
+
+def worker_abort(worker):
+    # Timed-out workers get SIGABRT; flush what can be flushed.
+    import app
+    app.shutdown_worker()
@@ -0,0 +1,583 @@
+"""The streaming calculation API and background batch jobs."""
+import csv
+import datetime
+import fcntl
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import parameters
+from engine import (
+    BATCH_FLAG_FIELDS, BATCH_NULLABLE_FIELDS, BATCH_PARAM_FIELDS, BATCH_TEXT_FIELDS,
+    batch_row_error, compute_results_batch, form_batch_columns, scenario_form,
+)
+from parameters import ensure_params_version, params_versions
+from storage import calculation_record, log_calculations, open_db
+
+try:
+    import orjson
+except ImportError:  # optional; json is used instead
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+# =====================
+#  Calculation API
+# =====================
+# Neither API route logs to `calculations` unless asked with ?log=1.
+API_LOG_DEFAULT = os.environ.get("MARO_API_LOG", "0") == "1"
+API_STREAM_CHUNK = int(os.environ.get("MARO_API_STREAM_CHUNK", "4096"))
+API_STREAM_MAX_SCENARIOS = int(os.environ.get("MARO_API_STREAM_MAX_SCENARIOS", "1000000"))
+
+
+def dumps_json(obj):
+    """obj as compact JSON bytes, through orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def loads_json(data):
+    """json.loads, through orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def api_log_requested(args):
+    value = args.get("log")
+    if value is None:
+        return API_LOG_DEFAULT
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def batch_result_rows(results):
+    """
+    Every row of a compute_results_batch result as batch_results_row
+    would give it, converting each column to Python values once.
+    """
+    n = len(results["valid"])
+    columns = {}
+    for key, arr in results.items():
+        if key in BATCH_FLAG_FIELDS:
+            continue
+        if key in BATCH_TEXT_FIELDS:
+            columns[key] = [str(value) for value in arr.tolist()]
+        elif key == "use_solar":
+            columns[key] = [bool(value) for value in arr.tolist()]
+        elif key in BATCH_PARAM_FIELDS:
+            ints = results["int_params"][:, BATCH_PARAM_FIELDS.index(key)].tolist()
+            columns[key] = [
+                int(value) if is_int else value
+                for value, is_int in zip(arr.astype(float).tolist(), ints)
+            ]
+        elif key in BATCH_NULLABLE_FIELDS:
+            columns[key] = [None if value != value else value for value in arr.astype(float).tolist()]
+        else:
+            columns[key] = arr.astype(float).tolist()
+    keys = list(columns)
+    values = list(zip(*columns.values())) if columns else [()] * n
+    valid = results["valid"].tolist()
+    for i in range(n):
+        if valid[i]:
+            yield dict(zip(keys, values[i])), None
+        else:
+            yield None, batch_row_error(results, i)
+
+
+def parse_scenario_line(line):
+    scenario = loads_json(line)
+    if not isinstance(scenario, dict):
+        raise ValueError("each line must be a JSON object")
+    return scenario_form(scenario)
+
+
+def calculate_ndjson_chunk(numbered_lines, log=False):
+    """
+    NDJSON result lines (bytes, newline-terminated) for a list of
+    (line number, scenario line) pairs, computed in one
+    compute_results_batch call; plus the calculation records to log
+    when `log` is set and the number of error lines.
+    """
+    parsed = []
+    for number, line in numbered_lines:
+        try:
+            parsed.append((number, parse_scenario_line(line), None))
+        except ValueError as exc:
+            parsed.append((number, None, f"invalid scenario: {exc}"))
+
+    forms = [form for _, form, _ in parsed if form is not None]
+    rows = batch_result_rows(compute_results_batch(form_batch_columns(forms))) if forms else iter(())
+    out, records, errors = [], [], 0
+    for number, form, error in parsed:
+        if form is not None:
+            results, error = next(rows)
+            if results is not None:
+                out.append(dumps_json(results))
+                if log:
+                    records.append(calculation_record(results, form))
+                continue
+        out.append(dumps_json({"error": error, "line": number}))
+        errors += 1
+    out.append(b"")
+    return b"\n".join(out), records, errors
+
+
+def chunk_scenario_lines(lines, size=API_STREAM_CHUNK):
+    """Lists of (line number, line) pairs; blank lines are skipped."""
+    chunk = []
+    for number, line in enumerate(lines, 1):
+        if line.strip():
+            chunk.append((number, line))
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_calculate_stream(lines, log=False):
+    """
+    NDJSON result lines for NDJSON scenario lines, API_STREAM_CHUNK at a
+    time. Line numbers in errors count from 1 over all lines.
+    """
+    for chunk in chunk_scenario_lines(lines):
+        payload, records, _ = calculate_ndjson_chunk(chunk, log)
+        log_calculations(records)
+        yield payload
+
+
+# =====================
+#  Batch jobs
+# =====================
+# MARO_JOB_RUNNER=web runs one runner per host in a web worker;
+# MARO_JOB_RUNNER=cli leaves them to 'flask run-jobs'.
+JOBS_DIR = os.environ.get(
+    "MARO_JOBS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "jobs")
+)
+JOB_RUNNER_MODE = os.environ.get("MARO_JOB_RUNNER", "web")
+JOB_WORKERS = int(os.environ.get("MARO_JOB_WORKERS", str(os.cpu_count() or 1)))
+JOB_CHUNK_ROWS = int(os.environ.get("MARO_JOB_CHUNK_ROWS", "20000"))
+JOB_MAX_ROWS = int(os.environ.get("MARO_JOB_MAX_ROWS", "2000000"))
+JOB_MAX_UPLOAD_BYTES = int(os.environ.get("MARO_JOB_MAX_UPLOAD_BYTES", str(512 * 1024 * 1024)))
+# 0 keeps finished jobs until they are deleted.
+JOB_RETENTION_SECONDS = float(os.environ.get("MARO_JOB_RETENTION_SECONDS", str(7 * 86400)))
+JOB_SWEEP_INTERVAL = 300.0
+JOB_LEASE_SECONDS = float(os.environ.get("MARO_JOB_LEASE_SECONDS", "60"))
+JOB_HEARTBEAT_SECONDS = JOB_LEASE_SECONDS / 4
+JOB_POLL_INTERVAL = float(os.environ.get("MARO_JOB_POLL_INTERVAL", "2.0"))
+JOB_FORMATS = ("csv", "ndjson")
+JOB_ACTIVE_STATUSES = ("queued", "running")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobUploadTooLarge(ValueError):
+    pass
+
+
+def job_dir(job_id):
+    return os.path.join(JOBS_DIR, job_id)
+
+
+def job_chunk_path(job_id, chunk):
+    return os.path.join(job_dir(job_id), "out", f"{chunk:06d}.ndjson")
+
+
+def job_format_for(filename, content_type, requested=None):
+    """csv or ndjson from an explicit format, the file name or the content type."""
+    fmt = (requested or "").strip().lower()
+    if not fmt:
+        ext = os.path.splitext(filename or "")[1].lower().lstrip(".")
+        if ext in ("csv", "ndjson", "jsonl"):
+            fmt = ext
+        elif "csv" in (content_type or ""):
+            fmt = "csv"
+        elif "ndjson" in (content_type or "") or "jsonl" in (content_type or ""):
+            fmt = "ndjson"
+    fmt = "ndjson" if fmt == "jsonl" else fmt
+    if fmt not in JOB_FORMATS:
+        raise ValueError(f"upload format must be one of: {', '.join(JOB_FORMATS)}")
+    return fmt
+
+
+def create_job(conn, upload, fmt, max_bytes=JOB_MAX_UPLOAD_BYTES):
+    """
+    Store an upload (a file-like object or a werkzeug FileStorage) as a
+    new queued job and return its id. Raises JobUploadTooLarge past
+    `max_bytes`, keeping nothing.
+    """
+    job_id = os.urandom(8).hex()
+    directory = job_dir(job_id)
+    os.makedirs(os.path.join(directory, "out"))
+    path = os.path.join(directory, f"upload.{fmt}")
+    source = upload.stream if hasattr(upload, "save") else upload
+    size = 0
+    try:
+        with open(path, "wb") as f:
+            while True:
+                data = source.read(1 << 20)
+                if not data:
+                    break
+                size += len(data)
+                if size > max_bytes:
+                    raise JobUploadTooLarge(f"uploads are limited to {max_bytes} bytes")
+                f.write(data)
+    except BaseException:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+    with conn:
+        conn.execute(
+            "INSERT INTO jobs (id, created_at, status, format) VALUES (?, ?, 'queued', ?)",
+            (job_id, datetime.datetime.utcnow().isoformat(), fmt),
+        )
+    return job_id
+
+
+def _csv_scenario_lines(f):
+    # Blank cells mean "use the default", like a field left out.
+    for row in csv.DictReader(f):
+        scenario = {key.strip(): value for key, value in row.items() if key and value not in (None, "")}
+        yield json.dumps(scenario, separators=(",", ":"))
+
+
+def _ndjson_scenario_lines(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield line
+
+
+def split_job_input(conn, job, heartbeat):
+    """
+    Normalize the upload to scenarios.ndjson and record its chunks.
+    The chunks land in one transaction, so an interrupted split is just
+    done again.
+    """
+    directory = job_dir(job["id"])
+    upload = os.path.join(directory, f"upload.{job['format']}")
+    lines = _csv_scenario_lines if job["format"] == "csv" else _ndjson_scenario_lines
+    chunks, rows, offset, chunk_start = [], 0, 0, 0
+    # utf-8-sig: spreadsheet exports often start with a byte order mark.
+    with open(upload, encoding="utf-8-sig", newline="") as src, \
+            open(os.path.join(directory, "scenarios.ndjson"), "wb") as dst:
+        for line in lines(src):
+            data = line.encode("utf-8") + b"\n"
+            dst.write(data)
+            offset += len(data)
+            rows += 1
+            if rows > JOB_MAX_ROWS:
+                raise ValueError(f"at most {JOB_MAX_ROWS} scenarios per job")
+            if rows % JOB_CHUNK_ROWS == 0:
+                chunks.append((len(chunks), chunk_start, offset, rows - JOB_CHUNK_ROWS + 1, JOB_CHUNK_ROWS))
+                chunk_start = offset
+                heartbeat()
+        if rows % JOB_CHUNK_ROWS:
+            chunks.append((len(chunks), chunk_start, offset, rows - rows % JOB_CHUNK_ROWS + 1, rows % JOB_CHUNK_ROWS))
+
+    with conn:
+        conn.execute("DELETE FROM job_chunks WHERE job_id = ?", (job["id"],))
+        conn.executemany(
+            "INSERT INTO job_chunks (job_id, chunk, start_offset, end_offset, first_line, rows) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(job["id"], *chunk) for chunk in chunks],
+        )
+        conn.execute(
+            "UPDATE jobs SET rows = ?, chunks = ? WHERE id = ?", (rows, len(chunks), job["id"])
+        )
+
+
+def _run_job_chunk(task):
+    path, start, end, first_line, out_path, versions = task
+    ensure_params_version(versions)
+    param_set = parameters.PARAMS
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    payload, _, errors = calculate_ndjson_chunk(list(enumerate(data.splitlines(), first_line)))
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(payload)
+    os.replace(tmp_path, out_path)
+    return param_set.version, errors
+
+
+class JobRunner:
+    """Background thread that claims jobs and runs their chunks."""
+
+    def __init__(self, workers=JOB_WORKERS):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        self._host_lock = None
+        self._elect_at = float("-inf")
+        self._wake = threading.Event()
+        self._swept_at = float("-inf")
+
+    def ensure_started(self):
+        """
+        Start the runner thread if this process holds the host lock. The
+        other workers try again every JOB_POLL_INTERVAL, so one of them
+        takes over when the runner's worker exits.
+        """
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = self._host_lock = None
+                self._elect_at = float("-inf")
+            if self._thread is not None or time.monotonic() < self._elect_at:
+                return
+            self._elect_at = time.monotonic() + JOB_POLL_INTERVAL
+            if not self._take_host_lock():
+                return
+            self._wake = threading.Event()
+            self._thread = threading.Thread(target=self._run, name="job-runner", daemon=True)
+            self._thread.start()
+
+    def _take_host_lock(self):
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        f = open(os.path.join(JOBS_DIR, f"runner-{socket.gethostname()}.lock"), "a")
+        try:
+            fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._host_lock = f
+        return True
+
+    @property
+    def owner(self):
+        return f"{socket.gethostname()}:{os.getpid()}:{id(self):x}"
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            try:
+                conn = open_db()
+                try:
+                    self.run_pending(conn)
+                finally:
+                    conn.close()
+            except Exception:
+                logger.exception("job runner failed")
+            self._wake.wait(JOB_POLL_INTERVAL)
+            self._wake.clear()
+
+    def run_pending(self, conn):
+        """Run claimable jobs until there are none left; returns how many ran."""
+        if time.monotonic() - self._swept_at >= JOB_SWEEP_INTERVAL:
+            self._swept_at = time.monotonic()
+            sweep_jobs(conn)
+        ran = 0
+        while True:
+            job = self.claim(conn)
+            if job is None:
+                return ran
+            self.run_job(conn, job)
+            ran += 1
+
+    def claim(self, conn):
+        now = time.time()
+        with conn:
+            row = conn.execute(
+                f"""
+                SELECT * FROM jobs
+                WHERE status IN ({', '.join('?' for _ in JOB_ACTIVE_STATUSES)})
+                  AND (owner IS NULL OR owner = ? OR heartbeat_at < ?)
+                ORDER BY created_at
+                LIMIT 1
+                """,
+                (*JOB_ACTIVE_STATUSES, self.owner, now - JOB_LEASE_SECONDS),
+            ).fetchone()
+            if row is None:
+                return None
+            claimed = conn.execute(
+                """
+                UPDATE jobs
+                SET status = 'running', owner = ?, heartbeat_at = ?,
+                    started_at = coalesce(started_at, ?)
+                WHERE id = ? AND status IN ('queued', 'running')
+                  AND (owner IS NULL OR owner = ? OR heartbeat_at < ?)
+                """,
+                (
+                    self.owner, now, datetime.datetime.utcnow().isoformat(),
+                    row["id"], self.owner, now - JOB_LEASE_SECONDS,
+                ),
+            ).rowcount
+        return row if claimed else None
+
+    def heartbeat(self, conn, job_id):
+        """Renew the lease; raises JobCancelled once the job was cancelled."""
+        with conn:
+            renewed = conn.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND owner = ? AND status = 'running'",
+                (time.time(), job_id, self.owner),
+            ).rowcount
+        if not renewed:
+            raise JobCancelled(job_id)
+
+    def finish(self, conn, job_id, status, error=None):
+        with conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ?, owner = NULL "
+                "WHERE id = ? AND owner = ? AND status = 'running'",
+                (status, error, datetime.datetime.utcnow().isoformat(), job_id, self.owner),
+            )
+
+    def run_job(self, conn, job):
+        job_id = job["id"]
+        try:
+            if job["chunks"] is None:
+                split_job_input(conn, job, lambda: self.heartbeat(conn, job_id))
+            self._run_chunks(conn, job_id)
+        except JobCancelled:
+            return
+        except Exception as exc:
+            logger.exception("job %s failed", job_id)
+            self.finish(conn, job_id, "failed", f"{type(exc).__name__}: {exc}")
+            return
+        self.finish(conn, job_id, "done")
+
+    def _run_chunks(self, conn, job_id):
+        from concurrent.futures import ProcessPoolExecutor
+
+        path = os.path.join(job_dir(job_id), "scenarios.ndjson")
+        todo = conn.execute(
+            "SELECT chunk, start_offset, end_offset, first_line, rows FROM job_chunks "
+            "WHERE job_id = ? AND finished_at IS NULL ORDER BY chunk",
+            (job_id,),
+        ).fetchall()
+        if not todo:
+            return
+        tasks = iter(todo)
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(todo))) as pool:
+            running = {}
+
+            def submit():
+                for chunk in tasks:
+                    task = (
+                        path, chunk["start_offset"], chunk["end_offset"], chunk["first_line"],
+                        job_chunk_path(job_id, chunk["chunk"]), params_versions(),
+                    )
+                    running[pool.submit(_run_job_chunk, task)] = chunk
+                    if len(running) >= self.workers * 2:
+                        return
+
+            submit()
+            try:
+                while running:
+                    done, _ = wait(running, timeout=JOB_HEARTBEAT_SECONDS, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        chunk = running.pop(future)
+                        params_version, errors = future.result()
+                        with conn:
+                            # A runner whose lease ran out may finish the
+                            # same chunk; only the first one counts.
+                            finished = conn.execute(
+                                "UPDATE job_chunks SET finished_at = ?, error_rows = ?, params_version = ? "
+                                "WHERE job_id = ? AND chunk = ? AND finished_at IS NULL",
+                                (datetime.datetime.utcnow().isoformat(), errors, params_version,
+                                 job_id, chunk["chunk"]),
+                            ).rowcount
+                            if not finished:
+                                continue
+                            conn.execute(
+                                "UPDATE jobs SET done_rows = done_rows + ?, error_rows = error_rows + ? "
+                                "WHERE id = ?",
+                                (chunk["rows"], errors, job_id),
+                            )
+                    self.heartbeat(conn, job_id)
+                    submit()
+            finally:
+                for future in running:
+                    future.cancel()
+
+
+JOB_RUNNER = JobRunner()
+
+
+def job_status(conn, job_id):
+    job = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if job is None:
+        return None
+    chunks = conn.execute(
+        "SELECT count(*) AS done, group_concat(DISTINCT params_version) AS versions "
+        "FROM job_chunks WHERE job_id = ? AND finished_at IS NOT NULL",
+        (job_id,),
+    ).fetchone()
+    return {
+        "id": job["id"],
+        "status": job["status"],
+        "format": job["format"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+        "rows": job["rows"],
+        "done_rows": job["done_rows"],
+        "error_rows": job["error_rows"],
+        "chunks": job["chunks"],
+        "done_chunks": chunks["done"],
+        "progress": job["done_rows"] / job["rows"] if job["rows"] else (1.0 if job["status"] == "done" else 0.0),
+        "params_versions": sorted(chunks["versions"].split(",")) if chunks["versions"] else [],
+        "error": job["error"],
+    }
+
+
+def delete_job(conn, job_id):
+    """
+    Remove a job's files. An unfinished job stays listed as cancelled (a
+    runner still working on it stops at its next heartbeat); a finished
+    one is forgotten. Returns False for an unknown job.
+    """
+    with conn:
+        job = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if job is None:
+            return False
+        if job["status"] in JOB_ACTIVE_STATUSES:
+            conn.execute(
+                "UPDATE jobs SET status = 'cancelled', owner = NULL, finished_at = ? WHERE id = ?",
+                (datetime.datetime.utcnow().isoformat(), job_id),
+            )
+        else:
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        conn.execute("DELETE FROM job_chunks WHERE job_id = ?", (job_id,))
+    shutil.rmtree(job_dir(job_id), ignore_errors=True)
+    return True
+
+
+def sweep_jobs(conn, retention=JOB_RETENTION_SECONDS):
+    """Delete jobs that finished more than `retention` seconds ago; returns how many."""
+    if retention <= 0:
+        return 0
+    cutoff = (datetime.datetime.utcnow() - datetime.timedelta(seconds=retention)).isoformat()
+    expired = conn.execute(
+        f"SELECT id FROM jobs WHERE status NOT IN ({', '.join('?' for _ in JOB_ACTIVE_STATUSES)}) "
+        "AND finished_at < ?",
+        (*JOB_ACTIVE_STATUSES, cutoff),
+    ).fetchall()
+    for row in expired:
+        delete_job(conn, row["id"])
+    return len(expired)
+
+
+def iter_job_results(job_id, chunks, block_size=1 << 20):
+    for chunk in range(chunks):
+        with open(job_chunk_path(job_id, chunk), "rb") as f:
+            while True:
+                data = f.read(block_size)
+                if not data:
+                    break
+                yield data
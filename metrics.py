@@ -0,0 +1,165 @@
+"""Request metrics for /admin/metrics and sampled profiles for /admin/profiles."""
+import bisect
+import contextvars
+import datetime
+import heapq
+import os
+import threading
+import time
+from contextlib import contextmanager
+from io import StringIO
+
+from flask import has_request_context, request
+
+# Latency histogram bucket bounds, in seconds.
+METRICS_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+# Fraction of requests run under cProfile (0 disables it).
+PROFILE_SAMPLE_RATE = float(os.environ.get("MARO_PROFILE_SAMPLE_RATE", "0"))
+PROFILE_KEEP = int(os.environ.get("MARO_PROFILE_KEEP", "10"))
+# Directory the kept profiles are also dumped to as .prof files.
+PROFILE_DIR = os.environ.get("MARO_PROFILE_DIR")
+
+
+class Metrics:
+    """Request counters and latency histograms, rendered for Prometheus."""
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = {}
+            self.histograms = {}
+
+    def observe(self, name, labels, seconds):
+        # labels is a tuple of (label, value) pairs.
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            hist = self.histograms.get((name, labels))
+            if hist is None:
+                hist = self.histograms[(name, labels)] = [[0] * (len(self.buckets) + 1), 0.0]
+            hist[0][i] += 1
+            hist[1] += seconds
+
+    def count_request(self, labels):
+        with self._lock:
+            self.requests[labels] = self.requests.get(labels, 0) + 1
+
+    def render(self, extra=()):
+        """Prometheus text exposition; `extra` adds (name, type, help, value) series."""
+        with self._lock:
+            requests = dict(self.requests)
+            histograms = {key: (list(c), total) for key, (c, total) in self.histograms.items()}
+
+        def fmt(labels):
+            return ",".join(f'{k}="{v}"' for k, v in labels)
+
+        lines = [
+            "# HELP maro_requests_total Requests handled, by route, method and status.",
+            "# TYPE maro_requests_total counter",
+        ]
+        for labels, count in sorted(requests.items()):
+            lines.append(f"maro_requests_total{{{fmt(labels)}}} {count}")
+
+        helps = {
+            "maro_request_seconds": "Request latency by route.",
+            "maro_phase_seconds": "Latency of hot-path phases by route.",
+        }
+        for name, help_text in helps.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            for (hist_name, labels), (counts, total) in sorted(histograms.items()):
+                if hist_name != name:
+                    continue
+                prefix = fmt(labels) + "," if labels else ""
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                cumulative += counts[-1]
+                lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {cumulative}')
+                lines.append(f"{name}_sum{{{fmt(labels)}}} {total}")
+                lines.append(f"{name}_count{{{fmt(labels)}}} {cumulative}")
+
+        for name, kind, help_text, value in extra:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+# Route label outside a Flask request, e.g. the routes asgi.py serves itself.
+METRICS_ROUTE = contextvars.ContextVar("metrics_route", default="background")
+
+
+def route_label():
+    if has_request_context():
+        return request.endpoint or "unknown"
+    return METRICS_ROUTE.get()
+
+
+@contextmanager
+def phase(name):
+    """Time the enclosed block into maro_phase_seconds{route, phase}."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        METRICS.observe(
+            "maro_phase_seconds",
+            (("route", route_label()), ("phase", name)),
+            time.perf_counter() - started,
+        )
+
+
+class SlowProfiles:
+    """Keeps the cProfile stats of the slowest sampled requests."""
+
+    def __init__(self, keep=PROFILE_KEEP, directory=PROFILE_DIR):
+        self.keep = keep
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._heap = []  # (seconds, seq, entry), slowest kept
+        self._seq = 0
+
+    def offer(self, profiler, route, method, path, seconds):
+        import pstats
+
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            if len(self._heap) >= self.keep and seconds <= self._heap[0][0]:
+                return
+        out = StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(30)
+        entry = {
+            "route": route,
+            "method": method,
+            "path": path,
+            "seconds": seconds,
+            "at": datetime.datetime.utcnow().isoformat(),
+            "stats": out.getvalue(),
+        }
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            entry["file"] = os.path.join(
+                self.directory, f"{route}-{os.getpid()}-{seq}-{seconds * 1000:.0f}ms.prof"
+            )
+            profiler.dump_stats(entry["file"])
+        with self._lock:
+            if len(self._heap) < self.keep:
+                heapq.heappush(self._heap, (seconds, seq, entry))
+            elif seconds > self._heap[0][0]:
+                heapq.heapreplace(self._heap, (seconds, seq, entry))
+
+    def slowest(self):
+        with self._lock:
+            return [entry for _, _, entry in sorted(self._heap, reverse=True)]
+
+
+SLOW_PROFILES = SlowProfiles()
@@ -0,0 +1,1047 @@
+"""Parameter tables, exchange rates and the country list, and their reloading."""
+import copy
+import datetime
+import hashlib
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SOLAR_SAVINGS_RATE = 0.20  # 20%
+
+
+# =========================
+#  CROP YIELD + NUTRIENTS
+# =========================
+
+CROP_PARAMS = {
+    "GLOBAL": {
+        "soil": {
+            "tomato":         {"plants_per_m2": 2.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 30, "nutrients_kg_m2_crop": 0.6},
+            "pepper":         {"plants_per_m2": 2.5, "crops_per_year": 1,  "yield_per_m2_per_crop": 25, "nutrients_kg_m2_crop": 0.55},
+            "cucumber":       {"plants_per_m2": 1.8, "crops_per_year": 1,  "yield_per_m2_per_crop": 32, "nutrients_kg_m2_crop": 0.55},
+            "strawberry":     {"plants_per_m2": 7.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 20, "nutrients_kg_m2_crop": 0.40},
+            "lettuce":        {"plants_per_m2": 16,  "crops_per_year": 4,  "yield_per_m2_per_crop": 2.5,"nutrients_kg_m2_crop": 0.15},
+            "spinach":        {"plants_per_m2": 16,  "crops_per_year": 4,  "yield_per_m2_per_crop": 2.3,"nutrients_kg_m2_crop": 0.15},
+            "potato":         {"plants_per_m2": 3.5, "crops_per_year": 1,  "yield_per_m2_per_crop": 5,  "nutrients_kg_m2_crop": 0.45},
+            "fluted_pumpkin": {"plants_per_m2": 3.5, "crops_per_year": 3,  "yield_per_m2_per_crop": 1.6,"nutrients_kg_m2_crop": 0.18},
+            "basil":          {"plants_per_m2": 20,  "crops_per_year": 4,  "yield_per_m2_per_crop": 1.2,"nutrients_kg_m2_crop": 0.12},
+            "water_leaf":     {"plants_per_m2": 14,  "crops_per_year": 4,  "yield_per_m2_per_crop": 1.8,"nutrients_kg_m2_crop": 0.16},
+            "cannabis":       {"plants_per_m2": 5.0, "crops_per_year": 2,  "yield_per_m2_per_crop": 0.7,"nutrients_kg_m2_crop": 0.35},
+        },
+        "soilless": {
+            "tomato":         {"plants_per_m2": 2.5, "crops_per_year": 1,  "yield_per_m2_per_crop": 55, "nutrients_kg_m2_crop": 0.9},
+            "pepper":         {"plants_per_m2": 3.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 45, "nutrients_kg_m2_crop": 0.85},
+            "cucumber":       {"plants_per_m2": 2.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 65, "nutrients_kg_m2_crop": 0.85},
+            "strawberry":     {"plants_per_m2": 8.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 35, "nutrients_kg_m2_crop": 0.55},
+            "lettuce":        {"plants_per_m2": 20,  "crops_per_year": 7,  "yield_per_m2_per_crop": 3.0,"nutrients_kg_m2_crop": 0.20},
+            "spinach":        {"plants_per_m2": 20,  "crops_per_year": 6,  "yield_per_m2_per_crop": 2.8,"nutrients_kg_m2_crop": 0.20},
+            "potato":         {"plants_per_m2": 4.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 6.0,"nutrients_kg_m2_crop": 0.55},
+            "fluted_pumpkin": {"plants_per_m2": 4.0, "crops_per_year": 4,  "yield_per_m2_per_crop": 2.0,"nutrients_kg_m2_crop": 0.22},
+            "basil":          {"plants_per_m2": 25,  "crops_per_year": 6,  "yield_per_m2_per_crop": 1.5,"nutrients_kg_m2_crop": 0.16},
+            "water_leaf":     {"plants_per_m2": 16,  "crops_per_year": 6,  "yield_per_m2_per_crop": 2.0,"nutrients_kg_m2_crop": 0.20},
+            "cannabis":       {"plants_per_m2": 6.0, "crops_per_year": 3,  "yield_per_m2_per_crop": 1.0,"nutrients_kg_m2_crop": 0.40},
+        },
+        "vertical": {
+            "tomato":         {"plants_per_m2": 4.5, "crops_per_year": 1,  "yield_per_m2_per_crop": 75, "nutrients_kg_m2_crop": 1.4},
+            "pepper":         {"plants_per_m2": 5.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 60, "nutrients_kg_m2_crop": 1.2},
+            "cucumber":       {"plants_per_m2": 3.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 85, "nutrients_kg_m2_crop": 1.3},
+            "strawberry":     {"plants_per_m2": 16,  "crops_per_year": 1,  "yield_per_m2_per_crop": 50, "nutrients_kg_m2_crop": 0.9},
+            "lettuce":        {"plants_per_m2": 60,  "crops_per_year": 9,  "yield_per_m2_per_crop": 3.0,"nutrients_kg_m2_crop": 0.35},
+            "spinach":        {"plants_per_m2": 60,  "crops_per_year": 8,  "yield_per_m2_per_crop": 2.8,"nutrients_kg_m2_crop": 0.35},
+            "potato":         {"plants_per_m2": 6.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 7.0,"nutrients_kg_m2_crop": 0.65},
+            "fluted_pumpkin": {"plants_per_m2": 8.0, "crops_per_year": 5,  "yield_per_m2_per_crop": 2.2,"nutrients_kg_m2_crop": 0.30},
+            "basil":          {"plants_per_m2": 70,  "crops_per_year": 7,  "yield_per_m2_per_crop": 1.6,"nutrients_kg_m2_crop": 0.24},
+            "water_leaf":     {"plants_per_m2": 40,  "crops_per_year": 7,  "yield_per_m2_per_crop": 2.2,"nutrients_kg_m2_crop": 0.30},
+            "cannabis":       {"plants_per_m2": 12,  "crops_per_year": 4,  "yield_per_m2_per_crop": 1.4,"nutrients_kg_m2_crop": 0.55},
+        },
+        "hydroponics": {
+            "tomato":         {"plants_per_m2": 2.7, "crops_per_year": 1,  "yield_per_m2_per_crop": 60, "nutrients_kg_m2_crop": 1.0},
+            "pepper":         {"plants_per_m2": 3.2, "crops_per_year": 1,  "yield_per_m2_per_crop": 50, "nutrients_kg_m2_crop": 0.95},
+            "cucumber":       {"plants_per_m2": 2.2, "crops_per_year": 1,  "yield_per_m2_per_crop": 70, "nutrients_kg_m2_crop": 0.95},
+            "strawberry":     {"plants_per_m2": 9.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 40, "nutrients_kg_m2_crop": 0.65},
+            "lettuce":        {"plants_per_m2": 24,  "crops_per_year": 8,  "yield_per_m2_per_crop": 3.2,"nutrients_kg_m2_crop": 0.22},
+            "spinach":        {"plants_per_m2": 24,  "crops_per_year": 7,  "yield_per_m2_per_crop": 3.0,"nutrients_kg_m2_crop": 0.22},
+            "potato":         {"plants_per_m2": 4.5, "crops_per_year": 1,  "yield_per_m2_per_crop": 6.5,"nutrients_kg_m2_crop": 0.60},
+            "fluted_pumpkin": {"plants_per_m2": 4.5, "crops_per_year": 4,  "yield_per_m2_per_crop": 2.1,"nutrients_kg_m2_crop": 0.24},
+            "basil":          {"plants_per_m2": 28,  "crops_per_year": 6,  "yield_per_m2_per_crop": 1.6,"nutrients_kg_m2_crop": 0.18},
+            "water_leaf":     {"plants_per_m2": 18,  "crops_per_year": 6,  "yield_per_m2_per_crop": 2.1,"nutrients_kg_m2_crop": 0.22},
+            "cannabis":       {"plants_per_m2": 7.0, "crops_per_year": 3,  "yield_per_m2_per_crop": 1.1,"nutrients_kg_m2_crop": 0.45},
+        },
+        "aeroponics": {
+            "tomato":         {"plants_per_m2": 2.8, "crops_per_year": 1,  "yield_per_m2_per_crop": 65, "nutrients_kg_m2_crop": 1.1},
+            "pepper":         {"plants_per_m2": 3.3, "crops_per_year": 1,  "yield_per_m2_per_crop": 52, "nutrients_kg_m2_crop": 1.0},
+            "cucumber":       {"plants_per_m2": 2.3, "crops_per_year": 1,  "yield_per_m2_per_crop": 72, "nutrients_kg_m2_crop": 1.0},
+            "strawberry":     {"plants_per_m2": 9.5, "crops_per_year": 1,  "yield_per_m2_per_crop": 42, "nutrients_kg_m2_crop": 0.70},
+            "lettuce":        {"plants_per_m2": 26,  "crops_per_year": 9,  "yield_per_m2_per_crop": 3.3,"nutrients_kg_m2_crop": 0.24},
+            "spinach":        {"plants_per_m2": 26,  "crops_per_year": 8,  "yield_per_m2_per_crop": 3.1,"nutrients_kg_m2_crop": 0.24},
+            "potato":         {"plants_per_m2": 4.8, "crops_per_year": 1,  "yield_per_m2_per_crop": 6.8,"nutrients_kg_m2_crop": 0.62},
+            "fluted_pumpkin": {"plants_per_m2": 4.8, "crops_per_year": 4,  "yield_per_m2_per_crop": 2.2,"nutrients_kg_m2_crop": 0.26},
+            "basil":          {"plants_per_m2": 30,  "crops_per_year": 6,  "yield_per_m2_per_crop": 1.7,"nutrients_kg_m2_crop": 0.19},
+            "water_leaf":     {"plants_per_m2": 20,  "crops_per_year": 6,  "yield_per_m2_per_crop": 2.2,"nutrients_kg_m2_crop": 0.24},
+            "cannabis":       {"plants_per_m2": 7.5, "crops_per_year": 3,  "yield_per_m2_per_crop": 1.2,"nutrients_kg_m2_crop": 0.48},
+        },
+    },
+    "NG": {
+        "soil": {
+            "tomato":         {"plants_per_m2": 2.0, "crops_per_year": 2,  "yield_per_m2_per_crop": 25, "nutrients_kg_m2_crop": 0.55},
+            "pepper":         {"plants_per_m2": 2.5, "crops_per_year": 2,  "yield_per_m2_per_crop": 22, "nutrients_kg_m2_crop": 0.50},
+            "cucumber":       {"plants_per_m2": 1.8, "crops_per_year": 2,  "yield_per_m2_per_crop": 28, "nutrients_kg_m2_crop": 0.50},
+            "strawberry":     {"plants_per_m2": 7.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 18, "nutrients_kg_m2_crop": 0.38},
+            "lettuce":        {"plants_per_m2": 16,  "crops_per_year": 6,  "yield_per_m2_per_crop": 2.4,"nutrients_kg_m2_crop": 0.16},
+            "spinach":        {"plants_per_m2": 16,  "crops_per_year": 6,  "yield_per_m2_per_crop": 2.3,"nutrients_kg_m2_crop": 0.16},
+            "potato":         {"plants_per_m2": 3.5, "crops_per_year": 1,  "yield_per_m2_per_crop": 4.5,"nutrients_kg_m2_crop": 0.40},
+            "fluted_pumpkin": {"plants_per_m2": 3.5, "crops_per_year": 4,  "yield_per_m2_per_crop": 1.8,"nutrients_kg_m2_crop": 0.20},
+            "basil":          {"plants_per_m2": 20,  "crops_per_year": 5,  "yield_per_m2_per_crop": 1.1,"nutrients_kg_m2_crop": 0.13},
+            "water_leaf":     {"plants_per_m2": 14,  "crops_per_year": 5,  "yield_per_m2_per_crop": 1.9,"nutrients_kg_m2_crop": 0.18},
+            "cannabis":       {"plants_per_m2": 5.0, "crops_per_year": 2,  "yield_per_m2_per_crop": 0.6,"nutrients_kg_m2_crop": 0.33},
+        }
+    },
+    "US": {
+        "soil": {
+            "tomato":         {"plants_per_m2": 2.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 32, "nutrients_kg_m2_crop": 0.60},
+            "pepper":         {"plants_per_m2": 2.5, "crops_per_year": 1,  "yield_per_m2_per_crop": 27, "nutrients_kg_m2_crop": 0.56},
+            "cucumber":       {"plants_per_m2": 1.8, "crops_per_year": 1,  "yield_per_m2_per_crop": 34, "nutrients_kg_m2_crop": 0.58},
+            "strawberry":     {"plants_per_m2": 7.0, "crops_per_year": 1,  "yield_per_m2_per_crop": 22, "nutrients_kg_m2_crop": 0.42},
+            "lettuce":        {"plants_per_m2": 16,  "crops_per_year": 4,  "yield_per_m2_per_crop": 2.6,"nutrients_kg_m2_crop": 0.16},
+            "spinach":        {"plants_per_m2": 16,  "crops_per_year": 4,  "yield_per_m2_per_crop": 2.4,"nutrients_kg_m2_crop": 0.16},
+            "potato":         {"plants_per_m2": 3.5, "crops_per_year": 1,  "yield_per_m2_per_crop": 5.2,"nutrients_kg_m2_crop": 0.47},
+            "fluted_pumpkin": {"plants_per_m2": 3.5, "crops_per_year": 3,  "yield_per_m2_per_crop": 1.6,"nutrients_kg_m2_crop": 0.18},
+            "basil":          {"plants_per_m2": 20,  "crops_per_year": 4,  "yield_per_m2_per_crop": 1.3,"nutrients_kg_m2_crop": 0.13},
+            "water_leaf":     {"plants_per_m2": 14,  "crops_per_year": 4,  "yield_per_m2_per_crop": 1.8,"nutrients_kg_m2_crop": 0.17},
+            "cannabis":       {"plants_per_m2": 5.0, "crops_per_year": 3,  "yield_per_m2_per_crop": 0.8,"nutrients_kg_m2_crop": 0.40},
+        }
+    },
+}
+
+
+# =====================
+#  ECONOMIC PARAMETERS
+# =====================
+
+SETUP_LEVEL_LABELS = {
+    "local":    "Local (low-tech, locally sourced materials)",
+    "standard": "Standard (commercial greenhouse technology)",
+    "hightech": "Hi-tech (fully automated indoor/CEA)",
+}
+
+PRODUCTION_COST_PER_M2_USD = {
+    "soil":        6.0,
+    "soilless":   10.0,
+    "vertical":   30.0,
+    "hydroponics":18.0,
+    "aeroponics": 22.0,
+}
+
+PRICE_PER_KG_USD = {
+    "GLOBAL": {
+        "tomato":         2.0,
+        "pepper":         2.5,
+        "cucumber":       2.0,
+        "strawberry":     5.0,
+        "lettuce":        3.0,
+        "spinach":        3.0,
+        "potato":         1.0,
+        "fluted_pumpkin": 2.0,
+        "basil":         12.0,
+        "water_leaf":     2.5,
+        "cannabis":    1500.0,
+    },
+    "US": {
+        "tomato":         2.5,
+        "pepper":         3.0,
+        "cucumber":       2.3,
+        "strawberry":     6.0,
+        "lettuce":        3.5,
+        "spinach":        3.5,
+        "potato":         1.2,
+        "fluted_pumpkin": 2.2,
+        "basil":         14.0,
+        "water_leaf":     2.7,
+        "cannabis":    1800.0,
+    },
+    "CA": {
+        "tomato":         2.7,
+        "pepper":         3.1,
+        "cucumber":       2.4,
+        "strawberry":     6.5,
+        "lettuce":        3.7,
+        "spinach":        3.7,
+        "potato":         1.3,
+        "fluted_pumpkin": 2.3,
+        "basil":         15.0,
+        "water_leaf":     2.8,
+        "cannabis":    1700.0,
+    },
+    "NG": {
+        "tomato":         1.4,
+        "pepper":         1.8,
+        "cucumber":       1.3,
+        "strawberry":     3.5,
+        "lettuce":        2.0,
+        "spinach":        2.0,
+        "potato":         0.7,
+        "fluted_pumpkin": 1.4,
+        "basil":          6.0,
+        "water_leaf":     1.5,
+        "cannabis":     900.0,
+    },
+}
+
+CAPEX_PER_M2_USD = {
+    "GLOBAL": {
+        "local":    80.0,
+        "standard": 150.0,
+        "hightech": 400.0,
+    },
+    "US": {
+        "local":    120.0,
+        "standard": 250.0,
+        "hightech": 750.0,
+    },
+    "CA": {
+        "local":    130.0,
+        "standard": 270.0,
+        "hightech": 780.0,
+    },
+    "NG": {
+        "local":    50.0,
+        "standard": 110.0,
+        "hightech": 250.0,
+    },
+}
+
+# FX rates: how many USD is 1 unit of currency. Only the fallback for
+# FX_RATES_FILE; calculations read the tables in use through PARAMS.
+FX_TO_USD = {
+    "USD": 1.0,
+    "EUR": 1.10,
+    "CAD": 0.75,
+    "NGN": 0.0008,
+    "TRY": 0.032,
+    "ANG": 0.56,
+    "GBP": 1.25,
+}
+
+
+def usd_to_currency(amount_usd, currency_code, param_set=None):
+    rate = (param_set or PARAMS).fx.rates.get(currency_code)
+    if rate is None:
+        raise ValueError(f"no exchange rate for currency {currency_code!r}")
+    return amount_usd / rate
+
+
+def current_price_unit_for_crop(crop):
+    if crop in {
+        "cannabis", "lettuce", "spinach", "basil", "water_leaf", "fluted_pumpkin"
+    }:
+        return "kg"
+
+
+# =====================
+#  Parameter index
+# =====================
+# Every (country, system, crop, setup) combination is resolved up front,
+# fallbacks applied. PARAM_WILDCARD stands for any value the tables don't know.
+PARAM_WILDCARD = "*"
+
+CROP_PARAM_FIELDS = (
+    "plants_per_m2", "crops_per_year", "yield_per_m2_per_crop", "nutrients_kg_m2_crop",
+)
+
+
+def _resolve_crop_params(tables, country_code, system_type, crop):
+    crop_params = tables["CROP_PARAMS"]
+    fallback = None
+    country_table = crop_params.get(country_code)
+    if not country_table:
+        country_table = crop_params["GLOBAL"]
+        fallback = "GLOBAL"
+    system_table = country_table.get(system_type)
+    if not system_table or crop not in system_table:
+        system_table = crop_params["GLOBAL"].get(system_type, {})
+        if country_code != "GLOBAL":
+            fallback = "GLOBAL"
+    params = system_table.get(crop)
+    if not params:
+        params = crop_params["GLOBAL"]["soilless"]["tomato"]
+        fallback = "GLOBAL/soilless/tomato"
+    return params, fallback
+
+
+def _resolve_price_per_kg_usd(tables, crop, country_code):
+    prices = tables["PRICE_PER_KG_USD"]
+    table = prices.get(country_code, prices["GLOBAL"])
+    if crop in table:
+        return table[crop], None if table is prices.get(country_code) else "GLOBAL"
+    if crop in prices["GLOBAL"]:
+        return prices["GLOBAL"][crop], "GLOBAL"
+    return 2.0, "default 2.0"
+
+
+def _resolve_capex_per_m2_usd(tables, setup_level, country_code):
+    capex = tables["CAPEX_PER_M2_USD"]
+    table = capex.get(country_code, capex["GLOBAL"])
+    fallback = None if table is capex.get(country_code) else "GLOBAL"
+    if setup_level in table:
+        return table[setup_level], fallback
+    return table.get("standard", 150.0), "standard"
+
+
+def _resolve_production_cost_per_m2_usd(tables, system_type):
+    costs = tables["PRODUCTION_COST_PER_M2_USD"]
+    if system_type in costs:
+        return costs[system_type], None
+    return costs["soilless"], "soilless"
+
+
+def validate_param_tables(tables):
+    """Raise ValueError listing every problem in the parameter tables."""
+    CROP_PARAMS = tables["CROP_PARAMS"]
+    PRICE_PER_KG_USD = tables["PRICE_PER_KG_USD"]
+    CAPEX_PER_M2_USD = tables["CAPEX_PER_M2_USD"]
+    PRODUCTION_COST_PER_M2_USD = tables["PRODUCTION_COST_PER_M2_USD"]
+    problems = []
+
+    def check(value, where, minimum=0.0, strict=False):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            problems.append(f"{where}: {value!r} is not a number")
+        elif value < minimum or (strict and value == minimum):
+            problems.append(f"{where}: {value!r} must be {'>' if strict else '>='} {minimum}")
+
+    for name, table in (
+        ("CROP_PARAMS", CROP_PARAMS),
+        ("PRICE_PER_KG_USD", PRICE_PER_KG_USD),
+        ("CAPEX_PER_M2_USD", CAPEX_PER_M2_USD),
+    ):
+        if "GLOBAL" not in table:
+            problems.append(f"{name}: missing GLOBAL table")
+    if "tomato" not in CROP_PARAMS.get("GLOBAL", {}).get("soilless", {}):
+        problems.append("CROP_PARAMS: missing default GLOBAL/soilless/tomato")
+    if "soilless" not in PRODUCTION_COST_PER_M2_USD:
+        problems.append("PRODUCTION_COST_PER_M2_USD: missing default soilless")
+
+    for country_code, systems in CROP_PARAMS.items():
+        for system_type, crops in systems.items():
+            for crop, params in crops.items():
+                where = f"CROP_PARAMS[{country_code}][{system_type}][{crop}]"
+                for field in CROP_PARAM_FIELDS:
+                    if field not in params:
+                        problems.append(f"{where}: missing {field}")
+                    else:
+                        strict = field in ("plants_per_m2", "crops_per_year")
+                        check(params[field], f"{where}[{field}]", strict=strict)
+    for country_code, prices in PRICE_PER_KG_USD.items():
+        for crop, price in prices.items():
+            check(price, f"PRICE_PER_KG_USD[{country_code}][{crop}]", strict=True)
+    for country_code, levels in CAPEX_PER_M2_USD.items():
+        for level, capex in levels.items():
+            check(capex, f"CAPEX_PER_M2_USD[{country_code}][{level}]", strict=True)
+    for system_type, cost in PRODUCTION_COST_PER_M2_USD.items():
+        check(cost, f"PRODUCTION_COST_PER_M2_USD[{system_type}]")
+
+    if problems:
+        raise ValueError("invalid parameter tables:\n  " + "\n  ".join(problems))
+
+
+def build_param_index(tables):
+    """
+    Validate the parameter tables and resolve every combination.
+    Returns (index, fallbacks, known values per key position).
+    """
+    validate_param_tables(tables)
+    CROP_PARAMS = tables["CROP_PARAMS"]
+    PRICE_PER_KG_USD = tables["PRICE_PER_KG_USD"]
+    CAPEX_PER_M2_USD = tables["CAPEX_PER_M2_USD"]
+
+    countries = set(CROP_PARAMS) | set(PRICE_PER_KG_USD) | set(CAPEX_PER_M2_USD)
+    systems = set(tables["PRODUCTION_COST_PER_M2_USD"]) | {
+        system_type for table in CROP_PARAMS.values() for system_type in table
+    }
+    crops = {
+        crop for table in CROP_PARAMS.values() for crops in table.values() for crop in crops
+    } | {crop for table in PRICE_PER_KG_USD.values() for crop in table}
+    setups = set(tables["SETUP_LEVEL_LABELS"]) | {
+        level for table in CAPEX_PER_M2_USD.values() for level in table
+    }
+    if PARAM_WILDCARD in countries | systems | crops | setups:
+        raise ValueError(f"parameter tables must not use the key {PARAM_WILDCARD!r}")
+
+    index = {}
+    fallbacks = []
+    for country_code in sorted(countries):
+        capex_by_level = [
+            (setup_level, *_resolve_capex_per_m2_usd(tables, setup_level, country_code))
+            for setup_level in sorted(setups) + [PARAM_WILDCARD]
+        ]
+        for system_type in sorted(systems) + [PARAM_WILDCARD]:
+            production_cost, cost_fallback = _resolve_production_cost_per_m2_usd(tables, system_type)
+            for crop in sorted(crops) + [PARAM_WILDCARD]:
+                params, crop_fallback = _resolve_crop_params(tables, country_code, system_type, crop)
+                price, price_fallback = _resolve_price_per_kg_usd(tables, crop, country_code)
+                crop_fields = {field: params[field] for field in CROP_PARAM_FIELDS}
+                for setup_level, capex, capex_fallback in capex_by_level:
+                    key = (country_code, system_type, crop, setup_level)
+                    index[key] = {
+                        **crop_fields,
+                        "price_per_kg_usd": price,
+                        "capex_per_m2_usd": capex,
+                        "production_cost_per_m2_usd": production_cost,
+                    }
+                    if PARAM_WILDCARD in key:
+                        continue
+                    used = {
+                        "crop_params": crop_fallback,
+                        "price_per_kg_usd": price_fallback,
+                        "capex_per_m2_usd": capex_fallback,
+                        "production_cost_per_m2_usd": cost_fallback,
+                    }
+                    used = {field: source for field, source in used.items() if source}
+                    if used:
+                        fallbacks.append({"key": key, "fallbacks": used})
+
+    return index, fallbacks, (countries, systems, crops, setups)
+
+
+# Tables in fingerprint order; the exchange rates are versioned on their own.
+PARAM_TABLE_NAMES = (
+    "CROP_PARAMS", "PRICE_PER_KG_USD", "CAPEX_PER_M2_USD", "PRODUCTION_COST_PER_M2_USD",
+    "SETUP_LEVEL_LABELS", "SOLAR_SAVINGS_RATE",
+)
+
+
+def params_fingerprint(tables):
+    """Short content hash of every table the calculation reads."""
+    tables = [tables[name] for name in PARAM_TABLE_NAMES]
+    return hashlib.sha1(json.dumps(tables, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+
+# The tables, their index and fingerprint, and the FxTable in use. A
+# calculation reads PARAMS once and passes that ParamSet on, so it never
+# mixes two sets.
+ParamSet = namedtuple("ParamSet", "tables index fallbacks keys version source loaded_at fx")
+
+
+def make_param_set(tables, source, loaded_at=None, fx=None):
+    """A validated ParamSet of `tables`; ValueError if they are invalid."""
+    try:
+        index, fallbacks, keys = build_param_index(tables)
+    except (KeyError, TypeError, AttributeError) as exc:
+        raise ValueError(f"invalid parameter tables: {exc}")
+    return ParamSet(
+        tables, index, fallbacks, keys, params_fingerprint(tables), source,
+        loaded_at or datetime.datetime.utcnow().isoformat(), fx,
+    )
+
+
+def publish_params(param_set):
+    # Caller holds _params_lock (once defined).
+    global PARAMS
+    PARAMS = param_set
+
+
+publish_params(make_param_set({name: globals()[name] for name in PARAM_TABLE_NAMES}, "builtin"))
+
+
+def lookup_params(country_code, system_type, crop, setup_level=PARAM_WILDCARD, param_set=None):
+    """Resolved crop, price, capex and production-cost figures for one combination."""
+    params = param_set or PARAMS
+    record = params.index.get((country_code, system_type, crop, setup_level))
+    if record is None:
+        countries, systems, crops, setups = params.keys
+        record = params.index[(
+            country_code if country_code in countries else "GLOBAL",
+            system_type if system_type in systems else PARAM_WILDCARD,
+            crop if crop in crops else PARAM_WILDCARD,
+            setup_level if setup_level in setups else PARAM_WILDCARD,
+        )]
+    return record
+
+
+def get_crop_params(country_code, system_type, crop, param_set=None):
+    return lookup_params(country_code, system_type, crop, param_set=param_set)
+
+
+def estimate_price_per_kg_usd(crop, country_code, param_set=None):
+    record = lookup_params(country_code, PARAM_WILDCARD, crop, param_set=param_set)
+    return record["price_per_kg_usd"]
+
+
+def estimate_capex_per_m2_usd(setup_level, country_code, param_set=None):
+    record = lookup_params(country_code, PARAM_WILDCARD, PARAM_WILDCARD, setup_level, param_set)
+    return record["capex_per_m2_usd"]
+
+
+def estimate_production_cost_per_m2_usd(system_type, param_set=None):
+    record = lookup_params("GLOBAL", system_type, PARAM_WILDCARD, param_set=param_set)
+    return record["production_cost_per_m2_usd"]
+
+
+def param_fallback_report(param_set=None):
+    """Which table entries fall back to GLOBAL or built-in defaults."""
+    params = param_set or PARAMS
+    counts = {}
+    for entry in params.fallbacks:
+        for field in entry["fallbacks"]:
+            counts[field] = counts.get(field, 0) + 1
+    return {
+        "combinations": sum(1 for key in params.index if PARAM_WILDCARD not in key),
+        "with_fallbacks": len(params.fallbacks),
+        "fallbacks_by_field": counts,
+        "entries": [
+            {"key": "/".join(entry["key"]), "fallbacks": entry["fallbacks"]}
+            for entry in params.fallbacks
+        ],
+    }
+
+
+# =====================
+#  Parameter store
+# =====================
+# PARAMS_FILE, when it exists, replaces any of the built-in tables. Write
+# it atomically, e.g. with 'flask export-params'.
+PARAMS_FILE = os.environ.get(
+    "MARO_PARAMS_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "params.json"),
+)
+PARAMS_CHECK_INTERVAL = float(os.environ.get("MARO_PARAMS_CHECK_INTERVAL", "2"))
+
+# params file key -> module global it replaces
+PARAM_TABLES = {
+    "crop_params": "CROP_PARAMS",
+    "price_per_kg_usd": "PRICE_PER_KG_USD",
+    "capex_per_m2_usd": "CAPEX_PER_M2_USD",
+    "production_cost_per_m2_usd": "PRODUCTION_COST_PER_M2_USD",
+    "setup_level_labels": "SETUP_LEVEL_LABELS",
+    "solar_savings_rate": "SOLAR_SAVINGS_RATE",
+}
+BUILTIN_PARAMS = {key: copy.deepcopy(globals()[name]) for key, name in PARAM_TABLES.items()}
+# Keys older params files may still carry, ignored.
+RETIRED_PARAM_TABLES = ("fx_to_usd",)
+
+_params_lock = threading.Lock()
+_params_checked_at = float("-inf")
+_params_file_stamp = None
+_recorded_params_versions = set()
+
+
+def current_params():
+    """The parameter set in use, keyed like the params file."""
+    tables = PARAMS.tables
+    return {key: tables[name] for key, name in PARAM_TABLES.items()}
+
+
+def install_params(params, source):
+    """
+    Swap in a parameter set (as read from a params file). The new tables,
+    index and version are built and validated as one ParamSet before
+    anything is published, so invalid tables raise ValueError and leave
+    the current set untouched.
+    """
+    retired = [key for key in RETIRED_PARAM_TABLES if key in params]
+    if retired:
+        logger.info("Ignoring retired parameter tables in %s: %s", source, ", ".join(retired))
+        params = {key: value for key, value in params.items() if key not in retired}
+    unknown = set(params) - set(PARAM_TABLES)
+    if unknown:
+        raise ValueError(f"unknown parameter tables: {', '.join(sorted(unknown))}")
+    tables = {
+        PARAM_TABLES[key]: params[key] if key in params else copy.deepcopy(BUILTIN_PARAMS[key])
+        for key in PARAM_TABLES
+    }
+    with _params_lock:
+        param_set = make_param_set(tables, source, fx=PARAMS.fx)
+        publish_params(param_set)
+    return param_set.version
+
+
+def maybe_reload_params(force=False):
+    """
+    Install PARAMS_FILE if it changed since the last check; checks at most
+    every PARAMS_CHECK_INTERVAL seconds unless forced. A removed file brings
+    back the built-in set; a broken one is logged and skipped.
+    Returns True when a new set was installed.
+    """
+    global _params_checked_at, _params_file_stamp
+    now = time.monotonic()
+    if not force and now - _params_checked_at < PARAMS_CHECK_INTERVAL:
+        return False
+    _params_checked_at = now
+    try:
+        st = os.stat(PARAMS_FILE)
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+    except OSError:
+        stamp = None
+    if stamp == _params_file_stamp and not force:
+        return False
+    _params_file_stamp = stamp
+
+    if stamp is None:
+        if PARAMS.source == "builtin":
+            return False
+        install_params({}, "builtin")
+        return True
+    try:
+        with open(PARAMS_FILE, encoding="utf-8") as f:
+            params = json.load(f)
+        if not isinstance(params, dict):
+            raise ValueError("the params file must hold a JSON object")
+        before = PARAMS.version
+        install_params(params, PARAMS_FILE)
+    except (OSError, ValueError) as exc:
+        logger.warning("Keeping parameters %s: %s: %s", PARAMS.version, PARAMS_FILE, exc)
+        return False
+    return PARAMS.version != before
+
+
+def params_versions(param_set=None):
+    """(parameter version, FX version) of a ParamSet, for ensure_params_version."""
+    param_set = param_set or PARAMS
+    return param_set.version, param_set.fx.version
+
+
+def ensure_params_version(versions):
+    # Lets long-lived pool workers catch up with the parent.
+    version, fx_version = versions
+    if version != PARAMS.version:
+        maybe_reload_params(force=True)
+    if fx_version != PARAMS.fx.version:
+        install_fx_table(load_fx_rates())
+
+
+def write_data_file(path, payload, watch=None, **dump_args):
+    """
+    Write `payload` as JSON over `path` atomically: a temp file in the same
+    directory, renamed over it. Marks `watch` (a FileWatch on `path`), so
+    the writer does not reload its own file. Raises OSError.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(payload, f, indent=1, **dump_args)
+            f.write("\n")
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    if watch is not None and watch.path == path:
+        watch.mark()
+
+
+def save_params_file(params, path=None):
+    """Write a parameter set to `path` (default PARAMS_FILE) atomically."""
+    write_data_file(path or PARAMS_FILE, params, sort_keys=True)
+
+
+maybe_reload_params(force=True)
+
+
+# Seconds between checks of the FX rates and country files.
+DATA_FILE_CHECK_INTERVAL = float(os.environ.get("MARO_DATA_FILE_CHECK_INTERVAL", "2.0"))
+
+
+class FileWatch:
+    """
+    Tells whether a file changed (mtime, size, inode) since the last look,
+    statting it at most every `interval` seconds.
+    """
+
+    def __init__(self, path, interval=DATA_FILE_CHECK_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._checked_at = time.monotonic()
+        self._stamp = self._current()
+
+    def _current(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def mark(self):
+        """Take the file as it is now as seen, e.g. after writing it."""
+        self._stamp = self._current()
+
+    def changed(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.interval:
+            return False
+        self._checked_at = now
+        stamp = self._current()
+        if stamp == self._stamp:
+            return False
+        self._stamp = stamp
+        return True
+
+
+# =====================
+#  Exchange rates
+# =====================
+# Rates (USD per unit) come from FX_RATES_FILE. FX_RATES_URL, when set,
+# is polled every FX_REFRESH_INTERVAL seconds (0 disables it) and the
+# file rewritten. A currency without a rate is an error, never 1:1.
+FX_RATES_FILE = os.environ.get(
+    "MARO_FX_RATES_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "fx_rates.json"),
+)
+FX_RATES_URL = os.environ.get("MARO_FX_RATES_URL")
+FX_REFRESH_INTERVAL = float(os.environ.get("MARO_FX_REFRESH_INTERVAL", "0"))
+BUILTIN_FX_TO_USD = dict(FX_TO_USD)
+
+# matrix[i, j] is how many units of codes[j] one unit of codes[i] buys.
+FxTable = namedtuple("FxTable", "codes index rates to_usd matrix fetched_at source version")
+
+# Currency -> lookups that found no rate, for /admin/fx. Codes come from
+# user input, so only FX_UNKNOWN_TRACKED of them are kept.
+FX_UNKNOWN_CURRENCIES = {}
+FX_UNKNOWN_TRACKED = 64
+FX_UNKNOWN_OTHER = "(other)"
+
+
+def make_fx_table(rates_to_usd, fetched_at=None, source=None):
+    """Validated FxTable for {currency: USD per unit}; raises ValueError."""
+    bad = sorted(
+        code for code, rate in rates_to_usd.items()
+        if isinstance(rate, bool) or not isinstance(rate, (int, float))
+        or not math.isfinite(rate) or rate <= 0
+    )
+    if bad:
+        raise ValueError(f"invalid FX rates for: {', '.join(bad)}")
+    if not rates_to_usd:
+        raise ValueError("no FX rates")
+    codes = tuple(sorted(rates_to_usd))
+    rates = {code: float(rates_to_usd[code]) for code in codes}
+    to_usd = np.array(list(rates.values()))
+    version = hashlib.sha1(json.dumps(rates).encode("utf-8")).hexdigest()[:12]
+    return FxTable(
+        codes,
+        {code: i for i, code in enumerate(codes)},
+        rates,
+        to_usd,
+        to_usd[:, None] / to_usd[None, :],
+        fetched_at,
+        source,
+        version,
+    )
+
+
+def load_fx_rates(path=FX_RATES_FILE):
+    try:
+        with open(path, encoding="utf-8") as f:
+            payload = json.load(f)
+        return make_fx_table(payload["rates_to_usd"], payload.get("fetched_at"), payload.get("source"))
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as exc:
+        logger.warning("FX rates %s unusable (%s); using built-in rates", path, exc)
+        return make_fx_table(BUILTIN_FX_TO_USD, None, "builtin")
+
+
+def install_fx_table(table):
+    with _params_lock:
+        publish_params(PARAMS._replace(fx=table))
+
+
+def lookup_fx_rate(currency_code, param_set=None):
+    """USD per unit of currency_code, or None (counted) when there is no rate."""
+    rate = (param_set or PARAMS).fx.rates.get(currency_code)
+    if rate is None:
+        counts = FX_UNKNOWN_CURRENCIES
+        key = currency_code
+        if key not in counts and len(counts) >= FX_UNKNOWN_TRACKED:
+            key = FX_UNKNOWN_OTHER
+        counts[key] = counts.get(key, 0) + 1
+    return rate
+
+
+def missing_rate_message(currency_code):
+    return f"No exchange rate for currency {currency_code}. Pick another currency override."
+
+
+def convert_amounts(amounts, from_codes, to_code):
+    """
+    Convert amounts given in from_codes (one code per row) into to_code
+    with one gather from the conversion matrix. `amounts` may be 1-D or
+    (rows, fields). Rows in a currency without a rate come out NaN;
+    an unknown to_code raises ValueError.
+    """
+    table = PARAMS.fx
+    target = table.index.get(to_code)
+    if target is None:
+        raise ValueError(f"no exchange rate for currency {to_code!r}")
+    source = np.array([table.index.get(code, -1) for code in from_codes], dtype=np.intp)
+    factor = np.where(source >= 0, table.matrix[np.maximum(source, 0), target], np.nan)
+    amounts = np.asarray(amounts, dtype=float)
+    return amounts * (factor if amounts.ndim == 1 else factor[:, None])
+
+
+def fetch_fx_rates():
+    """{currency: USD per unit} from FX_RATES_URL; raises on any failure."""
+    import requests
+
+    resp = requests.get(FX_RATES_URL, timeout=10)
+    resp.raise_for_status()
+    payload = resp.json()
+    if "rates_to_usd" in payload:
+        return payload["rates_to_usd"]
+    if payload.get("base", payload.get("base_code", "USD")) != "USD":
+        raise ValueError("rates service must quote against USD")
+    return {code: 1.0 / units for code, units in payload["rates"].items() if units}
+
+
+def refresh_fx_rates(path=FX_RATES_FILE):
+    """
+    Fetch fresh rates, write them over the rates file and swap them in.
+    Returns the new FxTable, or None if the fetch failed or the rates were
+    unusable (the current table stays in place).
+    """
+    if not FX_RATES_URL:
+        return None
+    try:
+        # Currencies the service doesn't quote keep their last rate.
+        rates = dict(PARAMS.fx.rates)
+        rates.update(fetch_fx_rates())
+        table = make_fx_table(rates, datetime.datetime.utcnow().isoformat(), FX_RATES_URL)
+    except Exception as exc:
+        logger.warning("FX refresh failed: %s", exc)
+        return None
+
+    payload = {
+        "base": "USD",
+        "source": table.source,
+        "fetched_at": table.fetched_at,
+        "rates_to_usd": table.rates,
+    }
+    try:
+        write_data_file(path, payload, FX_WATCH)
+    except OSError as exc:
+        logger.warning("could not write FX rates %s: %s", path, exc)
+
+    install_fx_table(table)
+    return table
+
+
+def refresh_fx_rates_in_background():
+    thread = threading.Thread(target=refresh_fx_rates, name="fx-refresh", daemon=True)
+    thread.start()
+    return thread
+
+
+def _fx_refresh_loop(interval):
+    while True:
+        time.sleep(interval)
+        refresh_fx_rates()
+
+
+_fx_refresh_pid = None
+_fx_refresh_lock = threading.Lock()
+
+
+def start_fx_refresh(interval=FX_REFRESH_INTERVAL):
+    """Start this process's refresh loop once; called lazily so each worker gets one."""
+    global _fx_refresh_pid
+    if interval <= 0 or not FX_RATES_URL or _fx_refresh_pid == os.getpid():
+        return None
+    with _fx_refresh_lock:
+        if _fx_refresh_pid == os.getpid():
+            return None
+        _fx_refresh_pid = os.getpid()
+        thread = threading.Thread(
+            target=_fx_refresh_loop, args=(interval,), name="fx-refresh", daemon=True
+        )
+        thread.start()
+        return thread
+
+
+def maybe_reload_fx_rates():
+    """Install FX_RATES_FILE again if another worker refreshed it."""
+    if not FX_WATCH.changed():
+        return False
+    install_fx_table(load_fx_rates())
+    return True
+
+
+FX_WATCH = FileWatch(FX_RATES_FILE)
+install_fx_table(load_fx_rates())
+
+
+# ==========================
+#  Country / currency lookup
+# ==========================
+COUNTRIES_URL = "https://restcountries.com/v3.1/all?fields=name,currencies,cca2"
+COUNTRIES_SNAPSHOT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data", "countries.json"
+)
+# Refreshes are written here, never over the shipped snapshot.
+COUNTRIES_FILE = os.environ.get(
+    "MARO_COUNTRIES_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "countries.refreshed.json"),
+)
+# Seconds between background refreshes from COUNTRIES_URL; 0 disables them.
+COUNTRY_REFRESH_INTERVAL = float(os.environ.get("MARO_COUNTRY_REFRESH_INTERVAL", "0"))
+
+FALLBACK_COUNTRIES = [
+    {
+        "code": "US",
+        "name": "United States",
+        "currency_code": "USD",
+        "currency_symbol": "$",
+    }
+]
+
+CountrySnapshot = namedtuple("CountrySnapshot", "countries by_code fetched_at version")
+
+
+def fetch_countries():
+    """Download the country list from COUNTRIES_URL. Raises on failure."""
+    # Imported here: it is a large share of the cold-start time.
+    import requests
+
+    resp = requests.get(COUNTRIES_URL, timeout=10)
+    resp.raise_for_status()
+    data = resp.json()
+
+    countries = []
+    for c in data:
+        name = c.get("name", {}).get("common", "Unknown")
+        cca2 = c.get("cca2", "")
+        currencies = c.get("currencies", {})
+        if currencies:
+            code = list(currencies.keys())[0]
+            symbol = currencies[code].get("symbol", code)
+        else:
+            code, symbol = "USD", "$"
+        countries.append(
+            {
+                "code": cca2,
+                "name": name,
+                "currency_code": code,
+                "currency_symbol": symbol,
+            }
+        )
+
+    countries.sort(key=lambda x: x["name"])
+    return countries
+
+
+def make_country_snapshot(countries, fetched_at=None):
+    by_code = {}
+    for c in countries:
+        by_code.setdefault(c["code"], c)
+    digest = hashlib.sha1(
+        json.dumps(countries, sort_keys=True).encode("utf-8")
+    ).hexdigest()[:12]
+    return CountrySnapshot(countries, by_code, fetched_at, digest)
+
+
+def load_country_snapshot(paths=(COUNTRIES_FILE, COUNTRIES_SNAPSHOT)):
+    """The first usable country list of `paths`, else FALLBACK_COUNTRIES."""
+    for path in paths:
+        if path != COUNTRIES_SNAPSHOT and not os.path.exists(path):
+            continue
+        try:
+            with open(path, encoding="utf-8") as f:
+                payload = json.load(f)
+            countries = payload["countries"]
+            if not countries:
+                raise ValueError("empty country list")
+        except (OSError, ValueError, KeyError) as exc:
+            logger.warning("country snapshot %s unusable (%s)", path, exc)
+            continue
+        return make_country_snapshot(countries, payload.get("fetched_at"))
+    logger.warning("no usable country snapshot; using fallback")
+    return make_country_snapshot(FALLBACK_COUNTRIES)
+
+
+def install_country_snapshot(snapshot):
+    global COUNTRY_SNAPSHOT, COUNTRIES
+    COUNTRY_SNAPSHOT = snapshot
+    COUNTRIES = snapshot.countries
+
+
+def refresh_countries(path=COUNTRIES_FILE):
+    """
+    Fetch a fresh country list, write it to COUNTRIES_FILE and swap it in.
+    Returns the new snapshot, or None if the fetch failed (the current list
+    stays in place).
+    """
+    try:
+        countries = fetch_countries()
+    except Exception as exc:
+        logger.warning("country refresh failed: %s", exc)
+        return None
+    if not countries:
+        logger.warning("country refresh returned no countries; keeping snapshot")
+        return None
+
+    fetched_at = datetime.datetime.utcnow().isoformat()
+    payload = {"source": COUNTRIES_URL, "fetched_at": fetched_at, "countries": countries}
+    try:
+        write_data_file(path, payload, COUNTRIES_WATCH, ensure_ascii=False)
+    except OSError as exc:
+        logger.warning("could not write country snapshot %s: %s", path, exc)
+
+    snapshot = make_country_snapshot(countries, fetched_at)
+    install_country_snapshot(snapshot)
+    return snapshot
+
+
+def refresh_countries_in_background():
+    thread = threading.Thread(target=refresh_countries, name="country-refresh", daemon=True)
+    thread.start()
+    return thread
+
+
+def _country_refresh_loop(interval):
+    while True:
+        time.sleep(interval)
+        refresh_countries()
+
+
+_country_refresh_pid = None
+_country_refresh_lock = threading.Lock()
+
+
+def start_country_refresh(interval=COUNTRY_REFRESH_INTERVAL):
+    """Start this process's refresh loop once; called lazily so each worker gets one."""
+    global _country_refresh_pid
+    if interval <= 0 or _country_refresh_pid == os.getpid():
+        return None
+    with _country_refresh_lock:
+        if _country_refresh_pid == os.getpid():
+            return None
+        _country_refresh_pid = os.getpid()
+        thread = threading.Thread(
+            target=_country_refresh_loop, args=(interval,), name="country-refresh", daemon=True
+        )
+        thread.start()
+        return thread
+
+
+def maybe_reload_countries():
+    """Install COUNTRIES_FILE again if another worker refreshed it."""
+    if not COUNTRIES_WATCH.changed():
+        return False
+    install_country_snapshot(load_country_snapshot())
+    return True
+
+
+COUNTRY_SNAPSHOT = COUNTRIES = None
+COUNTRIES_WATCH = FileWatch(COUNTRIES_FILE)
+install_country_snapshot(load_country_snapshot())
+
+
+def get_countries():
+    return COUNTRY_SNAPSHOT.countries
+
+
+def find_country(cca2):
+    return COUNTRY_SNAPSHOT.by_code.get(cca2)
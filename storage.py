@@ -0,0 +1,1274 @@
+"""SQLite storage: the calculation log and rollups, stored results, history exports."""
+import atexit
+import csv
+import datetime
+import hashlib
+import json
+import logging
+import math
+import os
+import queue
+import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from collections import deque, namedtuple
+from io import StringIO
+
+import numpy as np
+
+import parameters
+from engine import (
+    CUSTOM_OVERRIDE_FLAGS, RESULT_CACHE_TTL, LazyResults, ResultCache, calculate,
+    calculation_key, compute_results_batch, form_batch_columns, submitted_form,
+)
+from metrics import phase
+from parameters import PARAM_TABLES, convert_amounts, ensure_params_version, params_versions
+
+logger = logging.getLogger(__name__)
+
+DATABASE = os.environ.get("MARO_DATABASE", "farm_calc.db")
+
+
+# ================
+#  DB helper funcs
+# ================
+def _sqlite_pragmas_from_env():
+    # Anything beyond these goes in MARO_SQLITE_PRAGMAS, e.g.
+    # "cache_size=-20000;temp_store=MEMORY".
+    pragmas = {
+        "journal_mode": os.environ.get("MARO_SQLITE_JOURNAL_MODE", "WAL"),
+        "synchronous": os.environ.get("MARO_SQLITE_SYNCHRONOUS", "NORMAL"),
+        "busy_timeout": os.environ.get("MARO_SQLITE_BUSY_TIMEOUT_MS", "5000"),
+    }
+    for pragma in os.environ.get("MARO_SQLITE_PRAGMAS", "").split(";"):
+        if "=" in pragma:
+            name, value = pragma.split("=", 1)
+            pragmas[name.strip()] = value.strip()
+    return pragmas
+
+
+SQLITE_PRAGMAS = _sqlite_pragmas_from_env()
+
+_db_local = threading.local()
+_migrated_databases = set()
+_migrate_lock = threading.Lock()
+
+
+def open_db(path=None):
+    """New connection to `path` (default DATABASE) with SQLITE_PRAGMAS applied."""
+    path = path or DATABASE
+    conn = sqlite3.connect(path, timeout=int(SQLITE_PRAGMAS["busy_timeout"]) / 1000.0)
+    conn.row_factory = sqlite3.Row
+    for name, value in SQLITE_PRAGMAS.items():
+        conn.execute(f"PRAGMA {name}={value}")
+    ensure_schema(conn, path)
+    return conn
+
+
+def get_db():
+    """
+    This thread's connection, opened on first use and then reused across
+    requests. A forked worker or a changed DATABASE gets a fresh one.
+    """
+    conn = getattr(_db_local, "conn", None)
+    if conn is None or _db_local.key != (os.getpid(), DATABASE):
+        conn = open_db()
+        _db_local.conn = conn
+        _db_local.key = (os.getpid(), DATABASE)
+    return conn
+
+
+def rollback_db():
+    """Roll back a transaction left open on this thread's connection."""
+    conn = getattr(_db_local, "conn", None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+
+def init_db(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS calculations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TEXT NOT NULL,
+            country_code TEXT,
+            currency_code TEXT,
+            crop TEXT,
+            system_type TEXT,
+            area_m2 REAL,
+            annual_yield REAL,
+            annual_revenue REAL,
+            annual_profit REAL
+        )
+        """
+    )
+    # (column, created_at, id) indexes serve the keyset history pages. ids
+    # alone don't follow created_at: write-behind batches land late.
+    conn.executescript(
+        """
+        DROP INDEX IF EXISTS idx_calculations_crop;
+        DROP INDEX IF EXISTS idx_calculations_country;
+        DROP INDEX IF EXISTS idx_calculations_system;
+        DROP INDEX IF EXISTS idx_calculations_created_at;
+        CREATE INDEX IF NOT EXISTS idx_calculations_crop_created
+            ON calculations (crop, created_at, id);
+        CREATE INDEX IF NOT EXISTS idx_calculations_country_created
+            ON calculations (country_code, created_at, id);
+        CREATE INDEX IF NOT EXISTS idx_calculations_system_created
+            ON calculations (system_type, created_at, id);
+        CREATE INDEX IF NOT EXISTS idx_calculations_created
+            ON calculations (created_at, id);
+        """
+    )
+    # Daily aggregates, maintained from calculations ids above last_id.
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS calculation_rollups (
+            day TEXT NOT NULL,
+            crop TEXT NOT NULL,
+            country_code TEXT NOT NULL,
+            system_type TEXT NOT NULL,
+            currency_code TEXT NOT NULL,
+            calculations INTEGER NOT NULL,
+            total_area_m2 REAL NOT NULL,
+            total_annual_yield REAL NOT NULL,
+            total_annual_revenue REAL NOT NULL,
+            total_annual_profit REAL NOT NULL,
+            PRIMARY KEY (day, crop, country_code, system_type, currency_code)
+        );
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL
+        );
+        """
+    )
+    # Stored results, addressed by a hash of their normalized inputs.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS results (
+            id TEXT PRIMARY KEY,
+            created_at TEXT NOT NULL,
+            params_version TEXT NOT NULL,
+            inputs_json TEXT NOT NULL,
+            results_json TEXT NOT NULL
+        )
+        """
+    )
+    add_missing_columns(
+        conn,
+        "calculations",
+        {"inputs_json": "TEXT", "result_id": "TEXT", "params_version": "TEXT"},
+    )
+    # Every parameter set that produced a result, by version.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS param_versions (
+            version TEXT PRIMARY KEY,
+            created_at TEXT NOT NULL,
+            source TEXT NOT NULL,
+            params_json TEXT NOT NULL
+        )
+        """
+    )
+    # History recomputed under a parameter set, one row per calculation
+    # and params_version; reevaluation_state holds each run's watermark.
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS reevaluations (
+            calculation_id INTEGER NOT NULL,
+            params_version TEXT NOT NULL,
+            currency_code TEXT,
+            annual_yield REAL,
+            annual_revenue REAL,
+            annual_profit REAL,
+            PRIMARY KEY (params_version, calculation_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS reevaluation_state (
+            params_version TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL,
+            max_id INTEGER NOT NULL,
+            started_at TEXT NOT NULL,
+            finished_at TEXT
+        );
+        """
+    )
+    # Background batch jobs; a chunk is done once finished_at is set.
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            created_at TEXT NOT NULL,
+            status TEXT NOT NULL,
+            format TEXT NOT NULL,
+            rows INTEGER,
+            chunks INTEGER,
+            done_rows INTEGER NOT NULL DEFAULT 0,
+            error_rows INTEGER NOT NULL DEFAULT 0,
+            owner TEXT,
+            heartbeat_at REAL,
+            started_at TEXT,
+            finished_at TEXT,
+            error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_status
+            ON jobs (status, created_at);
+        CREATE TABLE IF NOT EXISTS job_chunks (
+            job_id TEXT NOT NULL,
+            chunk INTEGER NOT NULL,
+            start_offset INTEGER NOT NULL,
+            end_offset INTEGER NOT NULL,
+            first_line INTEGER NOT NULL,
+            rows INTEGER NOT NULL,
+            error_rows INTEGER,
+            params_version TEXT,
+            finished_at TEXT,
+            PRIMARY KEY (job_id, chunk)
+        ) WITHOUT ROWID;
+        """
+    )
+    conn.commit()
+
+
+def add_missing_columns(conn, table, columns):
+    """ALTER TABLE ... ADD COLUMN for each of `columns` the table lacks."""
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for name, decl in columns.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+
+def ensure_schema(conn, path):
+    if path in _migrated_databases:
+        return
+    with _migrate_lock:
+        if path not in _migrated_databases:
+            init_db(conn)
+            _migrated_databases.add(path)
+
+
+_recorded_params_versions = set()
+
+
+def record_params_version(conn, param_set=None):
+    """Archive the parameter set in param_versions; caller owns the transaction."""
+    param_set = param_set or parameters.PARAMS
+    recorded = (DATABASE, param_set.version)
+    if recorded in _recorded_params_versions:
+        return
+    tables = param_set.tables
+    conn.execute(
+        "INSERT OR IGNORE INTO param_versions (version, created_at, source, params_json) "
+        "VALUES (?, ?, ?, ?)",
+        (
+            param_set.version,
+            param_set.loaded_at,
+            param_set.source,
+            json.dumps({key: tables[name] for key, name in PARAM_TABLES.items()}, sort_keys=True),
+        ),
+    )
+    _recorded_params_versions.add(recorded)
+
+
+# ==================
+#  Calculation log
+# ==================
+CALCULATION_COLUMNS = (
+    "created_at",
+    "country_code",
+    "currency_code",
+    "crop",
+    "system_type",
+    "area_m2",
+    "annual_yield",
+    "annual_revenue",
+    "annual_profit",
+    "inputs_json",
+    "result_id",
+    "params_version",
+)
+
+# "sync" commits each calculation before the redirect; "write_behind"
+# queues it for CalculationLogWriter to insert in batches.
+CALC_LOG_MODE = os.environ.get("MARO_CALC_LOG_MODE", "sync")
+CALC_LOG_BATCH_SIZE = int(os.environ.get("MARO_CALC_LOG_BATCH_SIZE", "500"))
+CALC_LOG_FLUSH_INTERVAL = float(os.environ.get("MARO_CALC_LOG_FLUSH_INTERVAL", "0.5"))
+CALC_LOG_QUEUE_SIZE = int(os.environ.get("MARO_CALC_LOG_QUEUE_SIZE", "10000"))
+# What submit() does when the queue is full:
+#   "block" waits up to CALC_LOG_BLOCK_TIMEOUT for room, then writes inline
+#   "sync"  writes the record inline straight away
+#   "drop"  discards it (counted in the stats)
+CALC_LOG_OVERFLOW = os.environ.get("MARO_CALC_LOG_OVERFLOW", "block")
+CALC_LOG_BLOCK_TIMEOUT = float(os.environ.get("MARO_CALC_LOG_BLOCK_TIMEOUT", "2.0"))
+CALC_LOG_RETRIES = 3
+
+
+def calculation_record(results, form=None, result_id=None):
+    return (
+        datetime.datetime.utcnow().isoformat(),
+        results["country_code"],
+        results["currency_code"],
+        results["crop"],
+        results["system_type"],
+        results["area"],
+        results["annual_yield"],
+        results["annual_revenue"],
+        results["annual_profit"],
+        json.dumps(form, sort_keys=True) if form is not None else None,
+        result_id,
+        parameters.PARAMS.version,
+    )
+
+
+def insert_calculations(conn, records):
+    """Insert calculation records (and their rollups) in one transaction."""
+    placeholders = ", ".join("?" for _ in CALCULATION_COLUMNS)
+    with conn:
+        conn.executemany(
+            f"INSERT INTO calculations ({', '.join(CALCULATION_COLUMNS)}) "
+            f"VALUES ({placeholders})",
+            records,
+        )
+        record_params_version(conn)
+        if ROLLUP_MODE == "inline":
+            _apply_rollups(conn)
+
+
+class CalculationLogWriter:
+    """
+    Background writer that batches calculation records into one
+    transaction per flush, on a size or time threshold.
+    """
+
+    def __init__(self, batch_size, flush_interval, max_queue, overflow):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        self._reset_counters()
+
+    def _reset_counters(self):
+        self.enqueued = self.written = self.dropped = self.failed = 0
+        self.written_inline = self.flushes = 0
+        self.last_flush_seconds = self.max_flush_seconds = 0.0
+
+    def _ensure_started(self):
+        # Restarted after a fork: each worker owns its queue and thread.
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None:
+                return
+            self._queue = queue.Queue(maxsize=self.max_queue)
+            self._stop = threading.Event()
+            self._reset_counters()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name="calc-log-writer", daemon=True
+            )
+            self._thread.start()
+
+    def submit(self, record):
+        """Queue a record; returns False if the overflow policy dropped it."""
+        self._ensure_started()
+        with self._lock:
+            self.enqueued += 1
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            pass
+
+        if self.overflow == "drop":
+            with self._lock:
+                self.dropped += 1
+            return False
+        if self.overflow == "block":
+            try:
+                self._queue.put(record, timeout=CALC_LOG_BLOCK_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        self._write([record], get_db())
+        with self._lock:
+            self.written_inline += 1
+        return True
+
+    def _write(self, records, conn):
+        started = time.perf_counter()
+        for attempt in range(CALC_LOG_RETRIES):
+            try:
+                insert_calculations(conn, records)
+                break
+            except sqlite3.Error as exc:
+                if attempt == CALC_LOG_RETRIES - 1:
+                    logger.error("dropping %d calculation records: %s", len(records), exc)
+                    with self._lock:
+                        self.failed += len(records)
+                    return
+                time.sleep(0.1 * (attempt + 1))
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.written += len(records)
+            self.flushes += 1
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stop.is_set():
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        conn = open_db()
+        try:
+            while not (self._stop.is_set() and self._queue.empty()):
+                batch = self._next_batch()
+                if batch:
+                    self._write(batch, conn)
+                    for _ in batch:
+                        self._queue.task_done()
+        finally:
+            conn.close()
+
+    def flush(self):
+        """Block until everything queued so far has been written."""
+        if self._pid == os.getpid() and self._thread is not None:
+            self._queue.join()
+
+    def close(self, timeout=10.0):
+        """Drain the queue and stop the writer thread (worker shutdown)."""
+        if self._pid != os.getpid() or self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def stats(self):
+        running = self._pid == os.getpid() and self._thread is not None
+        with self._lock:
+            return {
+                "mode": CALC_LOG_MODE,
+                "overflow_policy": self.overflow,
+                "queue_depth": self._queue.qsize() if running else 0,
+                "queue_capacity": self.max_queue,
+                "enqueued": self.enqueued,
+                "written": self.written,
+                "written_inline": self.written_inline,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "flushes": self.flushes,
+                "last_flush_seconds": self.last_flush_seconds,
+                "max_flush_seconds": self.max_flush_seconds,
+            }
+
+
+CALC_LOG_WRITER = CalculationLogWriter(
+    CALC_LOG_BATCH_SIZE, CALC_LOG_FLUSH_INTERVAL, CALC_LOG_QUEUE_SIZE, CALC_LOG_OVERFLOW
+)
+atexit.register(CALC_LOG_WRITER.close)
+
+
+def log_calculation(results, form=None, result_id=None):
+    record = calculation_record(results, form, result_id)
+    with phase("calc_log"):
+        if CALC_LOG_MODE == "write_behind":
+            CALC_LOG_WRITER.submit(record)
+        else:
+            insert_calculations(get_db(), [record])
+
+
+def log_calculations(records):
+    """log_calculation for many records: one transaction when writing inline."""
+    if not records:
+        return
+    with phase("calc_log"):
+        if CALC_LOG_MODE == "write_behind":
+            for record in records:
+                CALC_LOG_WRITER.submit(record)
+        else:
+            insert_calculations(get_db(), records)
+
+
+# ==================
+#  Analytics rollups
+# ==================
+# "inline" folds new rows into calculation_rollups inside the insert
+# transaction; "catch_up" leaves it to catch_up_rollups (run by the
+# analytics views and 'flask rebuild-rollups').
+ROLLUP_MODE = os.environ.get("MARO_ROLLUP_MODE", "inline")
+
+ROLLUP_DIMENSIONS = {
+    "day": "day",
+    "crop": "crop",
+    "country": "country_code",
+    "system": "system_type",
+}
+
+
+def _apply_rollups(conn):
+    # Caller owns the transaction.
+    row = conn.execute(
+        "SELECT last_id FROM rollup_state WHERE name = 'calculations'"
+    ).fetchone()
+    last_id = row[0] if row else 0
+    max_id = conn.execute("SELECT max(id) FROM calculations").fetchone()[0]
+    if max_id is None or max_id <= last_id:
+        return 0
+
+    cur = conn.execute(
+        """
+        INSERT INTO calculation_rollups (
+            day, crop, country_code, system_type, currency_code,
+            calculations, total_area_m2, total_annual_yield,
+            total_annual_revenue, total_annual_profit
+        )
+        SELECT substr(created_at, 1, 10),
+               coalesce(crop, ''),
+               coalesce(country_code, ''),
+               coalesce(system_type, ''),
+               coalesce(currency_code, ''),
+               count(*),
+               total(area_m2),
+               total(annual_yield),
+               total(annual_revenue),
+               total(annual_profit)
+        FROM calculations
+        WHERE id > ? AND id <= ?
+        GROUP BY 1, 2, 3, 4, 5
+        ON CONFLICT (day, crop, country_code, system_type, currency_code) DO UPDATE SET
+            calculations = calculations + excluded.calculations,
+            total_area_m2 = total_area_m2 + excluded.total_area_m2,
+            total_annual_yield = total_annual_yield + excluded.total_annual_yield,
+            total_annual_revenue = total_annual_revenue + excluded.total_annual_revenue,
+            total_annual_profit = total_annual_profit + excluded.total_annual_profit
+        """,
+        (last_id, max_id),
+    )
+    conn.execute(
+        """
+        INSERT INTO rollup_state (name, last_id) VALUES ('calculations', ?)
+        ON CONFLICT (name) DO UPDATE SET last_id = excluded.last_id
+        """,
+        (max_id,),
+    )
+    return cur.rowcount
+
+
+def catch_up_rollups(conn):
+    """Fold calculations not yet in the rollups into them."""
+    with conn:
+        return _apply_rollups(conn)
+
+
+def rebuild_rollups(conn):
+    """Recompute calculation_rollups from scratch in one transaction."""
+    with conn:
+        conn.execute("DELETE FROM calculation_rollups")
+        conn.execute("DELETE FROM rollup_state WHERE name = 'calculations'")
+        return _apply_rollups(conn)
+
+
+def reset_history(conn):
+    """
+    Delete the calculation history and everything derived from it, and
+    restart the ids, in one transaction.
+    """
+    with conn:
+        for table in ("calculations", "calculation_rollups", "rollup_state",
+                      "reevaluations", "reevaluation_state"):
+            conn.execute(f"DELETE FROM {table}")
+        conn.execute("DELETE FROM sqlite_sequence WHERE name = 'calculations'")
+
+
+def analytics_summary(conn, group_by=("day",), date_from=None, date_to=None, currency=None):
+    """
+    Calculation volume and average profit, revenue and yield from the
+    rollups, grouped by any of ROLLUP_DIMENSIONS and split by currency, or
+    converted into `currency` and merged (groups without a rate left out).
+    """
+    if currency:
+        return _converted_analytics_summary(conn, group_by, date_from, date_to, currency)
+    columns = [ROLLUP_DIMENSIONS[dim] for dim in group_by] + ["currency_code"]
+    clauses, params = [], []
+    if date_from:
+        clauses.append("day >= ?")
+        params.append(date_from)
+    if date_to:
+        clauses.append("day <= ?")
+        params.append(date_to)
+    where = " WHERE " + " AND ".join(clauses) if clauses else ""
+    dims = ", ".join(dict.fromkeys(columns))
+
+    rows = conn.execute(
+        f"""
+        SELECT {dims},
+               sum(calculations) AS calculations,
+               sum(total_area_m2) / sum(calculations) AS avg_area_m2,
+               sum(total_annual_yield) / sum(calculations) AS avg_annual_yield,
+               sum(total_annual_revenue) / sum(calculations) AS avg_annual_revenue,
+               sum(total_annual_profit) / sum(calculations) AS avg_annual_profit
+        FROM calculation_rollups{where}
+        GROUP BY {dims}
+        ORDER BY {dims}
+        """,
+        params,
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def _converted_analytics_summary(conn, group_by, date_from, date_to, currency):
+    rows = analytics_summary(conn, group_by, date_from, date_to)
+    if not rows:
+        if currency not in parameters.PARAMS.fx.index:
+            raise ValueError(f"no exchange rate for currency {currency!r}")
+        return []
+    money = ("avg_annual_revenue", "avg_annual_profit")
+    converted = convert_amounts(
+        [[row[key] * row["calculations"] for key in money] for row in rows],
+        [row["currency_code"] for row in rows],
+        currency,
+    )
+    dims = list(dict.fromkeys(ROLLUP_DIMENSIONS[dim] for dim in group_by))
+    merged = {}
+    for row, (revenue, profit) in zip(rows, converted.tolist()):
+        if math.isnan(revenue):
+            continue
+        key = tuple(row[dim] for dim in dims)
+        totals = merged.setdefault(key, [0, 0.0, 0.0, 0.0, 0.0])
+        count = row["calculations"]
+        totals[0] += count
+        totals[1] += row["avg_area_m2"] * count
+        totals[2] += row["avg_annual_yield"] * count
+        totals[3] += revenue
+        totals[4] += profit
+
+    return [
+        {
+            **dict(zip(dims, key)),
+            "currency_code": currency,
+            "calculations": count,
+            "avg_area_m2": area / count,
+            "avg_annual_yield": yield_ / count,
+            "avg_annual_revenue": revenue / count,
+            "avg_annual_profit": profit / count,
+        }
+        for key, (count, area, yield_, revenue, profit) in merged.items()
+    ]
+
+
+# =====================
+#  Stored results
+# =====================
+StoredResult = namedtuple("StoredResult", "id created_at params_version form results")
+
+
+def result_id_for(form, param_set=None):
+    """
+    Permalink id of a calculation: a hash of its normalized inputs
+    (calculation_key), so identical submissions share one stored result.
+    """
+    key = json.dumps(calculation_key(form, param_set), separators=(",", ":"))
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:20]
+
+
+def load_result(conn, result_id):
+    row = conn.execute(
+        "SELECT id, created_at, params_version, inputs_json, results_json "
+        "FROM results WHERE id = ?",
+        (result_id,),
+    ).fetchone()
+    if row is None:
+        return None
+    return StoredResult(
+        row["id"],
+        row["created_at"],
+        row["params_version"],
+        json.loads(row["inputs_json"]),
+        json.loads(row["results_json"]),
+    )
+
+
+def save_result(conn, result_id, form, results, param_set=None):
+    param_set = param_set or parameters.PARAMS
+    with conn:
+        record_params_version(conn, param_set)
+        conn.execute(
+            "INSERT OR IGNORE INTO results "
+            "(id, created_at, params_version, inputs_json, results_json) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (
+                result_id,
+                datetime.datetime.utcnow().isoformat(),
+                param_set.version,
+                json.dumps(form, sort_keys=True),
+                json.dumps(results),
+            ),
+        )
+
+
+def calculate_and_store(form):
+    """
+    calculate() backed by the results table: a submission whose inputs
+    were stored before is served from there without recomputing.
+    Returns (result_id, results, error); `form` is filled like calculate's.
+    """
+    conn = get_db()
+    param_set = parameters.PARAMS
+    result_id = result_id_for(form, param_set)
+    with phase("result_lookup"):
+        stored = load_result(conn, result_id)
+    if stored is not None:
+        form.update(stored.form)
+        return result_id, stored.results, None
+
+    results, error = calculate(form, param_set)
+    if results and not error:
+        with phase("result_store"):
+            save_result(conn, result_id, form, results, param_set)
+    return result_id, results, error
+
+
+def recent_calculations(conn, limit=10):
+    return conn.execute(
+        """
+        SELECT id, created_at, country_code, currency_code, crop,
+               system_type, area_m2, annual_yield, annual_profit
+        FROM calculations
+        ORDER BY id DESC
+        LIMIT ?
+        """,
+        (limit,),
+    ).fetchall()
+
+
+# Evaluated result graphs of stored results, for what-ifs.
+WHATIF_CACHE_SIZE = int(os.environ.get("MARO_WHATIF_CACHE_SIZE", "1024"))
+WHATIF_BASES = ResultCache(WHATIF_CACHE_SIZE, RESULT_CACHE_TTL)
+
+
+def whatif_base(conn, result_id):
+    """(submitted form, evaluated LazyResults) of a stored result, or None."""
+    key = (result_id, parameters.PARAMS.version)
+    cached = WHATIF_BASES.get(key)
+    if cached is None:
+        stored = load_result(conn, result_id)
+        if stored is None:
+            return None
+        form = submitted_form(stored.form)
+        base = LazyResults.from_form(form)
+        base.get()
+        cached = (form, base)
+        WHATIF_BASES.put(key, cached)
+    return cached
+
+
+# ====================
+#  History export
+# ====================
+HISTORY_EXPORT_CHUNK = 5000
+HISTORY_PAGE_SIZE = 50
+
+# query arg -> calculations column, for exact-match filters
+HISTORY_FILTER_COLUMNS = {
+    "crop": "crop",
+    "country": "country_code",
+    "system": "system_type",
+}
+
+
+def history_filters(args):
+    """
+    WHERE clause and parameters for the history filters in `args`:
+    crop, country, system, and a date_from / date_to range (YYYY-MM-DD,
+    both inclusive, or full ISO timestamps). Raises ValueError on a bad date.
+    """
+    clauses, params = [], []
+    for arg, column in HISTORY_FILTER_COLUMNS.items():
+        value = (args.get(arg) or "").strip()
+        if value:
+            clauses.append(f"{column} = ?")
+            params.append(value)
+
+    for arg, op in (("date_from", ">="), ("date_to", "<=")):
+        value = (args.get(arg) or "").strip()
+        if not value:
+            continue
+        try:
+            if len(value) == 10:
+                day = datetime.date.fromisoformat(value)
+                if op == "<=":
+                    # Whole day inclusive: everything before the next midnight.
+                    op, day = "<", day + datetime.timedelta(days=1)
+                value = day.isoformat()
+            else:
+                value = datetime.datetime.fromisoformat(value).isoformat()
+        except ValueError:
+            raise ValueError(f"{arg} must be a date (YYYY-MM-DD) or ISO timestamp")
+        clauses.append(f"created_at {op} ?")
+        params.append(value)
+
+    where = " WHERE " + " AND ".join(clauses) if clauses else ""
+    return where, params
+
+
+def history_cursor(row):
+    return f"{row['created_at']},{row['id']}"
+
+
+def _parse_history_cursor(value):
+    created_at, _, row_id = value.rpartition(",")
+    try:
+        datetime.datetime.fromisoformat(created_at)
+        return [created_at, int(row_id)]
+    except ValueError:
+        raise ValueError("invalid page cursor")
+
+
+def history_page(conn, args, page_size=HISTORY_PAGE_SIZE):
+    """
+    One keyset page of calculations, newest first by (created_at, id).
+    `before` / `after` in `args` are cursors from a previous page.
+    Returns (rows, older cursor or None, newer cursor or None).
+    """
+    where, params = history_filters(args)
+    joiner = " AND " if where else " WHERE "
+
+    before = (args.get("before") or "").strip()
+    after = (args.get("after") or "").strip()
+    if after:
+        sql = f"{where}{joiner}(created_at, id) > (?, ?) ORDER BY created_at ASC, id ASC LIMIT ?"
+        params = params + _parse_history_cursor(after) + [page_size + 1]
+    elif before:
+        sql = f"{where}{joiner}(created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?"
+        params = params + _parse_history_cursor(before) + [page_size + 1]
+    else:
+        sql = f"{where} ORDER BY created_at DESC, id DESC LIMIT ?"
+        params = params + [page_size + 1]
+
+    rows = conn.execute(
+        f"""
+        SELECT id,
+               created_at,
+               country_code,
+               currency_code,
+               crop,
+               system_type,
+               area_m2,
+               annual_yield,
+               annual_revenue,
+               annual_profit
+        FROM calculations{sql}
+        """,
+        params,
+    ).fetchall()
+
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    if after:
+        rows.reverse()
+        has_older, has_newer = True, more
+    else:
+        has_older, has_newer = more, bool(before)
+    older = history_cursor(rows[-1]) if rows and has_older else None
+    newer = history_cursor(rows[0]) if rows and has_newer else None
+    return rows, older, newer
+
+
+def iter_history_csv(where="", params=()):
+    """CSV of the calculations table, newest first, produced chunk by chunk."""
+    # Its own connection: the body is consumed after the view returns.
+    conn = open_db()
+    try:
+        cur = conn.execute(
+            f"""
+            SELECT created_at,
+                   country_code,
+                   currency_code,
+                   crop,
+                   system_type,
+                   area_m2,
+                   annual_yield,
+                   annual_revenue,
+                   annual_profit
+            FROM calculations{where}
+            ORDER BY created_at DESC, id DESC
+            """,
+            params,
+        )
+
+        output = StringIO()
+        writer = csv.writer(output)
+
+        writer.writerow([
+            "Date (UTC)",
+            "Country",
+            "Currency",
+            "Crop",
+            "System",
+            "Area (m2)",
+            "Annual Yield (kg)",
+            "Annual Revenue",
+            "Annual Profit",
+        ])
+
+        while True:
+            rows = cur.fetchmany(HISTORY_EXPORT_CHUNK)
+            if not rows:
+                break
+            for r in rows:
+                writer.writerow([
+                    r["created_at"],
+                    r["country_code"],
+                    r["currency_code"],
+                    r["crop"],
+                    r["system_type"],
+                    f"{r['area_m2']:.0f}",
+                    f"{r['annual_yield']:.0f}",
+                    f"{r['annual_revenue']:.2f}",
+                    f"{r['annual_profit']:.2f}",
+                ])
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate(0)
+
+        if output.tell():
+            yield output.getvalue()
+    finally:
+        conn.close()
+
+
+# calculations column -> dtype in the columnar export. Text columns are
+# dictionary-encoded as int32 codes plus a "<name>_categories" array.
+HISTORY_NPZ_COLUMNS = {
+    "id": np.int64,
+    "created_at": "datetime64[us]",
+    "country_code": "category",
+    "currency_code": "category",
+    "crop": "category",
+    "system_type": "category",
+    "area_m2": np.float64,
+    "annual_yield": np.float64,
+    "annual_revenue": np.float64,
+    "annual_profit": np.float64,
+}
+HISTORY_NPZ_CHUNK = 100_000
+
+
+def export_history_npz(path, where="", params=()):
+    """
+    Write the (filtered) calculations table to `path` as an uncompressed
+    .npz of raw columns, filled chunk by chunk through .npy memmaps.
+    Returns the number of rows written.
+    """
+    conn = open_db()
+    conn.row_factory = None
+    workdir = tempfile.mkdtemp(prefix="maro-npz-")
+    try:
+        # Pin the row set: rows inserted meanwhile get higher ids.
+        max_id, count = conn.execute(
+            f"SELECT max(id), count(*) FROM calculations{where}", params
+        ).fetchone()
+        joiner = " AND " if where else " WHERE "
+        cur = conn.execute(
+            f"SELECT {', '.join(HISTORY_NPZ_COLUMNS)} FROM calculations"
+            f"{where}{joiner}id <= ? ORDER BY id",
+            list(params) + [max_id or 0],
+        )
+
+        columns, categories = {}, {}
+        for name, dtype in HISTORY_NPZ_COLUMNS.items():
+            if dtype == "category":
+                dtype = np.int32
+                categories[name] = {}
+            columns[name] = np.lib.format.open_memmap(
+                os.path.join(workdir, f"{name}.npy"), mode="w+", dtype=dtype, shape=(count,)
+            )
+
+        offset = 0
+        while offset < count:
+            rows = cur.fetchmany(min(HISTORY_NPZ_CHUNK, count - offset))
+            if not rows:
+                break
+            end = offset + len(rows)
+            for i, (name, dtype) in enumerate(HISTORY_NPZ_COLUMNS.items()):
+                values = [row[i] for row in rows]
+                if dtype == "category":
+                    lookup = categories[name]
+                    columns[name][offset:end] = np.fromiter(
+                        (lookup.setdefault(v or "", len(lookup)) for v in values),
+                        dtype=np.int32, count=len(values),
+                    )
+                else:
+                    columns[name][offset:end] = np.array(values, dtype=dtype)
+            offset = end
+
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED, allowZip64=True) as zf:
+            for name, column in columns.items():
+                column.flush()
+                del column
+                zf.write(os.path.join(workdir, f"{name}.npy"), f"{name}.npy")
+            for name, lookup in categories.items():
+                with zf.open(f"{name}_categories.npy", "w", force_zip64=True) as f:
+                    np.lib.format.write_array(f, np.array(list(lookup), dtype=str))
+        columns.clear()
+        return offset
+    finally:
+        conn.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def load_history_npz(path):
+    """Memory-map every column of an export_history_npz file, read-only."""
+    arrays = {}
+    with zipfile.ZipFile(path) as zf, open(path, "rb") as f:
+        for info in zf.infolist():
+            name = info.filename[:-4] if info.filename.endswith(".npy") else info.filename
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.load(zf.open(info))
+                continue
+            # Data follows the local header and its name and extra fields.
+            f.seek(info.header_offset + 26)
+            name_len, extra_len = struct.unpack("<HH", f.read(4))
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            if not np.prod(shape):
+                arrays[name] = np.empty(shape, dtype=dtype)
+                continue
+            arrays[name] = np.memmap(
+                path, dtype=dtype, mode="r", offset=f.tell(), shape=shape,
+                order="F" if fortran else "C",
+            )
+    return arrays
+
+
+def decode_history_column(arrays, name):
+    """Text values of a dictionary-encoded column from load_history_npz."""
+    return arrays[f"{name}_categories"][arrays[name]]
+
+
+def stream_file_and_remove(path, chunk_size=1 << 20):
+    try:
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        os.remove(path)
+
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip framing
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# =========================
+#  History re-evaluation
+# =========================
+REEVALUATE_CHUNK_SIZE = int(os.environ.get("MARO_REEVALUATE_CHUNK_SIZE", "20000"))
+REEVALUATE_WORKERS = int(os.environ.get("MARO_REEVALUATE_WORKERS", "0")) or os.cpu_count() or 1
+
+
+def history_batch_columns(rows):
+    """
+    compute_results_batch columns for calculations rows. Rows logged
+    without inputs_json use form defaults beyond the logged columns.
+    """
+    forms = []
+    for row in rows:
+        form = json.loads(row["inputs_json"]) if row["inputs_json"] else None
+        if form is None:
+            form = {
+                "area_m2": row["area_m2"],
+                "crop": row["crop"],
+                "system_type": row["system_type"],
+                "country": row["country_code"],
+                "currency_override": row["currency_code"] or "",
+            }
+        for field, flag in CUSTOM_OVERRIDE_FLAGS.items():
+            if not form.get(flag):
+                form[field] = ""
+        forms.append(form)
+    return form_batch_columns(forms)
+
+
+def _reevaluate_chunk(args):
+    path, lo, hi, versions = args
+    ensure_params_version(versions)
+    param_set = parameters.PARAMS
+    conn = open_db(path)
+    try:
+        rows = conn.execute(
+            """
+            SELECT id, inputs_json, country_code, currency_code, crop,
+                   system_type, area_m2
+            FROM calculations WHERE id > ? AND id <= ? ORDER BY id
+            """,
+            (lo, hi),
+        ).fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        return hi, []
+
+    out = compute_results_batch(history_batch_columns(rows), param_set)
+    records = [
+        (
+            row["id"],
+            out["currency_code"][i],
+            float(out["annual_yield"][i]) if out["valid"][i] else None,
+            float(out["annual_revenue"][i]) if out["valid"][i] else None,
+            float(out["annual_profit"][i]) if out["valid"][i] else None,
+        )
+        for i, row in enumerate(rows)
+    ]
+    return hi, records
+
+
+def reevaluate_history(conn, chunk_size=REEVALUATE_CHUNK_SIZE, workers=REEVALUATE_WORKERS,
+                       restart=False, progress=None):
+    """
+    Recompute every calculation under the current parameter tables into
+    reevaluations. Chunks are written in id order with the run's
+    watermark, so an interrupted run resumes where it stopped. Returns
+    the reevaluation_state row as a dict.
+    """
+    param_set = parameters.PARAMS
+    version = param_set.version
+    with conn:
+        if restart:
+            conn.execute("DELETE FROM reevaluations WHERE params_version = ?", (version,))
+            conn.execute("DELETE FROM reevaluation_state WHERE params_version = ?", (version,))
+        max_id = conn.execute("SELECT coalesce(max(id), 0) FROM calculations").fetchone()[0]
+        conn.execute(
+            """
+            INSERT INTO reevaluation_state (params_version, last_id, max_id, started_at)
+            VALUES (?, 0, ?, ?)
+            ON CONFLICT (params_version) DO UPDATE SET
+                max_id = max(max_id, excluded.max_id), finished_at = NULL
+            """,
+            (version, max_id, datetime.datetime.utcnow().isoformat()),
+        )
+    state = conn.execute(
+        "SELECT last_id, max_id FROM reevaluation_state WHERE params_version = ?", (version,)
+    ).fetchone()
+    ranges = [
+        (DATABASE, lo, min(lo + chunk_size, state["max_id"]), params_versions(param_set))
+        for lo in range(state["last_id"], state["max_id"], chunk_size)
+    ]
+
+    def write(hi, records):
+        with conn:
+            conn.executemany(
+                """
+                INSERT OR REPLACE INTO reevaluations (
+                    calculation_id, params_version, currency_code,
+                    annual_yield, annual_revenue, annual_profit
+                ) VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                [(r[0], version, *r[1:]) for r in records],
+            )
+            conn.execute(
+                "UPDATE reevaluation_state SET last_id = ? WHERE params_version = ?",
+                (hi, version),
+            )
+        if progress:
+            progress(hi, state["max_id"], len(records))
+
+    if workers <= 1 or len(ranges) <= 1:
+        for task in ranges:
+            write(*_reevaluate_chunk(task))
+    else:
+        # A bounded window in flight, committed in id order.
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            tasks = iter(ranges)
+            for task in tasks:
+                pending.append(pool.submit(_reevaluate_chunk, task))
+                if len(pending) >= workers * 2:
+                    write(*pending.popleft().result())
+            while pending:
+                write(*pending.popleft().result())
+
+    with conn:
+        conn.execute(
+            "UPDATE reevaluation_state SET finished_at = ? WHERE params_version = ?",
+            (datetime.datetime.utcnow().isoformat(), version),
+        )
+    return dict(
+        conn.execute(
+            "SELECT * FROM reevaluation_state WHERE params_version = ?", (version,)
+        ).fetchone()
+    )
+
+
+def reevaluation_report(conn, version=None):
+    """
+    Old-vs-new deltas of a re-evaluation run, by crop and currency.
+    Rows whose currency changed can't be compared and are only counted.
+    """
+    version = version or parameters.PARAMS.version
+    state = conn.execute(
+        "SELECT * FROM reevaluation_state WHERE params_version = ?", (version,)
+    ).fetchone()
+    if state is None:
+        return None
+    rows = conn.execute(
+        """
+        SELECT crop, currency_code,
+               count(*) AS calculations,
+               sum(new_profit IS NULL) AS invalid,
+               sum(NOT same) AS currency_changed,
+               sum(same AND abs(new_profit - old_profit) > 1e-6) AS profit_changed,
+               total(CASE WHEN same THEN old_profit END) AS old_total_profit,
+               total(CASE WHEN same THEN new_profit END) AS new_total_profit,
+               avg(CASE WHEN same THEN new_profit - old_profit END) AS avg_profit_delta,
+               max(CASE WHEN same THEN abs(new_profit - old_profit) END) AS max_abs_profit_delta,
+               avg(CASE WHEN same THEN new_revenue - old_revenue END) AS avg_revenue_delta,
+               avg(CASE WHEN same THEN new_yield - old_yield END) AS avg_yield_delta
+        FROM (
+            SELECT c.crop, c.currency_code,
+                   coalesce(r.currency_code, '') = coalesce(c.currency_code, '') AS same,
+                   c.annual_profit AS old_profit, r.annual_profit AS new_profit,
+                   c.annual_revenue AS old_revenue, r.annual_revenue AS new_revenue,
+                   c.annual_yield AS old_yield, r.annual_yield AS new_yield
+            FROM reevaluations r
+            JOIN calculations c ON c.id = r.calculation_id
+            WHERE r.params_version = ?
+        )
+        GROUP BY crop, currency_code
+        ORDER BY crop, currency_code
+        """,
+        (version,),
+    ).fetchall()
+    return {"state": dict(state), "groups": [dict(row) for row in rows]}
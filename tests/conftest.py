@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Keep the tests off the tracked farm_calc.db and job directory.
+_TMP = tempfile.mkdtemp(prefix="maro-tests-")
+os.environ.setdefault("MARO_DATABASE", os.path.join(_TMP, "test.db"))
+os.environ.setdefault("MARO_JOBS_DIR", os.path.join(_TMP, "jobs"))
+os.environ.setdefault("MARO_JOB_RUNNER", "cli")
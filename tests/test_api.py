@@ -0,0 +1,45 @@
+import json
+import random
+
+import engine
+import jobs
+import parameters
+import storage
+
+
+def test_ndjson_rows_match_calculate():
+    rng = random.Random(3)
+    crops = sorted(parameters.PARAMS.tables["PRICE_PER_KG_USD"]["GLOBAL"])
+    systems = ["soil", "soilless", "vertical", "hydroponics", "aeroponics"]
+    scenarios = []
+    for _ in range(500):
+        scenario = {
+            "area_m2": rng.choice([0, 50, 1234.5]),
+            "crop": rng.choice(crops),
+            "system_type": rng.choice(systems),
+            "country": rng.choice(["US", "NG", "DE"]),
+            "use_solar": rng.random() < 0.5,
+        }
+        if rng.random() < 0.3:
+            scenario["price_per_unit"] = rng.choice([0, 3.5, -1])
+        scenarios.append(scenario)
+
+    lines = b"".join(jobs.iter_calculate_stream([json.dumps(s).encode() for s in scenarios]))
+    for scenario, line in zip(scenarios, lines.splitlines()):
+        results, error = engine.calculate(engine.scenario_form(scenario))
+        if results is None:
+            assert json.loads(line)["error"] == error
+        else:
+            # Same values and the same types (ints stay ints) as the scalar path.
+            assert line == jobs.dumps_json(results)
+
+
+def test_api_forms_carry_override_flags():
+    form = engine.scenario_form({"area_m2": 100, "price_per_unit": 9, "capex_per_m2": 0})
+    assert form["use_custom_price"] is True
+    assert form["use_custom_capex"] is False
+    assert form["use_custom_production_cost"] is False
+
+    # A logged API form replays with its override.
+    columns = storage.history_batch_columns([{"inputs_json": json.dumps(form)}])
+    assert columns["price_per_unit"] == [9.0]
@@ -0,0 +1,157 @@
+import asyncio
+import json
+from collections import deque
+
+import pytest
+
+import app as maro
+import asgi
+import engine
+import jobs
+import metrics
+import storage
+
+
+def http_scope(method, path, query=b"", headers=()):
+    return {
+        "type": "http", "method": method, "path": path, "query_string": query,
+        "headers": [(name.encode(), value.encode()) for name, value in headers],
+        "http_version": "1.1", "scheme": "http",
+    }
+
+
+async def request(server, method, path, chunks=(b"",), query=b"", headers=()):
+    incoming = deque(
+        {"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1}
+        for i, chunk in enumerate(chunks)
+    )
+    sent = []
+
+    async def receive():
+        if incoming:
+            return incoming.popleft()
+        # Like a server: nothing more until the client goes away.
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    await server(http_scope(method, path, query, headers), receive, send)
+    body = b"".join(message.get("body", b"") for message in sent[1:])
+    return sent[0]["status"], body
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 30))
+
+
+@pytest.fixture
+def server():
+    server = asgi.MaroASGI(maro.app, threads=2, wsgi_threads=2)
+    yield server
+    server.shutdown()
+
+
+def test_calculate_is_dispatched_without_flask(server, monkeypatch):
+    monkeypatch.setattr(server, "wsgi_app", None)
+    scenario = {"area_m2": 250, "crop": "lettuce", "country": "NG"}
+    status, body = run(request(server, "POST", "/api/v1/calculate", [json.dumps(scenario).encode()]))
+    assert status == 200
+    results, error = engine.calculate(engine.scenario_form(scenario))
+    assert error is None
+    assert json.loads(body) == json.loads(jobs.dumps_json(results))
+
+    status, body = run(request(server, "POST", "/api/v1/calculate", [b"[1]"]))
+    assert status == 400
+
+
+def test_api_routes_run_the_worker_hooks_and_label_their_phases(server, monkeypatch):
+    seen = []
+    monkeypatch.setattr(maro, "WORKER_HOOKS", [lambda: seen.append(metrics.route_label())])
+    status, _ = run(request(server, "POST", "/api/v1/calculate", [b'{"area_m2": 10}']))
+    assert status == 200
+    assert seen == ["api_v1_calculate"]
+    assert metrics.route_label() == "background"
+
+
+def test_oversized_api_body_is_rejected(server, monkeypatch):
+    monkeypatch.setattr(asgi, "ASGI_MAX_BODY", 10)
+    status, body = run(request(server, "POST", "/api/v1/calculate", [b'{"area_m2":', b' 100}']))
+    assert status == 413
+    assert json.loads(body) == {"error": "request body too large"}
+
+
+def test_ndjson_pipeline_matches_the_flask_route(server, monkeypatch):
+    # Every chunk goes to the process pool.
+    monkeypatch.setattr(asgi, "ASGI_INLINE_ROWS", 0)
+    monkeypatch.setattr(asgi, "ASGI_PIPELINE_DEPTH", 2)
+    monkeypatch.setattr(engine, "PROCESS_POOL_WORKERS", 2)
+    lines = [
+        json.dumps({"area_m2": 50 + i, "crop": "tomato", "country": "US"}).encode()
+        for i in range(300)
+    ]
+    lines[7] = b"not json"
+    body = b"\n".join(lines)
+
+    status, streamed = run(request(server, "POST", "/api/v1/calculate.ndjson", [body]))
+    assert status == 200
+    expected = maro.app.test_client().post("/api/v1/calculate.ndjson", data=body).get_data()
+    assert streamed.splitlines() == expected.splitlines()
+    assert len(streamed.splitlines()) == 300
+    assert b'"error"' in streamed.splitlines()[7]
+
+
+def test_other_routes_run_the_flask_app(server):
+    status, body = run(request(server, "GET", "/"))
+    assert status == 200
+    assert b"<form" in body
+
+    upload = [b'{"area_m2": 10}\n', b'{"area_m2": 20}\n', b'{"area_m2": 30}\n']
+    status, body = run(request(
+        server, "POST", "/api/jobs", upload, query=b"format=ndjson",
+        headers=[("content-type", "application/x-ndjson"),
+                 ("content-length", str(sum(map(len, upload))))],
+    ))
+    assert status == 202
+    job = json.loads(body)
+    conn = storage.open_db()
+    try:
+        jobs.JobRunner(workers=1).run_pending(conn)
+    finally:
+        conn.close()
+    status, body = run(request(server, "GET", job["status_url"]))
+    assert status == 200
+    assert json.loads(body)["rows"] == 3
+
+
+def test_a_stalled_page_does_not_block_the_api(server):
+    server.threads = server.wsgi_threads = 1
+
+    def endless(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        while True:
+            yield b"x" * 1024
+
+    server.wsgi_app = endless
+
+    async def stalled_send(message):
+        # A client that never reads its response.
+        await asyncio.Event().wait()
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def scenario():
+        stalled = asyncio.create_task(server(http_scope("GET", "/endless"), receive, stalled_send))
+        await asyncio.sleep(0.2)
+        try:
+            status, _ = await asyncio.wait_for(
+                request(server, "POST", "/api/v1/calculate", [b'{"area_m2": 10}']), 5
+            )
+        finally:
+            stalled.cancel()
+            await asyncio.gather(stalled, return_exceptions=True)
+        return status
+
+    assert run(scenario()) == 200
+
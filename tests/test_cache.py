@@ -0,0 +1,89 @@
+import copy
+
+import pytest
+
+import engine
+import parameters
+
+FORM = {"area_m2": "300", "crop": "lettuce", "system_type": "soil", "country": "US"}
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = engine.ResultCache(16, 3600)
+    monkeypatch.setattr(engine, "RESULT_CACHE", cache)
+    fx = parameters.PARAMS.fx
+    yield cache
+    parameters.install_params({}, "builtin")
+    parameters.install_fx_table(fx)
+
+
+def test_repeated_inputs_hit_and_fill_the_form_alike(cache):
+    first = dict(FORM)
+    expected, error = engine.calculate(first)
+    assert error is None
+    assert (cache.misses, cache.hits) == (1, 0)
+
+    # Spellings the scalar path parses the same way share the entry.
+    for variant in ({"area_m2": " 300.0 "}, {"price_per_unit": "0"}, {"capex_per_m2": "-5"}):
+        form = {**FORM, **variant}
+        results, error = engine.calculate(form)
+        assert error is None
+        assert results == expected
+        assert form["annual_production_cost"] == first["annual_production_cost"]
+        assert form[engine.ESTIMATED_FIELDS] == first[engine.ESTIMATED_FIELDS]
+    assert (cache.misses, cache.hits) == (1, 3)
+
+    # A cached result handed out is a copy.
+    results["annual_profit"] = None
+    assert engine.calculate(dict(FORM))[0] == expected
+
+
+def test_other_inputs_miss(cache):
+    engine.calculate(dict(FORM))
+    engine.calculate({**FORM, "price_per_unit": "4"})
+    engine.calculate({**FORM, "use_solar": True})
+    assert (cache.misses, cache.hits) == (3, 0)
+
+
+def test_least_recently_used_entries_are_evicted_first():
+    cache = engine.ResultCache(2, 3600)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats()["evictions"] == 1
+
+
+def test_entries_expire():
+    cache = engine.ResultCache(2, -1)
+    cache.put("a", 1)
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+    assert cache.stats()["size"] == 0
+
+
+def test_new_params_invalidate_their_results(cache):
+    before, _ = engine.calculate(dict(FORM))
+    params = copy.deepcopy(parameters.current_params())
+    params["price_per_kg_usd"]["US"]["lettuce"] = 9.0
+    parameters.install_params(params, "test")
+
+    after, _ = engine.calculate(dict(FORM))
+    assert (cache.misses, cache.hits) == (2, 0)
+    assert before["price_per_kg"] != after["price_per_kg"] == 9.0
+
+
+def test_new_rates_invalidate_only_their_currency(cache):
+    eur_form = {**FORM, "currency_override": "EUR"}
+    engine.calculate(dict(FORM))
+    engine.calculate(dict(eur_form))
+    rates = {**parameters.PARAMS.fx.rates, "EUR": parameters.PARAMS.fx.rates["EUR"] * 1.1}
+    parameters.install_fx_table(parameters.make_fx_table(rates))
+
+    engine.calculate(dict(FORM))
+    assert (cache.misses, cache.hits) == (2, 1)
+    engine.calculate(dict(eur_form))
+    assert (cache.misses, cache.hits) == (3, 1)
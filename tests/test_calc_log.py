@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+import app
+import engine
+import storage
+
+
+@pytest.fixture
+def conn():
+    conn = storage.open_db()
+    conn.execute("DELETE FROM calculations")
+    conn.commit()
+    yield conn
+    conn.execute("DELETE FROM calculations")
+    conn.commit()
+    conn.close()
+
+
+def record():
+    results, error = engine.calculate({"area_m2": "100", "crop": "tomato", "country": "US"})
+    assert error is None
+    return storage.calculation_record(results)
+
+
+def count(conn):
+    return conn.execute("SELECT COUNT(*) FROM calculations").fetchone()[0]
+
+
+def test_write_behind_flushes_in_batches(conn):
+    writer = storage.CalculationLogWriter(batch_size=50, flush_interval=0.05, max_queue=1000, overflow="block")
+    for _ in range(120):
+        assert writer.submit(record())
+    writer.flush()
+    assert count(conn) == 120
+    stats = writer.stats()
+    assert stats["written"] == 120
+    assert 3 <= stats["flushes"] <= 120
+    writer.close()
+
+
+def stalled_writer(overflow, max_queue=2):
+    # The writer thread waits on `release` before taking anything from
+    # the queue, so the queue fills up.
+    writer = storage.CalculationLogWriter(batch_size=10, flush_interval=0.05, max_queue=max_queue, overflow=overflow)
+    release = threading.Event()
+    next_batch = writer._next_batch
+
+    def wait_then_next_batch():
+        release.wait()
+        return next_batch()
+
+    writer._next_batch = wait_then_next_batch
+    return writer, release
+
+
+@pytest.mark.parametrize("overflow, kept", [("drop", 2), ("sync", 3), ("block", 3)])
+def test_overflow_policies(conn, monkeypatch, overflow, kept):
+    monkeypatch.setattr(storage, "CALC_LOG_BLOCK_TIMEOUT", 0.05)
+    writer, release = stalled_writer(overflow)
+    with app.app.app_context():
+        results = [writer.submit(record()) for _ in range(3)]
+    assert results == [True, True, overflow != "drop"]
+    release.set()
+    writer.close()
+
+    stats = writer.stats()
+    assert count(conn) == kept
+    assert stats["written"] == kept
+    assert stats["dropped"] == 3 - kept
+    assert stats["written_inline"] == (1 if overflow != "drop" else 0)
+    assert stats["enqueued"] == stats["written"] + stats["dropped"] + stats["failed"]
+
+
+def test_shutdown_worker_drains_the_queue(conn, monkeypatch):
+    writer = storage.CalculationLogWriter(batch_size=500, flush_interval=5, max_queue=1000, overflow="block")
+    monkeypatch.setattr(storage, "CALC_LOG_WRITER", writer)
+    for _ in range(10):
+        writer.submit(record())
+    app.shutdown_worker()
+    assert count(conn) == 10
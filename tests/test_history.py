@@ -0,0 +1,231 @@
+import csv
+import datetime
+import gzip
+import io
+import random
+
+import numpy as np
+import pytest
+
+import app
+import parameters
+import storage
+
+
+@pytest.fixture
+def conn():
+    conn = storage.open_db()
+    conn.execute("DELETE FROM calculations")
+    # Shuffled timestamps: ids don't follow created_at, as with the
+    # write-behind logger inserting a late batch.
+    rng = random.Random(7)
+    start = datetime.datetime(2026, 1, 1)
+    conn.executemany(
+        "INSERT INTO calculations (created_at, country_code, currency_code, crop, system_type, "
+        "area_m2, annual_yield, annual_revenue, annual_profit) VALUES (?, 'US', 'USD', ?, 'soilless', 1, 1, 1, 1)",
+        [
+            ((start + datetime.timedelta(minutes=rng.randrange(60 * 24 * 60))).isoformat(),
+             rng.choice(["tomato", "lettuce"]))
+            for _ in range(300)
+        ],
+    )
+    conn.commit()
+    yield conn
+    conn.execute("DELETE FROM calculations")
+    conn.commit()
+    conn.close()
+
+
+@pytest.mark.parametrize("args", [
+    {},
+    {"crop": "tomato"},
+    {"date_from": "2026-01-15", "date_to": "2026-02-10"},
+    {"crop": "lettuce", "date_from": "2026-02-01"},
+])
+def test_history_pages_follow_created_at(conn, args):
+    where, params = storage.history_filters(args)
+    expected = [
+        row["id"]
+        for row in conn.execute(
+            f"SELECT id FROM calculations{where} ORDER BY created_at DESC, id DESC", params
+        )
+    ]
+
+    seen, page_args = [], dict(args)
+    while True:
+        rows, older, newer = storage.history_page(conn, page_args, page_size=23)
+        seen += [row["id"] for row in rows]
+        if older is None:
+            break
+        page_args = dict(args, before=older)
+    assert seen == expected
+
+    # And back up again from the last page.
+    seen = [row["id"] for row in rows]
+    while newer is not None:
+        rows, older, newer = storage.history_page(conn, dict(args, after=newer), page_size=23)
+        seen = [row["id"] for row in rows] + seen
+    assert seen == expected
+
+
+def test_history_page_rejects_bad_cursor(conn):
+    with pytest.raises(ValueError):
+        storage.history_page(conn, {"before": "yesterday,3"})
+
+
+def export_before_streaming(conn):
+    # The export as it was built in memory before it streamed (newest id
+    # first, the same formatting).
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow([
+        "Date (UTC)", "Country", "Currency", "Crop", "System",
+        "Area (m2)", "Annual Yield (kg)", "Annual Revenue", "Annual Profit",
+    ])
+    for r in conn.execute("SELECT * FROM calculations ORDER BY id DESC"):
+        writer.writerow([
+            r["created_at"], r["country_code"], r["currency_code"], r["crop"], r["system_type"],
+            f"{r['area_m2']:.0f}", f"{r['annual_yield']:.0f}",
+            f"{r['annual_revenue']:.2f}", f"{r['annual_profit']:.2f}",
+        ])
+    return output.getvalue().encode("utf-8")
+
+
+@pytest.fixture
+def logged(monkeypatch):
+    # Ids follow created_at, as when each calculation is logged as it
+    # happens.
+    monkeypatch.setattr(storage, "HISTORY_EXPORT_CHUNK", 17)
+    conn = storage.open_db()
+    conn.execute("DELETE FROM calculations")
+    rng = random.Random(9)
+    start = datetime.datetime(2026, 3, 1)
+    conn.executemany(
+        "INSERT INTO calculations (created_at, country_code, currency_code, crop, system_type, "
+        "area_m2, annual_yield, annual_revenue, annual_profit) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            ((start + datetime.timedelta(minutes=7 * i)).isoformat(),
+             rng.choice(["US", "NG"]), rng.choice(["USD", "NGN"]),
+             rng.choice(["tomato", "basil, sweet", None]), "soilless",
+             rng.uniform(1, 5000), rng.uniform(0, 1e5), rng.uniform(0, 1e6), rng.uniform(-1e5, 1e6))
+            for i in range(200)
+        ],
+    )
+    conn.commit()
+    yield conn
+    conn.execute("DELETE FROM calculations")
+    conn.commit()
+    conn.close()
+
+
+def test_streamed_export_matches_the_in_memory_one(logged):
+    client = app.app.test_client()
+    expected = export_before_streaming(logged)
+
+    response = client.get("/admin/history/download")
+    assert response.status_code == 200
+    assert response.mimetype == "text/csv"
+    assert response.get_data() == expected
+
+    response = client.get("/admin/history/download?gzip=1")
+    assert response.mimetype == "application/gzip"
+    assert "maro_history.csv.gz" in response.headers["Content-Disposition"]
+    assert gzip.decompress(response.get_data()) == expected
+
+
+def test_filtered_export_keeps_the_matching_rows(logged):
+    header, *rows = export_before_streaming(logged).decode("utf-8").splitlines()
+    wanted = [row for row in rows if row.split(",")[3] == "tomato" and row >= "2026-03-01T12"]
+    response = app.app.test_client().get(
+        "/admin/history/download?crop=tomato&date_from=2026-03-01T12:00"
+    )
+    assert response.get_data(as_text=True).splitlines() == [header] + wanted
+
+
+def test_npz_export_round_trips(logged, monkeypatch, tmp_path):
+    monkeypatch.setattr(storage, "HISTORY_NPZ_CHUNK", 13)
+    path = str(tmp_path / "history.npz")
+    assert storage.export_history_npz(path) == 200
+    arrays = storage.load_history_npz(path)
+    rows = logged.execute("SELECT * FROM calculations ORDER BY id").fetchall()
+
+    assert isinstance(arrays["area_m2"], np.memmap)
+    assert arrays["id"].tolist() == [row["id"] for row in rows]
+    assert arrays["created_at"].tolist() == [
+        datetime.datetime.fromisoformat(row["created_at"]) for row in rows
+    ]
+    for name in ("area_m2", "annual_yield", "annual_revenue", "annual_profit"):
+        assert arrays[name].tolist() == [row[name] for row in rows]
+    for name in ("country_code", "currency_code", "crop", "system_type"):
+        assert storage.decode_history_column(arrays, name).tolist() == [row[name] or "" for row in rows]
+
+    # A plain .npz as far as numpy is concerned.
+    with np.load(path) as loaded:
+        assert sorted(loaded.files) == sorted(arrays)
+        assert (loaded["annual_profit"] == arrays["annual_profit"]).all()
+
+
+def test_npz_download_applies_the_filters(logged, tmp_path):
+    response = app.app.test_client().get("/admin/history/download.npz?crop=tomato")
+    assert response.status_code == 200
+    path = tmp_path / "history.npz"
+    path.write_bytes(response.get_data())
+    arrays = storage.load_history_npz(str(path))
+    assert arrays["id"].tolist() == [
+        row["id"] for row in logged.execute("SELECT id FROM calculations WHERE crop = 'tomato' ORDER BY id")
+    ]
+    assert set(storage.decode_history_column(arrays, "crop").tolist()) == {"tomato"}
+
+    empty = tmp_path / "empty.npz"
+    assert storage.export_history_npz(str(empty), " WHERE crop = ?", ("okra",)) == 0
+    assert storage.load_history_npz(str(empty))["area_m2"].shape == (0,)
+
+
+class Interrupted(Exception):
+    pass
+
+
+def reevaluated(conn, version):
+    return conn.execute(
+        "SELECT calculation_id, currency_code, annual_yield, annual_revenue, annual_profit "
+        "FROM reevaluations WHERE params_version = ? ORDER BY calculation_id",
+        (version,),
+    ).fetchall()
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_reevaluation_resumes_after_an_interruption(logged, workers):
+    version = parameters.PARAMS.version
+    written = []
+
+    def interrupt(hi, max_id, count):
+        written.append(hi)
+        if len(written) == 3:
+            raise Interrupted
+
+    with pytest.raises(Interrupted):
+        storage.reevaluate_history(logged, chunk_size=30, workers=workers, restart=True, progress=interrupt)
+    state = logged.execute(
+        "SELECT * FROM reevaluation_state WHERE params_version = ?", (version,)
+    ).fetchone()
+    assert state["last_id"] == written[-1]
+    assert state["finished_at"] is None
+    done = reevaluated(logged, version)
+    assert [row[0] for row in done] == [
+        row[0] for row in logged.execute("SELECT id FROM calculations WHERE id <= ? ORDER BY id", (written[-1],))
+    ]
+
+    resumed = []
+    state = storage.reevaluate_history(
+        logged, chunk_size=30, workers=workers,
+        progress=lambda hi, max_id, count: resumed.append(hi),
+    )
+    assert min(resumed) > written[-1]
+    assert state["finished_at"] is not None
+    assert state["last_id"] == state["max_id"] == logged.execute("SELECT max(id) FROM calculations").fetchone()[0]
+    interrupted = reevaluated(logged, version)
+
+    # The same rows as a run that was never interrupted.
+    storage.reevaluate_history(logged, chunk_size=30, workers=1, restart=True)
+    assert [tuple(row) for row in interrupted] == [tuple(row) for row in reevaluated(logged, version)]
+    assert len(interrupted) == 200
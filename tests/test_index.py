@@ -0,0 +1,53 @@
+import re
+
+import app
+import parameters
+
+
+def selected_countries(html):
+    return re.findall(r'<option value="([A-Z]{2})" selected>', html)
+
+
+def test_index_answers_conditional_gets():
+    client = app.app.test_client()
+    first = client.get("/")
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+    assert first.headers["Cache-Control"] == "no-cache"
+
+    assert client.get("/", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/", headers={"If-None-Match": '"stale"'}).status_code == 200
+    since = first.headers["Last-Modified"]
+    assert client.get("/", headers={"If-Modified-Since": since}).status_code == 304
+
+
+def test_index_page_changes_with_the_country_snapshot(monkeypatch):
+    client = app.app.test_client()
+    etag = client.get("/").headers["ETag"]
+    countries = [
+        {"code": "KE", "name": "Kenya", "currency_code": "KES", "currency_symbol": "KSh"},
+        {"code": "GH", "name": "Ghana & Co", "currency_code": "GHS", "currency_symbol": "GH₵"},
+    ]
+    monkeypatch.setattr(parameters, "COUNTRY_SNAPSHOT", parameters.make_country_snapshot(countries))
+    monkeypatch.setattr(parameters, "COUNTRIES", countries)
+    page = client.get("/", headers={"If-None-Match": etag})
+    assert page.status_code == 200
+    html = page.get_data(as_text=True)
+    assert selected_countries(html) == ["KE"]
+    assert "Ghana &amp; Co" in html
+
+
+def test_country_options_mark_one_selection():
+    with app.app.test_request_context():
+        code = parameters.COUNTRIES[-1]["code"]
+        html = str(app.country_options_html(code))
+        assert selected_countries(html) == [code]
+        assert html.count("<option") == len(parameters.COUNTRIES)
+        assert selected_countries(str(app.country_options_html("nowhere"))) == []
+
+
+def test_rejected_form_keeps_the_chosen_country():
+    code = parameters.COUNTRIES[-1]["code"]
+    response = app.app.test_client().post("/", data={"area_m2": "0", "country": code})
+    assert response.status_code == 200
+    assert selected_countries(response.get_data(as_text=True)) == [code]
@@ -0,0 +1,112 @@
+import datetime
+import io
+import os
+import subprocess
+import sys
+
+import pytest
+
+import app
+import jobs
+import storage
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def conn():
+    conn = storage.open_db()
+    yield conn
+    conn.close()
+
+
+def run_job(conn, body, fmt):
+    job_id = jobs.create_job(conn, io.BytesIO(body), fmt)
+    jobs.JobRunner(workers=1).run_pending(conn)
+    status = jobs.job_status(conn, job_id)
+    results = b"".join(jobs.iter_job_results(job_id, status["chunks"] or 0))
+    return job_id, status, results.splitlines()
+
+
+def test_csv_upload_with_byte_order_mark(conn):
+    body = "﻿area_m2,crop,country\r\n100,lettuce,US\r\n200,tomato,NG\r\n".encode("utf-8")
+    _, status, lines = run_job(conn, body, "csv")
+    assert status["status"] == "done"
+    assert status["error_rows"] == 0
+    assert len(lines) == 2
+
+
+def test_upload_over_the_limit_is_rejected(conn):
+    before = set(os.listdir(jobs.JOBS_DIR)) if os.path.isdir(jobs.JOBS_DIR) else set()
+    with pytest.raises(jobs.JobUploadTooLarge):
+        jobs.create_job(conn, io.BytesIO(b"x" * 100), "ndjson", max_bytes=10)
+    assert set(os.listdir(jobs.JOBS_DIR)) == before
+
+    response = app.app.test_client().post(
+        "/api/jobs?format=ndjson", data=b"{}\n" * 10, content_type="application/x-ndjson"
+    )
+    assert response.status_code == 202
+    old = jobs.JOB_MAX_UPLOAD_BYTES
+    jobs.JOB_MAX_UPLOAD_BYTES = 10
+    try:
+        response = app.app.test_client().post(
+            "/api/jobs?format=ndjson", data=b"{}\n" * 10, content_type="application/x-ndjson"
+        )
+    finally:
+        jobs.JOB_MAX_UPLOAD_BYTES = old
+    assert response.status_code == 413
+
+
+def test_sweep_deletes_only_expired_finished_jobs(conn):
+    old_id, _, _ = run_job(conn, b'{"area_m2": 10}\n', "ndjson")
+    new_id, _, _ = run_job(conn, b'{"area_m2": 20}\n', "ndjson")
+    queued_id = jobs.create_job(conn, io.BytesIO(b'{"area_m2": 30}\n'), "ndjson")
+    long_ago = (datetime.datetime.utcnow() - datetime.timedelta(days=30)).isoformat()
+    with conn:
+        conn.execute("UPDATE jobs SET finished_at = ? WHERE id = ?", (long_ago, old_id))
+
+    assert jobs.sweep_jobs(conn, retention=86400) == 1
+    assert jobs.job_status(conn, old_id) is None
+    assert not os.path.exists(jobs.job_dir(old_id))
+    assert jobs.job_status(conn, new_id)["status"] == "done"
+    assert jobs.job_status(conn, queued_id)["status"] == "queued"
+    jobs.delete_job(conn, queued_id)
+
+
+def test_error_rows_are_counted_per_scenario(conn):
+    body = b'{"area_m2": 10}\nnot json\n{"area_m2": -5}\n{"area_m2": 40}\n'
+    _, status, lines = run_job(conn, body, "ndjson")
+    assert status["status"] == "done"
+    assert (status["rows"], status["error_rows"]) == (4, 2)
+    assert [jobs.loads_json(line).get("line") for line in lines] == [None, 2, 3, None]
+
+
+HOLD_LOCK = """
+import sys
+import jobs
+assert jobs.JOB_RUNNER._take_host_lock()
+print("locked", flush=True)
+sys.stdin.read()
+"""
+
+
+def test_one_web_worker_per_host_runs_jobs(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_POLL_INTERVAL", 0)
+    holder = subprocess.Popen(
+        [sys.executable, "-c", HOLD_LOCK], cwd=ROOT,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+    )
+    try:
+        assert holder.stdout.readline().strip() == "locked"
+        runner = jobs.JobRunner(workers=1)
+        runner._run = lambda: None
+        runner.ensure_started()
+        assert runner._thread is None
+    finally:
+        holder.stdin.close()
+        holder.wait(timeout=30)
+
+    # The lock goes away with the process that held it.
+    runner.ensure_started()
+    assert runner._thread is not None
+    runner._host_lock.close()
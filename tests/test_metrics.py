@@ -0,0 +1,75 @@
+import re
+
+import pytest
+
+import app
+import metrics
+
+SAMPLE = re.compile(r'^([a-z_]+)(?:\{((?:[a-z_]+="[^"]*",?)*)\})? (\S+)$')
+
+
+def test_histograms_render_cumulative_buckets():
+    recorder = metrics.Metrics(buckets=(0.1, 1.0))
+    labels = (("route", "index"), ("phase", "compute_results"))
+    for seconds in (0.05, 0.5, 0.5, 5.0):
+        recorder.observe("maro_phase_seconds", labels, seconds)
+    recorder.count_request((("route", "index"), ("method", "GET"), ("status", 200)))
+
+    text = recorder.render([("maro_result_cache_size", "gauge", "Entries in the result cache.", 3)])
+    assert text.endswith("\n")
+    series = 'route="index",phase="compute_results"'
+    for line in (
+        'maro_requests_total{route="index",method="GET",status="200"} 1',
+        f'maro_phase_seconds_bucket{{{series},le="0.1"}} 1',
+        f'maro_phase_seconds_bucket{{{series},le="1.0"}} 3',
+        f'maro_phase_seconds_bucket{{{series},le="+Inf"}} 4',
+        f"maro_phase_seconds_sum{{{series}}} 6.05",
+        f"maro_phase_seconds_count{{{series}}} 4",
+        "# TYPE maro_result_cache_size gauge",
+        "maro_result_cache_size 3",
+    ):
+        assert line in text.splitlines()
+
+
+def test_admin_metrics_is_prometheus_text():
+    metrics.METRICS.reset()
+    client = app.app.test_client()
+    assert client.post("/", data={"area_m2": "1618", "crop": "basil", "country": "NG"}).status_code == 302
+    assert client.post("/api/v1/calculate", json={"area_m2": 10}).status_code == 200
+
+    response = client.get("/admin/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    assert response.mimetype_params["version"] == "0.0.4"
+
+    types, samples = {}, {}
+    for line in response.get_data(as_text=True).splitlines():
+        if line.startswith("# TYPE "):
+            _, _, name, kind = line.split(" ")
+            types[name] = kind
+            continue
+        if line.startswith("# HELP "):
+            continue
+        match = SAMPLE.match(line)
+        assert match, line
+        name, labels, value = match.groups()
+        family = re.sub(r"_(bucket|sum|count)$", "", name) if name not in types else name
+        assert family in types, line
+        samples[(name, labels or "")] = float(value)
+
+    assert types["maro_requests_total"] == "counter"
+    assert types["maro_request_seconds"] == types["maro_phase_seconds"] == "histogram"
+    assert samples[("maro_requests_total", 'route="index",method="POST",status="302"')] == 1
+    assert samples[("maro_requests_total", 'route="api_v1_calculate",method="POST",status="200"')] == 1
+    assert samples[("maro_request_seconds_count", 'route="index"')] == 1
+    assert ("maro_phase_seconds_count", 'route="index",phase="compute_results"') in samples
+    for name in ("maro_result_cache_hits_total", "maro_result_cache_size", "maro_calc_log_queue_depth"):
+        assert (name, "") in samples
+
+    # Buckets are cumulative and end at the count.
+    buckets = [
+        value for (name, labels), value in samples.items()
+        if name == "maro_request_seconds_bucket" and labels.startswith('route="index",')
+    ]
+    assert buckets == sorted(buckets)
+    assert buckets[-1] == pytest.approx(1)
@@ -0,0 +1,102 @@
+import itertools
+
+import numpy as np
+import pytest
+
+import analysis
+
+
+def brute_force_max(c, rows, senses, rhs):
+    """Best vertex of the LP by enumerating every basis; None if infeasible."""
+    c = np.asarray(c, dtype=float)
+    n = len(c)
+    A = [np.asarray(r, dtype=float) for r in rows] + list(-np.eye(n))
+    b = list(rhs) + [0.0] * n
+    kinds = list(senses) + ["<="] * n
+    best = None
+    for subset in itertools.combinations(range(len(A)), n):
+        M = np.array([A[i] for i in subset])
+        if abs(np.linalg.det(M)) < 1e-12:
+            continue
+        x = np.linalg.solve(M, np.array([b[i] for i in subset]))
+        ok = all(
+            (a @ x <= bi + 1e-7) if k == "<=" else (a @ x >= bi - 1e-7) if k == ">=" else abs(a @ x - bi) < 1e-7
+            for a, bi, k in zip(A, b, kinds)
+        )
+        if ok and (best is None or c @ x > best + 1e-9):
+            best = c @ x
+    return best
+
+
+def test_simplex_textbook_optimum():
+    # max 3x + 5y; x <= 4, 2y <= 12, 3x + 2y <= 18 -> (2, 6), 36
+    x = analysis.simplex_max([3, 5], [[1, 0], [0, 2], [3, 2]], ["<="] * 3, [4, 12, 18])
+    assert np.allclose(x, [2, 6])
+
+
+def test_simplex_equality_and_lower_bounds():
+    # max x + 2y; x + y <= 10, x >= 3, x - y == 0 -> (5, 5)
+    x = analysis.simplex_max([1, 2], [[1, 1], [1, 0], [1, -1]], ["<=", ">=", "=="], [10, 3, 0])
+    assert np.allclose(x, [5, 5])
+
+
+def test_simplex_infeasible_and_unbounded():
+    assert analysis.simplex_max([1], [[1], [1]], ["<=", ">="], [1, 2]) is None
+    with pytest.raises(ValueError):
+        analysis.simplex_max([1, 0], [[1, -1]], ["<="], [1])
+
+
+def test_simplex_degenerate_beale():
+    # Beale's example cycles under the textbook pivot rule; optimum 5/4.
+    c = [0.75, -20, 0.5, -6]
+    rows = [[0.25, -8, -1, 9], [0.5, -12, -0.5, 3], [0, 0, 1, 0]]
+    x = analysis.simplex_max(c, rows, ["<="] * 3, [0, 0, 1])
+    assert np.dot(c, x) == pytest.approx(1.25)
+
+
+def test_simplex_matches_vertex_enumeration():
+    rng = np.random.default_rng(7)
+    for _ in range(200):
+        n, m = rng.integers(2, 4), rng.integers(1, 4)
+        c = rng.normal(size=n)
+        rows = rng.uniform(0.1, 3, size=(m, n)).tolist() + [np.ones(n).tolist()]
+        senses = list(rng.choice(["<=", ">="], size=m)) + ["<="]
+        rhs = rng.uniform(1, 10, size=m).tolist() + [20.0]
+        expected = brute_force_max(c, rows, senses, rhs)
+        x = analysis.simplex_max(c, rows, senses, rhs)
+        if expected is None:
+            assert x is None
+        else:
+            assert x is not None
+            assert c @ x == pytest.approx(expected, rel=1e-6, abs=1e-6)
+
+
+def test_optimize_allocation_respects_limits():
+    spec = {
+        "area_m2": 1000,
+        "country": "US",
+        "systems": ["soil", "soilless"],
+        "crops": {"tomato": {"max_area": 300}, "lettuce": {"min_area": 100}},
+    }
+    report = analysis.optimize_allocation(spec)
+    by_crop = {}
+    for row in report["allocation"]:
+        by_crop[row["crop"]] = by_crop.get(row["crop"], 0) + row["area"]
+    assert sum(by_crop.values()) <= 1000 + 1e-6
+    assert by_crop.get("tomato", 0) <= 300 + 1e-6
+    assert by_crop.get("lettuce", 0) >= 100 - 1e-6
+
+
+@pytest.mark.parametrize(
+    "spec",
+    [
+        {"area_m2": 100, "systems": "soil"},
+        {"area_m2": 100, "systems": ["greenhouse"]},
+        {"area_m2": 100, "crops": ["tomatoes"]},
+        {"area_m2": 100, "setup_levels": ["deluxe"]},
+        {"area_m2": 100, "crops": {"tomato": {"systems": ["moon"]}}},
+    ],
+)
+def test_optimize_allocation_rejects_unknown_names(spec):
+    with pytest.raises(ValueError):
+        analysis.optimize_allocation(spec)
@@ -0,0 +1,184 @@
+import copy
+import os
+import subprocess
+import sys
+
+import pytest
+
+import engine
+import parameters
+import storage
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(autouse=True)
+def builtin_params():
+    yield
+    parameters.install_params({}, "builtin")
+
+
+def test_invalid_params_leave_the_current_set_in_place():
+    current = parameters.PARAMS
+    params = copy.deepcopy(parameters.current_params())
+    params["crop_params"]["GLOBAL"]["soilless"]["tomato"]["plants_per_m2"] = -1
+    with pytest.raises(ValueError):
+        parameters.install_params(params, "broken")
+    with pytest.raises(ValueError):
+        parameters.install_params({"crop_params": {"GLOBAL": 3}}, "broken")
+    assert parameters.PARAMS is current
+
+
+def test_install_params_publishes_one_consistent_set():
+    params = copy.deepcopy(parameters.current_params())
+    params["price_per_kg_usd"]["GLOBAL"]["tomato"] = 9.5
+    version = parameters.install_params(params, "test")
+    snapshot = parameters.PARAMS
+    assert snapshot.version == version
+    assert snapshot.source == "test"
+    assert parameters.estimate_price_per_kg_usd("tomato", "ZZ") == 9.5
+    # The built-in tables stay as they were.
+    assert parameters.PRICE_PER_KG_USD["GLOBAL"]["tomato"] == 2.0
+
+
+def test_params_files_with_fx_to_usd_still_load():
+    # Files from export-params before the rates moved to their own file.
+    params = copy.deepcopy(parameters.current_params())
+    params["solar_savings_rate"] = 0.25
+    params["fx_to_usd"] = {"USD": 1.0, "EUR": 2.0}
+    rates = parameters.PARAMS.fx
+    parameters.install_params(params, "old export")
+    assert parameters.PARAMS.tables["SOLAR_SAVINGS_RATE"] == 0.25
+    assert parameters.PARAMS.fx is rates
+
+
+def test_new_rates_only_move_the_keys_of_their_currency():
+    before = parameters.PARAMS
+    usd_form = {"area_m2": "100", "country": "US"}
+    eur_form = {"area_m2": "100", "country": "US", "currency_override": "EUR"}
+    usd_id, eur_id = storage.result_id_for(usd_form), storage.result_id_for(eur_form)
+    eur_before, _ = engine.calculate(dict(eur_form))
+
+    rates = {**before.fx.rates, "EUR": before.fx.rates["EUR"] * 2}
+    parameters.install_fx_table(parameters.make_fx_table(rates))
+    try:
+        assert parameters.PARAMS.version == before.version
+        assert parameters.PARAMS.fx.version != before.fx.version
+        assert storage.result_id_for(usd_form) == usd_id
+        assert storage.result_id_for(eur_form) != eur_id
+        eur_after, _ = engine.calculate(dict(eur_form))
+    finally:
+        parameters.install_fx_table(before.fx)
+    assert eur_after["annual_revenue"] == pytest.approx(eur_before["annual_revenue"] / 2, rel=1e-3)
+
+
+# A worker process: report its parameter version, wait for the go, then
+# poll the params file as the before_request hook does until it changes.
+WORKER = """
+import sys, time
+import parameters
+print(parameters.PARAMS.version, flush=True)
+sys.stdin.readline()
+deadline = time.monotonic() + 10
+while not parameters.maybe_reload_params() and time.monotonic() < deadline:
+    time.sleep(0.01)
+print(parameters.PARAMS.version, parameters.estimate_price_per_kg_usd("tomato", "ZZ"), flush=True)
+"""
+
+
+def test_workers_converge_on_a_changed_params_file(tmp_path):
+    path = tmp_path / "params.json"
+    env = {**os.environ, "MARO_PARAMS_FILE": str(path), "MARO_PARAMS_CHECK_INTERVAL": "0.05"}
+    builtin = parameters.PARAMS.version
+    workers = [
+        subprocess.Popen(
+            [sys.executable, "-c", WORKER], cwd=ROOT, env=env,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+        )
+        for _ in range(2)
+    ]
+    try:
+        assert [worker.stdout.readline().split() for worker in workers] == [[builtin]] * 2
+
+        params = copy.deepcopy(parameters.BUILTIN_PARAMS)
+        params["price_per_kg_usd"]["GLOBAL"]["tomato"] = 9.5
+        parameters.save_params_file(params, str(path))
+        for worker in workers:
+            worker.stdin.write("\n")
+            worker.stdin.flush()
+        reloaded = [worker.stdout.readline().split() for worker in workers]
+    finally:
+        for worker in workers:
+            worker.kill()
+            worker.wait()
+
+    version = parameters.install_params(params, str(path))
+    assert version != builtin
+    assert reloaded == [[version, "9.5"]] * 2
+
+
+def builtin_tables():
+    return copy.deepcopy(dict(parameters.PARAMS.tables))
+
+
+def test_index_resolves_like_the_nested_tables():
+    tables = builtin_tables()
+    tables["CROP_PARAMS"]["NG"] = {"soil": {"okra": dict(tables["CROP_PARAMS"]["GLOBAL"]["soil"]["tomato"])}}
+    tables["CAPEX_PER_M2_USD"]["NG"] = {"local": 40}
+    param_set = parameters.make_param_set(tables, "test")
+    countries, systems, crops, setups = param_set.keys
+    for country in sorted(countries) + ["ZZ"]:
+        for system_type in sorted(systems) + ["nope"]:
+            for crop in sorted(crops) + ["nope"]:
+                for setup_level in sorted(setups) + ["nope"]:
+                    record = parameters.lookup_params(country, system_type, crop, setup_level, param_set)
+                    params, _ = parameters._resolve_crop_params(tables, country, system_type, crop)
+                    assert {field: record[field] for field in parameters.CROP_PARAM_FIELDS} == {
+                        field: params[field] for field in parameters.CROP_PARAM_FIELDS
+                    }
+                    assert record["price_per_kg_usd"] == parameters._resolve_price_per_kg_usd(tables, crop, country)[0]
+                    assert record["capex_per_m2_usd"] == parameters._resolve_capex_per_m2_usd(tables, setup_level, country)[0]
+                    assert record["production_cost_per_m2_usd"] == (
+                        parameters._resolve_production_cost_per_m2_usd(tables, system_type)[0]
+                    )
+
+
+def test_fallback_report_names_each_fallback():
+    tables = builtin_tables()
+    tables["CROP_PARAMS"]["NG"] = {"soil": {"okra": dict(tables["CROP_PARAMS"]["GLOBAL"]["soil"]["tomato"])}}
+    report = parameters.param_fallback_report(parameters.make_param_set(tables, "test"))
+    entries = {entry["key"]: entry["fallbacks"] for entry in report["entries"]}
+    # okra has a crop entry in NG only and no price anywhere.
+    assert "crop_params" not in entries["NG/soil/okra/local"]
+    assert entries["NG/soil/okra/local"]["price_per_kg_usd"] == "default 2.0"
+    assert entries["GLOBAL/soil/okra/local"]["crop_params"] == "GLOBAL/soilless/tomato"
+    assert entries["NG/soil/tomato/local"]["crop_params"] == "GLOBAL"
+    assert report["with_fallbacks"] == len(report["entries"])
+    assert report["fallbacks_by_field"]["crop_params"] == sum(
+        "crop_params" in fallbacks for fallbacks in entries.values()
+    )
+
+
+def test_validator_lists_every_problem():
+    tables = builtin_tables()
+    del tables["PRICE_PER_KG_USD"]["GLOBAL"]
+    tables["CROP_PARAMS"]["GLOBAL"]["soil"]["tomato"]["plants_per_m2"] = 0
+    del tables["CROP_PARAMS"]["GLOBAL"]["soil"]["lettuce"]["crops_per_year"]
+    tables["CAPEX_PER_M2_USD"]["GLOBAL"]["local"] = "cheap"
+    tables["PRODUCTION_COST_PER_M2_USD"]["soil"] = -1
+    with pytest.raises(ValueError) as raised:
+        parameters.make_param_set(tables, "broken")
+    message = str(raised.value)
+    for problem in (
+        "PRICE_PER_KG_USD: missing GLOBAL table",
+        "CROP_PARAMS[GLOBAL][soil][tomato][plants_per_m2]: 0 must be > 0.0",
+        "CROP_PARAMS[GLOBAL][soil][lettuce]: missing crops_per_year",
+        "CAPEX_PER_M2_USD[GLOBAL][local]: 'cheap' is not a number",
+        "PRODUCTION_COST_PER_M2_USD[soil]: -1 must be >= 0.0",
+    ):
+        assert problem in message
+
+    tables = builtin_tables()
+    tables["PRICE_PER_KG_USD"]["GLOBAL"][parameters.PARAM_WILDCARD] = 1.0
+    with pytest.raises(ValueError, match="must not use the key"):
+        parameters.make_param_set(tables, "broken")
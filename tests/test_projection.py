@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+import analysis
+import app
+
+# Cash flows with a known NPV or IRR (year 0 first).
+KNOWN_NPV = [
+    ([-40000, 5000, 8000, 12000, 30000], 0.08, 3065.222668),
+    ([-100, 110], 0.10, 0.0),
+    ([-1000, 300, 400, 500], 0.0, 200.0),
+]
+KNOWN_IRR = [
+    ([-100, 39, 59, 55, 20], 0.2809484212),
+    ([-100, 110], 0.10),
+    ([-100, 0, 0, 0, 0, 0, 0, 0, 0, 1e6], 10000 ** (1 / 9) - 1),
+    ([-1000, 1000], 0.0),
+    ([-100, 50], -0.5),
+]
+
+
+def padded(flows):
+    # irr and npv take rows of equal length; trailing zeros change neither.
+    width = max(len(cash) for cash in flows)
+    return np.array([list(cash) + [0.0] * (width - len(cash)) for cash in flows])
+
+
+@pytest.mark.parametrize("cash, rate, expected", KNOWN_NPV)
+def test_npv_of_known_cash_flows(cash, rate, expected):
+    assert analysis.npv(np.array([cash], dtype=float), rate)[0] == pytest.approx(expected, abs=1e-6)
+
+
+def test_irr_of_known_cash_flows():
+    rates = analysis.irr(padded([cash for cash, _ in KNOWN_IRR]))
+    assert rates == pytest.approx([rate for _, rate in KNOWN_IRR], abs=1e-8)
+    # Discounting at the IRR leaves nothing.
+    for (cash, _), rate in zip(KNOWN_IRR, rates):
+        assert analysis.npv(np.array([cash], dtype=float), rate)[0] == pytest.approx(0, abs=1e-6)
+
+
+def test_irr_without_a_root_is_nan():
+    rates = analysis.irr(padded([[100, 100], [-100, -50], [-100, 110]]))
+    assert np.isnan(rates[:2]).all()
+    assert rates[2] == pytest.approx(0.10)
+
+
+def test_payback_interpolates_within_the_year():
+    cash = np.array([[-100, 30, 30, 30, 30], [-100, 10, 10, 10, 10], [0, 5, 5, 5, 5]], dtype=float)
+    assert analysis.payback_years(cash)[0] == pytest.approx(10 / 3)
+    assert np.isnan(analysis.payback_years(cash)[1])
+    assert analysis.payback_years(cash)[2] == 0
+    # Discounted at 10%, 40 a year is worth 99.474 after three years and
+    # 27.321 in the fourth.
+    cash[0, 1:] = 40
+    assert analysis.payback_years(cash, 0.10)[0] == pytest.approx(3.01925, abs=1e-5)
+
+
+def options(**overrides):
+    return analysis.projection_options({
+        "years": 5, "ramp_up": [], "price_inflation": 0, "cost_inflation": 0,
+        "equipment_replacement_share": 0, **overrides,
+    })
+
+
+def project(revenue, cost, setup, opts):
+    return analysis.project_cash_flows(np.array([revenue]), np.array([cost]), np.array([setup]), opts)
+
+
+def test_flat_projection_without_financing():
+    cash, _ = project(100.0, 40.0, 200.0, options())
+    assert cash[0].tolist() == [-200, 60, 60, 60, 60, 60]
+    # A 5-year annuity factor of 200 / 60.
+    assert analysis.irr(cash)[0] == pytest.approx(0.1523824, abs=1e-7)
+
+
+def test_loan_repayments_are_worth_the_loan_at_its_rate():
+    # A 10-year loan on a 5-year horizon: the balance is repaid in year 5.
+    opts = options(loan_share=0.75, loan_rate=0.07, loan_years=10)
+    cash, series = project(100.0, 40.0, 200.0, opts)
+    assert cash[0, 0] == pytest.approx(-50)
+    debt_service = np.concatenate([[0.0], series["debt_service"][0]])
+    assert analysis.npv(debt_service[None, :], 0.07)[0] == pytest.approx(150)
+    assert cash[0, 1:] == pytest.approx(60 - series["debt_service"][0])
+
+
+def test_api_projection_reports_match_their_cash_flows():
+    response = app.app.test_client().post("/api/projection", json={
+        "scenario": {"area_m2": 800, "crop": "tomato", "country": "US"},
+        "discount_rate": 0.06,
+    })
+    assert response.status_code == 200
+    report = response.get_json()["results"][0]
+    cash = np.array([report["cash_flows"]])
+    assert report["npv"] == pytest.approx(analysis.npv(cash, 0.06)[0])
+    if report["irr"] is not None:
+        assert analysis.npv(cash, report["irr"])[0] == pytest.approx(0, abs=1e-6 * np.abs(cash).sum())
@@ -0,0 +1,154 @@
+import json
+import random
+
+import pytest
+
+import app
+import engine
+import jobs
+import storage
+
+CROPS = ["tomato", "lettuce", "strawberry", "cannabis", "unknown_crop"]
+SYSTEMS = ["soil", "soilless", "vertical", "hydroponics", "aeroponics", "unknown_system"]
+
+
+def random_form(rng):
+    form = {
+        "area_m2": rng.choice(["0", "50", "1234.5", "abc", ""]),
+        "crop": rng.choice(CROPS),
+        "system_type": rng.choice(SYSTEMS),
+        "setup_level": rng.choice(["basic", "standard", "premium", "unknown"]),
+        "country": rng.choice(["US", "NG", "DE", "KE", "ZZ", ""]),
+        "use_solar": rng.random() < 0.5,
+        "currency_override": rng.choice(["", "", "EUR", "XYZ"]),
+    }
+    for field in ("price_per_unit", "annual_production_cost", "capex_per_m2"):
+        form[field] = rng.choice(["", "0", "-1", "3.5", "1000", "abc"])
+    return form
+
+
+def test_result_graph_matches_calculate():
+    # RESULT_GRAPH shares compute_results' helpers but restates the
+    # estimates of fill_auto_economics_for_form; types must match too.
+    rng = random.Random(11)
+    for _ in range(3000):
+        form = random_form(rng)
+        expected, expected_error = engine.calculate(dict(form))
+        results, error = engine.LazyResults.from_form(form).get()
+        assert error == expected_error
+        if expected is not None:
+            assert jobs.dumps_json(results) == jobs.dumps_json(expected)
+
+
+SUBMITTED = {
+    "area_m2": "2000",
+    "crop": "tomato",
+    "system_type": "soilless",
+    "setup_level": "standard",
+    "country": "US",
+    "currency_override": "",
+    "use_custom_price": "on",
+    "price_per_unit": "4.5",
+}
+
+
+@pytest.fixture(scope="module")
+def result_id():
+    response = app.app.test_client().post("/", data=SUBMITTED)
+    assert response.status_code == 302
+    return response.location.rsplit("/", 1)[-1]
+
+
+def post_whatif(result_id, spec):
+    return app.app.test_client().post(f"/api/v1/results/{result_id}/whatif", json=spec)
+
+
+@pytest.mark.parametrize("changes", [
+    {"country": "NG"},
+    {"crop": "lettuce"},
+    {"system_type": "vertical", "setup_level": "premium"},
+    {"area_m2": 3500},
+    {"currency_override": "EUR"},
+    {"price_per_unit": ""},
+    {"capex_per_m2": 300, "country": "KE"},
+])
+def test_whatif_matches_calculate_on_the_changed_form(result_id, changes):
+    response = post_whatif(result_id, {"changes": changes})
+    assert response.status_code == 200, response.get_json()
+    # The stored form, with the estimated overrides blank again, as
+    # resubmitted with the changes.
+    conn = storage.open_db()
+    try:
+        form = engine.submitted_form(storage.load_result(conn, result_id).form)
+    finally:
+        conn.close()
+    form.update({key: str(value) for key, value in changes.items()})
+    expected, error = engine.calculate(form)
+    assert error is None
+    assert jobs.dumps_json(response.get_json()["results"]) == jobs.dumps_json(
+        json.loads(jobs.dumps_json(expected))
+    )
+
+
+def test_whatif_scales_estimates(result_id):
+    base = post_whatif(result_id, {"fields": ["capex_per_m2", "total_setup_cost"]}).get_json()
+    scaled = post_whatif(
+        result_id, {"scale": {"capex_per_m2": 2}, "fields": ["capex_per_m2"]}
+    ).get_json()
+    assert scaled["results"]["capex_per_m2"] == 2 * base["results"]["capex_per_m2"]
+    assert scaled["changed"] == ["capex_per_m2"]
+
+
+@pytest.mark.parametrize("body", [
+    [1, 2],
+    "text",
+    {"fields": "annual_profit"},
+    {"fields": [1]},
+    {"fields": ["no_such_field"]},
+    {"changes": ["country"]},
+    {"changes": {"no_such_input": 1}},
+    {"scale": {"area_m2": "2"}},
+    {"scale": {"crop": 2}},
+])
+def test_whatif_rejects_bad_specs(result_id, body):
+    assert post_whatif(result_id, body).status_code == 400
+
+
+def test_whatif_unknown_result():
+    assert post_whatif("nope", {}).status_code == 404
+
+
+def test_equal_submissions_share_one_permalink(monkeypatch):
+    client = app.app.test_client()
+    form = {**SUBMITTED, "area_m2": "2718"}
+    first = client.post("/", data=form)
+    assert first.status_code == 302
+    result_id = first.location.rsplit("/", 1)[-1]
+
+    # Served from the results table the second time, not recomputed.
+    def calculate(*args, **kwargs):
+        raise AssertionError("recomputed a stored result")
+
+    monkeypatch.setattr(engine, "calculate", calculate)
+    again = client.post("/", data={**form, "area_m2": " 2718.0 "})
+    assert again.location == first.location
+    monkeypatch.undo()
+
+    other = client.post("/", data={**form, "price_per_unit": "4.6"})
+    assert other.location != first.location
+
+    conn = storage.open_db()
+    try:
+        rows = conn.execute("SELECT COUNT(*) FROM results WHERE id = ?", (result_id,)).fetchone()[0]
+    finally:
+        conn.close()
+    assert rows == 1
+    assert client.get("/results").location == other.location
+
+
+def test_permalink_page(result_id):
+    client = app.app.test_client()
+    page = client.get(f"/r/{result_id}")
+    assert page.status_code == 200
+    assert result_id in page.get_data(as_text=True)
+    assert client.get("/r/nope").status_code == 404
@@ -0,0 +1,64 @@
+import pytest
+
+import analysis
+import app
+import engine
+
+SCENARIOS = [
+    {"area_m2": 500, "crop": "tomato", "country": "US"},
+    {"area_m2": 1200, "crop": "lettuce", "system_type": "vertical", "country": "NG"},
+]
+
+
+def test_seeded_run_reproduces_inline_and_on_the_pool(monkeypatch):
+    monkeypatch.setattr(engine, "PROCESS_POOL_WORKERS", 2)
+    try:
+        pooled = analysis.run_risk(SCENARIOS, draws=2000, seed=42)
+    finally:
+        engine.shutdown_process_pool()
+    monkeypatch.setattr(engine, "PROCESS_POOL_WORKERS", 1)
+    inline = analysis.run_risk(SCENARIOS, draws=2000, seed=42)
+    assert pooled == inline
+    assert pooled["seed"] == 42
+
+    # The reported seed of an unseeded run replays it.
+    unseeded = analysis.run_risk(SCENARIOS[:1], draws=500)
+    assert analysis.run_risk(SCENARIOS[:1], draws=500, seed=unseeded["seed"]) == unseeded
+
+
+def test_simulate_risk_report():
+    report, error = analysis.simulate_risk(SCENARIOS[0], draws=5000, seed=1)
+    assert error is None
+    profit = report["annual_profit"]
+    assert profit["p5"] <= profit["p50"] <= profit["p95"]
+    assert 0 <= report["probability_of_loss"] <= 1
+
+    # Fixed multipliers give the point estimate on every draw.
+    fixed = {name: {"dist": "fixed"} for name in analysis.RISK_DEFAULT_UNCERTAINTY}
+    report, _ = analysis.simulate_risk(SCENARIOS[0], draws=10, seed=1, uncertainty=fixed)
+    assert report["annual_profit"]["p50"] == pytest.approx(report["point"]["annual_profit"])
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"scenarios": {}},
+    {"scenarios": []},
+    {"scenarios": [1]},
+    {"scenarios": SCENARIOS, "draws": 0},
+    {"scenarios": SCENARIOS, "seed": -1},
+    {"scenarios": SCENARIOS, "seed": True},
+    {"scenarios": SCENARIOS, "uncertainty": ["yield"]},
+    {"scenarios": SCENARIOS, "uncertainty": {"weather": {"dist": "fixed"}}},
+    {"scenarios": SCENARIOS, "uncertainty": {"yield": {"dist": "cauchy"}}},
+    {"scenarios": SCENARIOS, "uncertainty": {"yield": {"dist": "normal"}}},
+])
+def test_run_risk_rejects_bad_input(kwargs):
+    with pytest.raises(ValueError):
+        analysis.run_risk(**kwargs)
+
+
+def test_api_risk():
+    client = app.app.test_client()
+    response = client.post("/api/risk", json={"scenarios": SCENARIOS, "draws": 1000, "seed": 5})
+    assert response.status_code == 200
+    assert len(response.get_json()["results"]) == 2
+    assert client.post("/api/risk", json=[1]).status_code == 400
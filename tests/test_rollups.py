@@ -0,0 +1,100 @@
+import datetime
+import random
+
+import pytest
+
+import app
+import storage
+
+FULL_GROUP_BY = """
+    SELECT substr(created_at, 1, 10) AS day, coalesce(crop, '') AS crop,
+           coalesce(country_code, '') AS country_code,
+           coalesce(system_type, '') AS system_type,
+           coalesce(currency_code, '') AS currency_code,
+           count(*), total(area_m2), total(annual_yield),
+           total(annual_revenue), total(annual_profit)
+    FROM calculations
+    GROUP BY 1, 2, 3, 4, 5
+    ORDER BY 1, 2, 3, 4, 5
+"""
+
+ROLLUPS = """
+    SELECT day, crop, country_code, system_type, currency_code,
+           calculations, total_area_m2, total_annual_yield,
+           total_annual_revenue, total_annual_profit
+    FROM calculation_rollups
+    ORDER BY 1, 2, 3, 4, 5
+"""
+
+
+@pytest.fixture
+def conn():
+    conn = storage.open_db()
+    storage.reset_history(conn)
+    yield conn
+    storage.reset_history(conn)
+    conn.close()
+
+
+def records(rng, n):
+    start = datetime.datetime(2026, 3, 1)
+    return [
+        (
+            (start + datetime.timedelta(hours=rng.randrange(24 * 20))).isoformat(),
+            rng.choice(["US", "NG"]), rng.choice(["USD", "NGN"]),
+            rng.choice(["tomato", "lettuce", None]), rng.choice(["soil", "vertical"]),
+            rng.uniform(10, 1000), rng.uniform(0, 1e4), rng.uniform(0, 1e5), rng.uniform(-1e4, 1e5),
+            None, None, None,
+        )
+        for _ in range(n)
+    ]
+
+
+def assert_rollups_match(conn):
+    expected = [tuple(row) for row in conn.execute(FULL_GROUP_BY)]
+    actual = [tuple(row) for row in conn.execute(ROLLUPS)]
+    assert [row[:6] for row in actual] == [row[:6] for row in expected]
+    for got, want in zip(actual, expected):
+        assert got[6:] == pytest.approx(want[6:])
+
+
+@pytest.mark.parametrize("mode", ["inline", "catch_up"])
+def test_rollups_match_a_full_group_by(conn, monkeypatch, mode):
+    monkeypatch.setattr(storage, "ROLLUP_MODE", mode)
+    rng = random.Random(4)
+    for size in (1, 50, 300):
+        storage.insert_calculations(conn, records(rng, size))
+        storage.catch_up_rollups(conn)
+        assert_rollups_match(conn)
+
+    storage.rebuild_rollups(conn)
+    assert_rollups_match(conn)
+
+
+def test_reset_clears_everything_derived_from_the_history(conn):
+    rng = random.Random(5)
+    storage.insert_calculations(conn, records(rng, 40))
+    storage.reevaluate_history(conn, workers=1)
+    assert conn.execute("SELECT count(*) FROM reevaluations").fetchone()[0] == 40
+
+    storage.reset_history(conn)
+    for table in ("calculations", "calculation_rollups", "rollup_state",
+                  "reevaluations", "reevaluation_state"):
+        assert conn.execute(f"SELECT count(*) FROM {table}").fetchone()[0] == 0, table
+
+    # Ids start over, and the rollups and a new re-evaluation run still
+    # cover every row.
+    storage.insert_calculations(conn, records(rng, 25))
+    assert conn.execute("SELECT min(id) FROM calculations").fetchone()[0] == 1
+    assert_rollups_match(conn)
+    state = storage.reevaluate_history(conn, workers=1)
+    assert (state["last_id"], state["max_id"]) == (25, 25)
+    assert conn.execute("SELECT count(*) FROM reevaluations").fetchone()[0] == 25
+
+
+def test_admin_reset_route(conn):
+    storage.insert_calculations(conn, records(random.Random(6), 5))
+    response = app.app.test_client().post("/admin/history/reset")
+    assert response.status_code == 302
+    assert conn.execute("SELECT count(*) FROM calculations").fetchone()[0] == 0
+    assert conn.execute("SELECT count(*) FROM rollup_state").fetchone()[0] == 0
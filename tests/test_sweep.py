@@ -0,0 +1,77 @@
+import itertools
+import json
+
+import pytest
+
+import analysis
+import app
+import engine
+
+AREAS = [120, 480.5, 2000]
+CROPS = ["tomato", "lettuce", "basil", "strawberry"]
+SYSTEMS = ["soil", "vertical"]
+SETUPS = ["basic", "standard", "premium"]
+
+
+def ranked_by_calculate(metric, country):
+    """Every grid cell priced by calculate(), best first; ties in grid order."""
+    field, higher_is_better = analysis.SWEEP_METRICS[metric]
+    ranked = []
+    for i, (area, crop, system_type, setup_level) in enumerate(
+        itertools.product(AREAS, CROPS, SYSTEMS, SETUPS)
+    ):
+        results, error = engine.calculate({
+            "area_m2": str(area), "crop": crop, "system_type": system_type,
+            "setup_level": setup_level, "country": country,
+        })
+        assert error is None
+        score = results[field]
+        if score is not None:
+            ranked.append((-score if higher_is_better else score, i, results))
+    ranked.sort(key=lambda entry: entry[:2])
+    return [results for _, _, results in ranked]
+
+
+@pytest.mark.parametrize("metric", sorted(analysis.SWEEP_METRICS))
+def test_sweep_keeps_the_top_n_across_chunks(monkeypatch, metric):
+    # Small chunks, so the running top-N is merged many times.
+    monkeypatch.setattr(analysis, "SWEEP_CHUNK_SIZE", 7)
+    field, _ = analysis.SWEEP_METRICS[metric]
+    expected = ranked_by_calculate(metric, "NG")[:10]
+    rows = analysis.sweep_scenarios(
+        area=AREAS, crops=CROPS, system_types=SYSTEMS, setup_levels=SETUPS,
+        country="NG", metric=metric, top_n=10,
+    )
+    assert [row["rank"] for row in rows] == list(range(1, len(expected) + 1))
+    for row, results in zip(rows, expected):
+        cell = ("area", "crop", "system_type", "setup_level")
+        assert [row[key] for key in cell] == [results[key] for key in cell]
+        assert row["score"] == row[field] == pytest.approx(results[field])
+
+
+def test_sweep_area_ranges_include_the_stop():
+    assert list(analysis.sweep_area_values({"start": 100, "stop": 300, "step": 100})) == [100, 200, 300]
+    assert list(analysis.sweep_area_values(250)) == [250]
+
+
+@pytest.mark.parametrize("body", [
+    {"metric": "revenue"},
+    {"top_n": 0},
+    {"top_n": "many"},
+    {"crops": []},
+    {"area": {"start": 10, "stop": 5, "step": 1}},
+    {"area": ["big"]},
+])
+def test_sweep_api_rejects_bad_arguments(body):
+    assert app.app.test_client().post("/api/sweep", json=body).status_code == 400
+
+
+def test_sweep_api_streams_ranked_rows():
+    response = app.app.test_client().post("/api/sweep", json={
+        "area": AREAS, "crops": CROPS, "country": "US", "metric": "profit", "top_n": 3,
+    })
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in response.get_data().splitlines()]
+    assert [row["rank"] for row in rows] == [1, 2, 3]
+    scores = [row["score"] for row in rows]
+    assert scores == sorted(scores, reverse=True)